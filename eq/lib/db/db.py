@@ -29,7 +29,20 @@ To test the module use:
 $ python db.py
 """
 
-import mysql.connector
+import re
+import threading
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+
+try:
+    import Queue as queue   # Python 2
+except ImportError:
+    import queue
+
+try:
+    import mysql.connector
+except ImportError:     # only the SQLite backend is available (see sqlitedb)
+    mysql = None
 
 __author__ = "Jorge Morgado"
 __copyright__ = "Copyright (c)2014, Jorge Morgado"
@@ -40,10 +53,229 @@ __maintainer__ = "Jorge Morgado"
 __email__ = "jorge (at) morgado (dot) ch"
 __status__ = "Production"
 
+# TODO Set this from a configuration file
+# Run the statements as server-side prepared statements (see Db.__init__)
+PREPARED = False
+
+# How many SQL statements to keep (per process, see cached_sql and
+# positional) and how many prepared statements to keep open (per Db)
+SQL_CACHE_SIZE = 512
+PREPARED_CACHE_SIZE = 64
+
+# TODO Set this from a configuration file
+# How many records to write per statement (see insert_many and update_many)
+CHUNK_SIZE = 500
+
+# Connection pools shared by all Db instances (see get_pool)
+pools = {}
+pools_lock = threading.Lock()
+
+# The SQL statements built by Db, by shape, and their positional form
+sql_cache = {}
+positional_cache = {}
+
+# A named placeholder, e.g. %(id)s
+PLACEHOLDER = re.compile(r'%\((\w+)\)s')
+
+
+def cached_sql(key, build):
+    """ Return the SQL statement of the given shape `key`, calling `build`
+        to create it the first time only.
+
+    >>> cached_sql(('test', 1), lambda: 'SELECT 1')
+    'SELECT 1'
+    >>> cached_sql(('test', 1), lambda: 'SELECT 2')
+    'SELECT 1'
+    """
+
+    sql = sql_cache.get(key)
+
+    if sql is None:
+        if len(sql_cache) >= SQL_CACHE_SIZE:
+            sql_cache.clear()
+        sql = sql_cache[key] = build()
+
+    return sql
+
+
+def positional(sql):
+    """ Translate an SQL statement with named placeholders into one with
+        positional placeholders (as taken by prepared statements). Returns
+        the statement and the names of its parameters, in order.
+
+    >>> positional('UPDATE test SET col1 = %(col1)s WHERE id = %(id)s')
+    ('UPDATE test SET col1 = %s WHERE id = %s', ['col1', 'id'])
+    """
+
+    found = positional_cache.get(sql)
+
+    if found is None:
+        if len(positional_cache) >= SQL_CACHE_SIZE:
+            positional_cache.clear()
+        found = positional_cache[sql] = (PLACEHOLDER.sub('%s', sql),
+                                         PLACEHOLDER.findall(sql))
+
+    return found
+
+
+def prepare(sql, params):
+    """ Return the statement and the parameters to run as a prepared
+        statement: named parameters (a dictionary) are passed in the order
+        of their placeholders, positional ones (or none) as they are.
+
+    >>> prepare('SELECT * FROM test WHERE id = %(id)s', { 'id': 1 })
+    ('SELECT * FROM test WHERE id = %s', (1,))
+    >>> prepare('SELECT * FROM test WHERE id = %s', (1,))
+    ('SELECT * FROM test WHERE id = %s', (1,))
+    >>> prepare('SELECT 1', None)
+    ('SELECT 1', None)
+    """
+
+    if isinstance(params, dict):
+        sql, names = positional(sql)
+        params = tuple([ params[name] for name in names ])
+
+    return sql, params
+
+
+def get_pool(dbconfig, size, connect=None):
+    """ Return the connection pool for the given database configuration,
+        creating it on the first call (see Pool for `connect`).
+    """
+
+    key = (dbconfig['user'], dbconfig['host'], dbconfig['port'],
+           dbconfig['database'])
+
+    with pools_lock:
+        if key not in pools:
+            pools[key] = Pool(dbconfig, size, connect=connect)
+
+        return pools[key]
+
+
+class Pool():
+    'A pool of warm database connections shared by several threads.'
+
+    def __init__(self, dbconfig, size=5, timeout=None, connect=None):
+        """ Create a pool of up to `size` connections. Connections are only
+            opened when needed. If all connections are in use, checkout()
+            waits up to `timeout` seconds (forever if None) for one to be
+            returned.
+
+            The connections are opened by `connect(**dbconfig)`, MySQL ones
+            if not given.
+        """
+
+        self.dbconfig = dbconfig
+        self.connect = connect or mysql.connector.connect
+        self.size = size
+        self.timeout = timeout
+
+        # Reuse the most recently returned (i.e., the warmest) connection
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+
+        # The connection held by each thread (and how many times)
+        self.local = threading.local()
+
+
+    def checkout(self):
+        """ Get a connection for the calling thread. While a thread holds a
+            connection, further checkouts return that same connection.
+        """
+
+        conn = getattr(self.local, 'conn', None)
+
+        if conn is None:
+            conn = self.__get()
+            self.local.conn = conn
+            self.local.count = 0
+
+        self.local.count += 1
+
+        return conn
+
+
+    def last(self, conn):
+        """ Return True if returning `conn` makes it available to other
+            threads, i.e., it is not checked out again by the calling thread.
+        """
+
+        if getattr(self.local, 'conn', None) is conn:
+            return self.local.count <= 1
+
+        return True
+
+
+    def checkin(self, conn):
+        """ Return a connection to the pool. The connection only becomes
+            available to other threads once the calling thread has returned
+            all its checkouts.
+        """
+
+        if getattr(self.local, 'conn', None) is conn:
+            self.local.count -= 1
+            if self.local.count > 0:
+                return
+            self.local.conn = None
+
+        self.idle.put(conn)
+
+
+    def __get(self):
+        """ Get an idle (and healthy) connection or open a new one if the
+            pool is not full yet.
+        """
+
+        while True:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                with self.lock:
+                    full = self.opened >= self.size
+                    if not full:
+                        self.opened += 1
+
+                if not full:
+                    try:
+                        return self.connect(**self.dbconfig)
+                    except Exception:
+                        with self.lock:
+                            self.opened -= 1
+                        raise
+
+                try:
+                    conn = self.idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise Exception("No database connection available")
+
+            if self.__is_healthy(conn):
+                return conn
+
+            # Drop the broken connection (a new one can be opened instead)
+            with self.lock:
+                self.opened -= 1
+
+
+    def __is_healthy(self, conn):
+        """ Check (and try to restore) the connection to the server. """
+
+        try:
+            conn.ping(reconnect=True, attempts=1, delay=0)
+            return True
+        except Exception:   # catch *all* exceptions
+            try:
+                conn.close()
+            except Exception:
+                pass
+            return False
+
+
 class Db():
     def __init__(self, dbuser, dbpass, dbname,
                  dbhost='127.0.0.1', dbport=3306, raise_on_warnings=True,
-                 buffered_cursor=True):
+                 buffered_cursor=True, pool_size=None, prepared=None):
         """ Connect to the `database`.
 
             Please note that the connection sets a buffered cursor by default.
@@ -52,6 +284,18 @@ class Db():
             safer to use non-buffering cursor. In this case, you will then
             have to consume *all* rows.
 
+            If `pool_size` is given, the connection is taken from a pool of
+            up to `pool_size` connections shared by all Db instances (of all
+            threads) with the same configuration, and given back to the pool
+            on close(). All Db instances of the same thread share the same
+            connection, so don't use non-buffering cursors with pooling.
+
+            If `prepared` is set (the module's PREPARED setting if not
+            given), statements run as server-side prepared statements: each
+            distinct statement is parsed by the server once and then only
+            executed with new values (see __execute). The rows found are
+            always buffered then.
+
         >>> mydb = Db('test', 'password', 'test', '127.0.0.1')
         >>> mydb.close()
 
@@ -87,8 +331,27 @@ class Db():
             'autocommit'        : False,
         }
 
+        self.pool = None
+        self.conn = None
+        self.cursor_ro = None
+        self.cursor_rw = None
+
+        # Prepared statements (SQL -> cursor) and the rows found by the last
+        # select() in prepared mode
+        self.prepared = PREPARED if prepared is None else prepared
+        self.statements = OrderedDict()
+        self.rows = None
+
+        # The step between the ids generated by the server (see
+        # auto_increment_increment)
+        self.increment = None
+
         try:
-            self.conn = mysql.connector.connect(**dbconfig)
+            if pool_size:
+                self.pool = get_pool(dbconfig, pool_size)
+                self.conn = self.pool.checkout()
+            else:
+                self.conn = mysql.connector.connect(**dbconfig)
 
             # Create two cursors: one for RO and one for RW operartions
             self.cursor_ro = self.conn.cursor(buffered=buffered_cursor)
@@ -110,18 +373,78 @@ class Db():
         """
 
         try:
-            # Make sure data is commited to the database
-            self.conn.commit()
+            # Make sure data is commited to the database, unless the
+            # connection is still used by another instance (which might be
+            # in the middle of a transaction)
+            if self.pool is None or self.pool.last(self.conn):
+                self.conn.commit()
 
             if self.cursor_ro is not None:
                 self.cursor_ro.close()
             if self.cursor_rw is not None:
                 self.cursor_rw.close()
 
-            self.conn.close()
+            self.__close_statements()
+
+            if self.pool is None:
+                self.conn.close()
         except Exception:   # catch *all* exceptions
             pass            # but ignore them as we are closing
 
+        if self.pool is not None and self.conn is not None:
+            self.pool.checkin(self.conn)
+
+        # Never touch the connection again (it might be in use elsewhere)
+        self.conn = None
+
+
+    def ping(self):
+        """ Check the connection to the server, reconnecting if it was lost
+            (e.g., after being idle for too long).
+        """
+
+        # The prepared statements are lost if reconnected
+        self.__close_statements()
+
+        self.conn.ping(reconnect=True, attempts=3, delay=1)
+
+
+    def commit(self):
+        """ Commit the current transaction, making all changes done so far
+            visible to other connections.
+        """
+
+        self.conn.commit()
+
+
+    def rollback(self):
+        """ Roll back the current transaction, discarding all changes done
+            since the last commit.
+        """
+
+        self.conn.rollback()
+
+
+    @contextmanager
+    def transaction(self):
+        """ Run a block of statements in a single transaction: commit at the
+            end of the block or roll back if an exception is raised.
+
+        >>> mydb = Db('test', 'password', 'test', '127.0.0.1', pool_size=2)
+        >>> with mydb.transaction():
+        ...     mydb.insert('test', { 'col1': [ '%(col1)s', 'col1' ] }) > 0
+        True
+        >>> mydb.close()
+        """
+
+        try:
+            yield self
+        except Exception:
+            self.rollback()
+            raise
+        else:
+            self.commit()
+
 
     def insert(self, table, record):
         """ Insert a new record into `table`. Returns the ID of the last
@@ -136,23 +459,197 @@ class Db():
         >>> mydb.close()
         """
 
-        columns_list = []
-        values_list = []
+        query, data_dict = self.__insert_query(table, record)
+
+        cursor = self.__execute(self.cursor_rw, query, data_dict)
+
+        # Get the id of the last inserted recond and close the cursor
+        return cursor.lastrowid
+
+
+    def upsert(self, table, record, update):
+        """ Insert a new record into `table` or, if it would duplicate an
+            existing unique key, update the fields given in `update` (same
+            format as in update()) of the existing record instead. Both cases
+            are a single statement. Returns the ID of the inserted or updated
+            record (the table must have an auto-increment `id` column).
+
+        >>> mydb = Db('test', 'password', dbname='test', dbhost='127.0.0.1')
+        >>> mydb.upsert('test', { \
+                    'id'  : [ '%(id)s',   1      ], \
+                    'col1': [ '%(col1)s', 'col1' ], \
+                }, { \
+                    'col2': '"updated"', \
+                })
+        1
+        >>> mydb.close()
+        """
+
+        query, data_dict = self.__insert_query(table, record)
+        update = sorted(update.items())
+
+        def build():
+            set_list = []
+            for key, value in update:
+                set_list.append(key + ' = ' + value)
+
+            # Make lastrowid return the id of the updated record
+            set_list.append('id = LAST_INSERT_ID(id)')
+
+            return query + ' ON DUPLICATE KEY UPDATE ' + ', '.join(set_list)
+
+        query = cached_sql(('upsert', query, tuple(update)), build)
+
+        cursor = self.__execute(self.cursor_rw, query, data_dict)
+
+        return cursor.lastrowid
+
+
+    def __insert_query(self, table, record):
+        """ Build the INSERT query (and its data) for insert() and upsert().
+        """
+
+        columns = sorted(record)
+        values = tuple([ record[key][0] for key in columns ])
+
+        def build():
+            return 'INSERT INTO ' + table + ' (' + ', '.join(columns) + ')' \
+                   ' VALUES (' + ', '.join(values) + ')'
+
+        query = cached_sql(('insert', table, tuple(columns), values), build)
+
         data_dict = {}
-        query = 'INSERT INTO ' + table + ' ('
+        for key in columns:
+            data_dict[key] = record[key][1]
 
-        for key, value in record.items():
-            columns_list.append(key)
-            values_list.append(value[0])
-            data_dict[key] = value[1]
+        return query, data_dict
 
-        query += ', '.join(columns_list) + ')'
-        query += ' VALUES (' + ', '.join(values_list) + ')'
 
-        self.cursor_rw.execute(query, data_dict)
+    def insert_many(self, table, records, chunk=None, commit=False):
+        """ Insert several records (same format as in insert(), all with
+            the same columns) into `table`, `chunk` records (CHUNK_SIZE by
+            default) per statement. If `commit` is set, each chunk is
+            committed. Returns the IDs of the inserted records, in order.
+
+            The IDs are those of a multi-row INSERT, i.e., allocated at once
+            from the first one (as InnoDB does for inserts whose number of
+            rows is known), every auto_increment_increment.
+
+        >>> mydb = Db('test', 'password', dbname='test', dbhost='127.0.0.1')
+        >>> ids = mydb.insert_many('test', [ \
+                    { 'col1': [ '%(col1)s', 'a' ] }, \
+                    { 'col1': [ '%(col1)s', 'b' ] }, \
+                ])
+        >>> ids[1] - ids[0]
+        1
+        >>> mydb.close()
+        """
+
+        chunk = chunk or CHUNK_SIZE
+        ids = []
+
+        for i in range(0, len(records), chunk):
+            rows = records[i:i + chunk]
+            columns = sorted(rows[0])
+            values = tuple([ rows[0][key][0] for key in columns ])
+
+            def build():
+                # One group of values per row, with the parameters renamed
+                # after the row
+                groups = []
+                for n in range(len(rows)):
+                    groups.append('(' + ', '.join([ PLACEHOLDER.sub(
+                        '%(\\1_' + str(n) + ')s', v) for v in values ]) + ')')
+
+                return 'INSERT INTO ' + table + ' (' + ', '.join(columns) + \
+                       ') VALUES ' + ', '.join(groups)
+
+            query = cached_sql(('insert_many', table, tuple(columns), values,
+                                len(rows)), build)
+
+            data_dict = {}
+            for n, record in enumerate(rows):
+                for key in columns:
+                    data_dict[key + '_' + str(n)] = record[key][1]
+
+            cursor = self.__execute(self.cursor_rw, query, data_dict)
+
+            # The id of the first inserted record
+            first = cursor.lastrowid
+            step = self.auto_increment_increment()
+            ids.extend(range(first, first + len(rows) * step, step))
+
+            if commit:
+                self.commit()
+
+        return ids
+
+
+    def auto_increment_increment(self):
+        """ Return the step between the ids generated by the server, which
+            is greater than 1 with several primaries (e.g., Galera). Read
+            once per instance.
+        """
+
+        if self.increment is None:
+            rows = self.query('SELECT @@auto_increment_increment')
+            self.increment = int(rows[0][0]) if rows else 1
+
+        return self.increment
 
-        # Get the id of the last inserted recond and close the cursor
-        return self.cursor_rw.lastrowid
+
+    def update_many(self, table, records, key='id', chunk=None, commit=False):
+        """ Update several records at once: each record is a dictionary
+            column -> new value (all with the same columns), including the
+            `key` column identifying the record to update. The records are
+            updated `chunk` (CHUNK_SIZE by default) per statement. If
+            `commit` is set, each chunk is committed. Returns the number of
+            records updated.
+
+        >>> mydb = Db('test', 'password', dbname='test', dbhost='127.0.0.1')
+        >>> mydb.update_many('test', [ \
+                    { 'id': 1, 'col1': 'newvalue1' }, \
+                    { 'id': 2, 'col1': 'newvalue2' }, \
+                ])
+        2
+        >>> mydb.close()
+        """
+
+        chunk = chunk or CHUNK_SIZE
+        count = 0
+
+        for i in range(0, len(records), chunk):
+            rows = records[i:i + chunk]
+            columns = sorted([ c for c in rows[0] if c != key ])
+
+            def build():
+                # col = CASE key WHEN key_0 THEN col_0 ... ELSE col END
+                set_list = []
+                for column in columns:
+                    set_list.append(column + ' = CASE ' + key + ''.join([
+                        ' WHEN %%(%s_%d)s THEN %%(%s_%d)s' % (key, n, column, n)
+                        for n in range(len(rows)) ]) + ' ELSE ' + column + ' END')
+
+                keys = [ '%%(%s_%d)s' % (key, n) for n in range(len(rows)) ]
+
+                return "UPDATE " + table + " SET " + ', '.join(set_list) + \
+                       ' WHERE ' + key + ' IN (' + ', '.join(keys) + ')'
+
+            query = cached_sql(('update_many', table, tuple(columns), key,
+                                len(rows)), build)
+
+            data_dict = {}
+            for n, record in enumerate(rows):
+                for column in columns + [ key ]:
+                    data_dict[column + '_' + str(n)] = record[column]
+
+            cursor = self.__execute(self.cursor_rw, query, data_dict)
+            count += cursor.rowcount
+
+            if commit:
+                self.commit()
+
+        return count
 
 
     def update(self, table, record, where):
@@ -169,29 +666,85 @@ class Db():
         >>> mydb.close()
         """
 
-        set_list = []
-        where_list = []
-        data_dict = {}
-        query = "UPDATE " + table + " SET "
+        record = sorted(record.items())
+        keys = sorted(where)
+        placeholders = tuple([ where[key][0] for key in keys ])
+
+        def build():
+            set_list = []
+            where_list = []
+
+            for key, value in record:
+                set_list.append(key + ' = ' + value)
 
-        for key, value in record.items():
-            set_list.append(key + ' = ' + value)
+            for key, value in zip(keys, placeholders):
+                where_list.append(key + ' = ' + value)
 
-        for key, value in where.items():
-            where_list.append(key + ' = ' + value[0])
-            data_dict[key] = value[1]
+            return "UPDATE " + table + " SET " + ', '.join(set_list) + \
+                   ' WHERE ' + ', '.join(where_list)
 
-        query += ', '.join(set_list)
-        query += ' WHERE ' + ', '.join(where_list)
+        query = cached_sql(('update', table, tuple(record), tuple(keys),
+                            placeholders), build)
+
+        data_dict = {}
+        for key in keys:
+            data_dict[key] = where[key][1]
 
-        self.cursor_rw.execute(query, data_dict)
+        self.__execute(self.cursor_rw, query, data_dict)
 
         return True
 
 
-    def select(self, table, cols='*', where=None, order=None, desc=False):
+    def update_in(self, table, record, column, values):
+        """ Update all records whose `column` value is one of `values` (the
+            `record` format is the same as in update()). Returns the number
+            of records updated.
+
+        >>> mydb = Db('test', 'password', dbname='test', dbhost='127.0.0.1')
+        >>> mydb.update_in('test', { \
+                    'col1': '"newvalue1"', \
+                }, 'id', [ 1, 2 ])
+        2
+        >>> mydb.close()
+        """
+
+        record = sorted(record.items())
+
+        def build():
+            set_list = []
+            in_list = []
+
+            for key, value in record:
+                set_list.append(key + ' = ' + value)
+
+            for i in range(len(values)):
+                in_list.append('%(' + column + str(i) + ')s')
+
+            return "UPDATE " + table + " SET " + ', '.join(set_list) + \
+                   ' WHERE ' + column + ' IN (' + ', '.join(in_list) + ')'
+
+        query = cached_sql(('update_in', table, tuple(record), column,
+                            len(values)), build)
+
+        data_dict = {}
+        for i, value in enumerate(values):
+            data_dict[column + str(i)] = value
+
+        cursor = self.__execute(self.cursor_rw, query, data_dict)
+
+        return cursor.rowcount
+
+
+    def select(self, table, cols='*', where=None, order=None, desc=False,
+               limit=None):
         """ Set the cursor from the search of all records that match the
-            given `where` criteria.
+            given `where` criteria. If `limit` is given, at most `limit`
+            records are returned.
+
+            Each criterion is `key: [operator, placeholder, value]`, where
+            the key is both the column and the parameter name. An optional
+            4th element names the column (e.g., to filter a column twice).
+            A list of values matches the column against any of them (IN).
 
         >>> mydb = Db('test', 'password', dbname='test', dbhost='127.0.0.1')
         >>> mydb.select('test')
@@ -208,38 +761,123 @@ class Db():
         >>> row = mydb.fetch_next()
         >>> row[0]
         2
+
+        >>> mydb.select('test', [ 'id' ], order=[ 'id' ], limit=1)
+        True
+        >>> len(mydb.fetch_all())
+        1
         >>> mydb.close()
         """
 
-        query = "SELECT " + ', '.join(cols) + ' FROM ' + table
+        # The shape of the criteria: name, operator, placeholder, column
+        # and number of values (lists only)
+        keys = []
+        for key in sorted(where or {}):
+            value = where[key]
+            keys.append((key, value[0], value[1],
+                         value[3] if len(value) > 3 else key,
+                         len(value[2]) if isinstance(value[2],
+                                                     (list, tuple, set)) \
+                                       else None))
 
-        if order is None:
-            orderby = ''
-        else:
-            orderby = ' ORDER BY ' + ', '.join(order)
+        def build():
+            query = "SELECT " + ', '.join(cols) + ' FROM ' + table
 
-            if desc:
-                orderby += " DESC"
+            if order is None:
+                orderby = ''
+            else:
+                orderby = ' ORDER BY ' + ', '.join(order)
+
+                if desc:
+                    orderby += " DESC"
+
+            if limit is not None:
+                orderby += ' LIMIT %d' % limit
+
+            if where is None:
+                return query + ' ' + orderby
 
-        if where is None:
-            self.cursor_ro.execute(query + ' ' + orderby)
-        else:
             where_list = []
-            data_dict = {}
 
-            for key, value in where.items():
-                where_list.append(key + value[0] + value[1])
-                data_dict[key] = value[2]
+            for key, op, placeholder, column, count in keys:
+                # A list of values is matched with IN (one parameter each)
+                if count is not None:
+                    params = [ '%%(%s_%d)s' % (key, i) for i in range(count) ]
+                    where_list.append(column + ' IN (' + ', '.join(params) + ')'
+                                      if params else 'FALSE')
+                else:
+                    where_list.append(column + op + placeholder)
 
-            query += ' WHERE ' + ' and '.join(where_list) + orderby
-            self.cursor_ro.execute(query, data_dict)
+            return query + ' WHERE ' + ' and '.join(where_list) + orderby
+
+        query = cached_sql(('select', table, tuple(cols), tuple(keys),
+                            None if order is None else tuple(order), desc,
+                            limit, where is None), build)
+
+        data_dict = {}
+        for key, op, placeholder, column, count in keys:
+            if count is None:
+                data_dict[key] = where[key][2]
+            else:
+                for i, v in enumerate(where[key][2]):
+                    data_dict['%s_%d' % (key, i)] = v
+
+        cursor = self.__execute(self.cursor_ro, query,
+                                None if where is None else data_dict)
+
+        # Prepared statements don't buffer the rows (and the cursor is
+        # reused by the next execution of the same statement)
+        self.rows = deque(cursor.fetchall()) if cursor is not self.cursor_ro \
+                    else None
 
         return True
 
 
+    def __execute(self, cursor, sql, params=None):
+        """ Execute a statement on `cursor` or, in prepared mode, as a
+            prepared statement (prepared on the first execution and kept
+            open for the next ones). Returns the cursor used.
+        """
+
+        if not self.prepared:
+            cursor.execute(sql, params)
+            return cursor
+
+        sql, params = prepare(sql, params)
+
+        statement = self.statements.pop(sql, None)
+        if statement is None:
+            statement = self.conn.cursor(prepared=True)
+
+            # Close the least recently used one
+            if len(self.statements) >= PREPARED_CACHE_SIZE:
+                self.statements.popitem(last=False)[1].close()
+
+        # Most recently used go last
+        self.statements[sql] = statement
+
+        statement.execute(sql, params)
+
+        return statement
+
+
+    def __close_statements(self):
+        """ Close all prepared statements. """
+
+        for statement in self.statements.values():
+            try:
+                statement.close()
+            except Exception:   # catch *all* exceptions
+                pass            # the connection might be gone already
+
+        self.statements.clear()
+
+
     def execute_sql(self, sql):
         """ Execute an SQL read query. """
 
+        self.rows = None
+
         try:
             self.cursor_ro.execute(sql)
         except Exception as e:  # catch *all* exceptions
@@ -247,6 +885,40 @@ class Db():
             raise e
 
 
+    def execute(self, sql, params=None):
+        """ Execute an SQL write statement. Returns the number of records
+            affected.
+
+        >>> mydb = Db('test', 'password', dbname='test', dbhost='127.0.0.1')
+        >>> mydb.execute('UPDATE test SET col1 = %(col1)s WHERE id = 1', \
+                    { 'col1': 'newvalue1' })
+        1
+        >>> mydb.close()
+        """
+
+        cursor = self.__execute(self.cursor_rw, sql, params)
+
+        return cursor.rowcount
+
+
+    def query(self, sql, params=None):
+        """ Execute an SQL read query on a private cursor and return all the
+            rows found. Unlike select(), it doesn't change the result set
+            read by fetch_next() and fetch_all().
+        """
+
+        if self.prepared:
+            return self.__execute(None, sql, params).fetchall()
+
+        cursor = self.conn.cursor(buffered=True)
+
+        try:
+            cursor.execute(sql, params)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+
     def fetch_next(self):
         """ Get the next row of a query result set, returning a single
             sequence, or None when no more rows are available. The returned
@@ -254,6 +926,9 @@ class Db():
             Python objects.
         """
 
+        if self.rows is not None:
+            return self.rows.popleft() if self.rows else None
+
         return self.cursor_ro.fetchone()
 
 
@@ -262,6 +937,11 @@ class Db():
             available.
         """
 
+        if self.rows is not None:
+            rows = list(self.rows)
+            self.rows.clear()
+            return rows
+
         return self.cursor_ro.fetchall()
 
 
@@ -16,6 +16,9 @@ CREATE TABLE queue (
        id INTEGER NOT NULL AUTO_INCREMENT,
        ts TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
        source VARCHAR(255) NOT NULL,
+       eventid INTEGER NOT NULL DEFAULT 0,
+       lasteventid INTEGER NOT NULL DEFAULT 0,
+       dedupkey BINARY(20) DEFAULT NULL,
        type VARCHAR(255) NOT NULL,
        state VARCHAR(255) DEFAULT NULL,
        statetype VARCHAR(255) DEFAULT NULL,
@@ -38,6 +41,8 @@ CREATE INDEX handled_idx ON queue(handled);
 CREATE INDEX ipv4_idx ON queue(ipv4);
 CREATE INDEX ipv6_idx ON queue(ipv6);
 CREATE INDEX hostname_idx ON queue(hostname);
+CREATE INDEX eventid_idx ON queue(source, eventid);
+CREATE UNIQUE INDEX dedupkey_idx ON queue(dedupkey);
 
 CREATE USER 'qapi'@'localhost' IDENTIFIED BY 'password';
 GRANT ALL PRIVILEGES
@@ -47,13 +52,23 @@ GRANT ALL PRIVILEGES
 FLUSH PRIVILEGES;
 
 
+The events can also be stored in an embedded SQLite database instead (see
+BACKEND and SQLITE_SCHEMA), no server needed.
+
 To test the module use:
 $ python dbevent.py
 """
 
+import os
+import re
 import sys
+import hashlib
+import threading
+from collections import deque, OrderedDict
+from datetime import datetime
 sys.path.append('..')
 from db.db import Db
+from sqlitedb.sqlitedb import SqliteDb
 
 __author__ = "Jorge Morgado"
 __copyright__ = "Copyright (c)2014, Jorge Morgado"
@@ -64,16 +79,486 @@ __maintainer__ = "Jorge Morgado"
 __email__ = "jorge (at) morgado (dot) ch"
 __status__ = "Production"
 
+# TODO Set this from a configuration file
+# Where the events are stored: 'mysql', 'sqlite' (the SQLITE_PATH file,
+# e.g., to run a single node without a MySQL server) or 'log' (the LOG_PATH
+# directory, see eventlog.py). The EQ_BACKEND, EQ_SQLITE_PATH and
+# EQ_LOG_PATH environment variables override them (e.g., for the tests).
+BACKEND = os.environ.get('EQ_BACKEND', 'mysql')
+SQLITE_PATH = os.environ.get('EQ_SQLITE_PATH',
+    os.path.dirname(os.path.realpath(__file__)) + '/../../var/event.db')
+LOG_PATH = os.environ.get('EQ_LOG_PATH',
+    os.path.dirname(os.path.realpath(__file__)) + '/../../var/eventlog')
+
+# TODO Set this from a configuration file
+# How many database connections to keep open (per process). Connections are
+# shared by all DbEvent instances, one per thread.
+POOL_SIZE = 5
+
+# Columns identifying a duplicate event (see DbEvent.new_event)
+DEDUP_COLS = [
+    'source',
+    'eventid',
+    'lasteventid',
+    'type',
+    'state',
+    'hostname',
+    'servicename',
+]
+
+# TODO Set this from a configuration file
+# Ingest events with a single INSERT ... ON DUPLICATE KEY UPDATE statement,
+# based on the unique `dedupkey` column, instead of searching for duplicates
+# first. Requires the 001-dedupkey.sql migration.
+UPSERT = False
+
+# TODO Set this from a configuration file
+# Scan the unhandled events from the `pending` table (the ids of the
+# unhandled events only, kept up to date by triggers) instead of the whole
+# queue. Requires the 005-pending.sql migration.
+PENDING_TABLE = False
+
+# The tables scanned for unhandled events (see PENDING_TABLE)
+QUEUE = 'queue'
+PENDING = 'pending JOIN queue USING (id)'
+
+# How many (source, eventid) pairs to look up per query (see find_eventids)
+EVENTID_CHUNK = 500
+
+# TODO Set this from a configuration file
+# How many events found by source and event id to keep in memory (per
+# process, see EventCache)
+CACHE_SIZE = 10000
+
+# The event queue tables in SQLite, created when the database is opened.
+# Same columns as in MySQL, but only the indexes used by DbEvent, so that
+# appends stay cheap: (handled, id) serves the scans of unhandled events
+# (no `pending` table needed, see PENDING_TABLE). The DEDUP_COLS ignore case,
+# as with MySQL's default collation (see dedup_value).
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS queue (
+       id INTEGER PRIMARY KEY AUTOINCREMENT,
+       ts TIMESTAMP NOT NULL DEFAULT (datetime('now', 'localtime')),
+       source VARCHAR(255) NOT NULL COLLATE NOCASE,
+       eventid INTEGER NOT NULL DEFAULT 0,
+       lasteventid INTEGER NOT NULL DEFAULT 0,
+       dedupkey BLOB DEFAULT NULL,
+       type VARCHAR(255) NOT NULL COLLATE NOCASE,
+       state VARCHAR(255) DEFAULT NULL COLLATE NOCASE,
+       statetype VARCHAR(255) DEFAULT NULL,
+       laststate VARCHAR(255) DEFAULT NULL,
+       count INTEGER DEFAULT 1,
+       handled BOOLEAN NOT NULL DEFAULT 0,
+       ipv4 INTEGER DEFAULT NULL,
+       ipv6 BLOB DEFAULT NULL,
+       hostname VARCHAR(255) DEFAULT NULL COLLATE NOCASE,
+       servicename VARCHAR(255) DEFAULT NULL COLLATE NOCASE,
+       date VARCHAR(30) NOT NULL,
+       time VARCHAR(30) NOT NULL,
+       message TEXT);
+
+CREATE UNIQUE INDEX IF NOT EXISTS dedupkey_idx ON queue (dedupkey);
+CREATE INDEX IF NOT EXISTS handled_idx ON queue (handled, id);
+CREATE INDEX IF NOT EXISTS eventid_idx ON queue (source, eventid);
+
+CREATE TABLE IF NOT EXISTS watermark (
+       name VARCHAR(255) NOT NULL PRIMARY KEY,
+       lastid INTEGER NOT NULL DEFAULT 0,
+       ts TIMESTAMP NOT NULL DEFAULT (datetime('now', 'localtime')));
+
+CREATE TABLE IF NOT EXISTS outbox (
+       id INTEGER PRIMARY KEY AUTOINCREMENT,
+       ts TIMESTAMP NOT NULL DEFAULT (datetime('now', 'localtime')),
+       dedupkey BLOB NOT NULL,
+       channel VARCHAR(10) NOT NULL,
+       proto INTEGER DEFAULT NULL,
+       rcpt VARCHAR(1024) NOT NULL,
+       subject VARCHAR(255) DEFAULT NULL,
+       body TEXT NOT NULL,
+       state VARCHAR(10) NOT NULL DEFAULT 'pending',
+       attempts INTEGER NOT NULL DEFAULT 0,
+       nextts TIMESTAMP NOT NULL,
+       claimedby VARCHAR(255) DEFAULT NULL,
+       error VARCHAR(255) DEFAULT NULL);
+
+CREATE UNIQUE INDEX IF NOT EXISTS outbox_dedupkey_idx ON outbox (dedupkey);
+CREATE INDEX IF NOT EXISTS state_nextts_idx ON outbox (state, nextts);
+"""
+
+# Position of some columns in the rows (see DbEvent cols)
+C_ID      = 0
+C_SOURCE  = 2
+C_EVENTID = 3
+C_HANDLED = 10
+
+
+def dedup_value(value):
+    """ Return a DEDUP_COLS value as the database compares it: the columns'
+        (default) collation ignores case and trailing spaces, so text is
+        lowercased and stripped of them (and decoded from UTF-8).
+
+    >>> dedup_value('Office-GW  ') == dedup_value(u'office-gw')
+    True
+    >>> dedup_value(1), dedup_value(None)
+    (1, None)
+    """
+
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+
+    if isinstance(value, type(u'')):
+        return value.lower().rstrip(u' ')
+
+    return value
+
+
+def dedup_key(source, eventid, lasteventid, etype, state, hostname, servicename):
+    """ Return the (binary) key identifying duplicate events, i.e., the SHA1
+        digest of the DEDUP_COLS values (see dedup_value), separated by 0x1F
+        and with NULL values as 0x00, all encoded in UTF-8. This must match
+        the key computed by the migration (001-dedupkey.sql):
+
+        UNHEX(SHA1(CONCAT_WS(CHAR(31 USING utf8mb4),
+            LOWER(TRIM(TRAILING ' ' FROM CONVERT(source USING utf8mb4))),
+            eventid, lasteventid, ...)))
+
+    >>> len(dedup_key('nagios1', 1, 0, 'RECOVERY', 'OK', 'office-gw', None))
+    20
+    >>> dedup_key('nagios1', '1', 0, 'RECOVERY', 'OK', 'gw', None) == \
+        dedup_key(u'nagios1', 1, '0', u'Recovery', u'OK ', u'GW', None)
+    True
+    """
+
+    values = []
+    for value in (source, int(eventid), int(lasteventid), etype, state,
+                  hostname, servicename):
+        if value is None:
+            value = u'\x00'
+        else:
+            value = u'%s' % dedup_value(value)
+        values.append(value)
+
+    return hashlib.sha1(u'\x1f'.join(values).encode('utf-8')).digest()
+
+
+# Columns the scans can be filtered on (see find_all_unhandled)
+FILTER_COLUMNS = [
+    'id',
+    'ts',
+    'source',
+    'eventid',
+    'lasteventid',
+    'type',
+    'state',
+    'statetype',
+    'laststate',
+    'count',
+    'hostname',
+    'servicename',
+    'date',
+    'time',
+]
+
+# Filter operators (the suffix of the filter name, e.g. `ts__gte`)
+FILTER_OPS = {
+    ''          : ' = ',
+    'startswith': ' LIKE ',
+    'like'      : ' LIKE ',
+    'gt'        : ' > ',
+    'gte'       : ' >= ',
+    'lt'        : ' < ',
+    'lte'       : ' <= ',
+}
+
+
+def parse_filter(name):
+    """ Split a filter name into its column and operator.
+
+    >>> parse_filter('hostname')
+    ('hostname', '')
+    >>> parse_filter('servicename__startswith')
+    ('servicename', 'startswith')
+    >>> parse_filter('message')
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown filter: message
+    >>> parse_filter('ts__since')
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown filter: ts__since
+    """
+
+    column, _, op = name.partition('__')
+
+    if column not in FILTER_COLUMNS or op not in FILTER_OPS:
+        raise ValueError("Unknown filter: %s" % name)
+
+    return column, op
+
+
+def filter_where(filters):
+    """ Translate the `filters` (e.g. {'hostname': 'gw',
+        'servicename__startswith': 'HTTP'}) into select criteria (see
+        Db.select). A list of values matches any of them.
+
+    >>> filter_where({'servicename__startswith': 'disk_%'})
+    {'f_servicename__startswith': [' LIKE ', '%(f_servicename__startswith)s', 'disk\\\\_\\\\%%', 'servicename']}
+    >>> filter_where({'ts__lt': ['a', 'b']})
+    Traceback (most recent call last):
+    ...
+    ValueError: Only equality filters take a list: ts__lt
+    """
+
+    where = {}
+
+    for name, value in filters.items():
+        column, op = parse_filter(name)
+
+        if isinstance(value, (list, tuple, set)) and op != '':
+            raise ValueError("Only equality filters take a list: %s" % name)
+
+        if op == 'startswith':
+            value = value.replace('\\', '\\\\').replace('%', '\\%') \
+                         .replace('_', '\\_') + '%'
+
+        # Prefixed, not to clash with the criteria set by the scans
+        key = 'f_' + name
+        where[key] = [ FILTER_OPS[op], '%(' + key + ')s', value, column ]
+
+    return where
+
+
+def match_filters(event, filters):
+    """ Return True if the event matches all `filters` (evaluated as the
+        database does, see filter_where), for the scans not done by the
+        database.
+    """
+
+    for name, value in filters.items():
+        column, op = parse_filter(name)
+        v = getattr(event, column)()
+
+        if column == 'ts' and not isinstance(value, datetime):
+            value = datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+        # String comparisons are case-insensitive (as in MySQL)
+        if hasattr(v, 'lower'):
+            v = v.lower()
+            if isinstance(value, (list, tuple, set)):
+                value = [ x.lower() if hasattr(x, 'lower') else x
+                          for x in value ]
+            elif hasattr(value, 'lower'):
+                value = value.lower()
+
+        if op == '':
+            ok = v in value if isinstance(value, (list, tuple, set)) \
+                else v == value
+        elif op == 'startswith':
+            ok = ('%s' % v).startswith(value)
+        elif op == 'like':
+            ok = re.match(like_regex(value), '%s' % v, re.S) is not None
+        elif op == 'gt':
+            ok = v > value
+        elif op == 'gte':
+            ok = v >= value
+        elif op == 'lt':
+            ok = v < value
+        else:
+            ok = v <= value
+
+        if not ok:
+            return False
+
+    return True
+
+
+def like_regex(pattern):
+    """ Translate an SQL LIKE pattern into a regular expression.
+
+    >>> re.match(like_regex('disk\\\\_%'), 'disk_usage') is not None
+    True
+    >>> re.match(like_regex('disk\\\\_%'), 'diskusage') is None
+    True
+    """
+
+    regex = []
+    escaped = False
+
+    for c in pattern:
+        if escaped:
+            regex.append(re.escape(c))
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif c == '%':
+            regex.append('.*')
+        elif c == '_':
+            regex.append('.')
+        else:
+            regex.append(re.escape(c))
+
+    return ''.join(regex) + '$'
+
+
+class EventCache:
+    'A LRU cache of the events found by source and event id.'
+
+    def __init__(self, size):
+        """ Keep up to `size` events (rows), the least recently used ones
+            are dropped first.
+        """
+
+        self.size = size
+        self.rows = OrderedDict()   # (source, eventid) -> row
+        self.ids = {}               # event id -> (source, eventid)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+
+    def __contains__(self, pair):
+        with self.lock:
+            return pair in self.rows
+
+
+    def get(self, pair):
+        """ Return the row of the given (source, eventid) pair or None if
+            it is not cached.
+
+        >>> cache = EventCache(2)
+        >>> cache.put(('nagios1', 1), (7, None, 'nagios1', 1))
+        >>> cache.get(('nagios1', 1))
+        (7, None, 'nagios1', 1)
+        >>> cache.get(('nagios1', 2)) is None
+        True
+        >>> cache.hits, cache.misses
+        (1, 1)
+        """
+
+        with self.lock:
+            row = self.rows.pop(pair, None)
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            # Most recently used go last
+            self.rows[pair] = row
+            self.hits += 1
+
+            return row
+
+
+    def put(self, pair, row):
+        """ Cache the row of the given (source, eventid) pair.
+
+        >>> cache = EventCache(2)
+        >>> for i in (1, 2, 3): cache.put(('nagios1', i), (i, None, 'nagios1', i))
+        >>> list(cache.rows)
+        [('nagios1', 2), ('nagios1', 3)]
+        """
+
+        with self.lock:
+            self.__discard(pair)
+            self.rows[pair] = row
+            self.ids[row[C_ID]] = pair
+
+            while len(self.rows) > self.size:
+                self.ids.pop(self.rows.popitem(last=False)[1][C_ID], None)
+
+
+    def discard(self, pair):
+        """ Forget the row of the given (source, eventid) pair (e.g., a
+            newer event with the same event id was inserted).
+        """
+
+        with self.lock:
+            self.__discard(pair)
+
+
+    def __discard(self, pair):
+        row = self.rows.pop(pair, None)
+        if row is not None:
+            self.ids.pop(row[C_ID], None)
+
+
+    def set_handled(self, ids, handled):
+        """ Update the handled value of the cached events among `ids`.
+
+        >>> cache = EventCache(2)
+        >>> cache.put(('nagios1', 1), (7, None, 'nagios1', 1, 0, '', '', '', '', 1, 0))
+        >>> cache.set_handled([ 6, 7 ], 2)
+        >>> cache.get(('nagios1', 1))[C_HANDLED]
+        2
+        """
+
+        with self.lock:
+            for _id in ids:
+                pair = self.ids.get(_id)
+                if pair is not None:
+                    row = self.rows[pair]
+                    self.rows[pair] = row[:C_HANDLED] + (handled,) \
+                                      + row[C_HANDLED + 1:]
+
+
+    def clear(self):
+        """ Forget all cached rows. """
+
+        with self.lock:
+            self.rows.clear()
+            self.ids.clear()
+
+
+    def stats(self):
+        """ Return the hits, misses and size of the cache. """
+
+        with self.lock:
+            return { 'hits'  : self.hits,
+                     'misses': self.misses,
+                     'size'  : len(self.rows) }
+
+
+# The events found by source and event id, shared by all DbEvent instances
+cache = EventCache(CACHE_SIZE)
+
+
 class DbEvent():
-    def __init__(self):
-        """ Connect to the event queue database.
+    def __init__(self, upsert=None, chunk=None, pending=None, backend=None):
+        """ Connect to the event queue database. If `upsert` is not given,
+            the module's UPSERT setting is used. The same goes for `pending`
+            and PENDING_TABLE, and `backend` and BACKEND.
+
+            If `chunk` is given, the find_* methods stream the events in
+            pages of `chunk` rows (by increasing id) instead of fetching
+            the whole result at once (see stream()).
 
         >>> mydbevent = DbEvent()
         """
 
-        # TODO Get user/password/host/dbname from configuration file
-        # TODO instead of having them hardcoded here.
-        self.db = Db('qapi', 'password', 'event')
+        self.backend = BACKEND if backend is None else backend
+        self.upsert = UPSERT if upsert is None else upsert
+        self.pending = PENDING_TABLE if pending is None else pending
+
+        # Streaming mode: rows per page, the criteria of the current scan,
+        # the rows of the current page and the last id read so far
+        self.chunk = chunk
+        self.page_where = None
+        self.page = deque()
+        self.page_last = 0
+        self.page_cols = None
+        self.page_table = QUEUE
+        self.page_done = True
+
+        if self.backend == 'sqlite':
+            # The statements are the same (see SqliteDb), only the unhandled
+            # events are found by index
+            self.db = SqliteDb(SQLITE_PATH, SQLITE_SCHEMA,
+                               pool_size=POOL_SIZE)
+            self.pending = False
+        else:
+            # TODO Get user/password/host/dbname from configuration file
+            # TODO instead of having them hardcoded here.
+            self.db = Db('qapi', 'password', 'event', pool_size=POOL_SIZE)
 
         # Database columns (used for select clauses below)
         # Ordering has to match with indexes F_* in event.py
@@ -108,12 +593,114 @@ class DbEvent():
         del self.db
 
 
+    def close(self):
+        """ Commit all changes and give the connection back to the pool.
+        """
+
+        self.db.close()
+
+
+    def ping(self):
+        """ Check (and restore) the database connection. """
+
+        self.db.ping()
+
+
+    def commit(self):
+        """ Commit all changes done so far on this connection.
+        """
+
+        self.db.commit()
+
+
+    def transaction(self):
+        """ Return a context manager running a block of statements in a
+            single transaction (see Db.transaction).
+        """
+
+        return self.db.transaction()
+
+
+    def rollback(self):
+        """ Discard all changes done since the last commit.
+        """
+
+        self.db.rollback()
+
+        # The cached events might have been changed
+        cache.clear()
+
+
+    def stream(self, chunk):
+        """ Switch the scans to streaming mode: fetch at most `chunk` rows at
+            a time, paging through the queue by id. Memory usage is bounded
+            by `chunk` and, as each page is read at once, other statements
+            (e.g., set_handled) can run while the scan is ongoing. Use None
+            to fetch the whole result at once again.
+        """
+
+        self.chunk = chunk
+
+
     def find_next(self):
         """ Get the next record from the cursor position. If no more records
             are available, return None.
         """
 
-        return self.db.fetch_next()
+        if self.page_where is None:
+            return self.db.fetch_next()
+
+        if not self.page and not self.page_done:
+            self.__next_page()
+
+        return self.page.popleft() if self.page else None
+
+
+    def buffered(self):
+        """ Return the rows of the current scan fetched already but not read
+            yet (streaming mode only, otherwise none).
+        """
+
+        return list(self.page) if self.page_where is not None else []
+
+
+    def __find(self, where, cols=None, table=QUEUE):
+        """ Set the cursor to all events of `table` matching `where` (ordered
+            by id) and return the first one (or None).
+        """
+
+        cols = self.cols if cols is None else cols
+
+        if not self.chunk:
+            self.page_where = None
+            self.db.select(table, cols, where, [ 'id' ])
+            return self.db.fetch_next()
+
+        self.page_where = where
+        self.page_cols = cols
+        self.page_table = table
+        self.page = deque()
+        self.page_last = where['id'][2] if 'id' in where else 0
+        self.page_done = False
+
+        return self.find_next()
+
+
+    def __next_page(self):
+        """ Fetch the next page of the current scan (keyset pagination). """
+
+        where = dict(self.page_where)
+        where['id'] = [ '>', '%(id)s', self.page_last ]
+
+        self.db.select(self.page_table, self.page_cols, where, [ 'id' ],
+                       limit=self.chunk)
+        rows = self.db.fetch_all() or []
+
+        if rows:
+            self.page_last = rows[-1][0]
+            self.page.extend(rows)
+
+        self.page_done = len(rows) < self.chunk
 
 
     def __find_if_existing(self, source, etype, state, statetype, ipv4, ipv6, hostname, servicename):
@@ -186,6 +773,37 @@ class DbEvent():
         return row[0] if row is not None else None
 
 
+    def __find_duplicates(self, keys):
+        """ Search the queue for several events at once (see __find_duplicate).
+            Each key is a (source, eventid, lasteventid, type, state, hostname,
+            servicename) tuple of dedup_value() values. Returns a dictionary
+            with the id of the keys found. The keys are searched
+            EVENTID_CHUNK per query.
+        """
+
+        row = '(' + ', '.join(['%s'] * len(DEDUP_COLS)) + ')'
+        found = {}
+
+        for i in range(0, len(keys), EVENTID_CHUNK):
+            chunk = keys[i:i + EVENTID_CHUNK]
+            params = []
+            for key in chunk:
+                params.extend(key)
+
+            rows = self.db.query(
+                'SELECT MIN(id), ' + ', '.join(DEDUP_COLS) + ' FROM queue' +
+                ' WHERE (' + ', '.join(DEDUP_COLS) + ') IN (' +
+                ', '.join([row] * len(chunk)) + ')' +
+                ' GROUP BY ' + ', '.join(DEDUP_COLS), params)
+
+            # The rows hold the values as stored (e.g., in another case)
+            for r in rows:
+                key = tuple(dedup_value(v) for v in r[1:])
+                found[key] = min(found.get(key, r[0]), r[0])
+
+        return found
+
+
     def increase_count(self, _id):
         """ Increment the event count for the sepecified `id`.
 
@@ -203,32 +821,70 @@ class DbEvent():
         """ Set the event handled value to Yes/No (True/False).
         """
 
+        cache.set_handled([ _id ], int(handled))
+
         return self.db.update('queue',
             { 'handled': str(handled) },
             { 'id': [ '%(id)s', _id ] })
 
 
+    def set_handled_many(self, ids, handled):
+        """ Set the same handled value on several events at once.
+        """
+
+        cache.set_handled(ids, int(handled))
+
+        return self.db.update_in('queue',
+            { 'handled': str(int(handled)) }, 'id', ids)
+
+
+    def update_many(self, records, commit=False):
+        """ Update several events at once (see Db.update_many), e.g.,
+            [ { 'id': 1, 'date': '2014-06-10' }, ... ]. If `commit` is set,
+            the records are committed by chunks. Returns the number of
+            events updated.
+        """
+
+        if records and 'handled' in records[0]:
+            for record in records:
+                cache.set_handled([ record['id'] ], int(record['handled']))
+
+        return self.db.update_many('queue', records, 'id', commit=commit)
+
+
     def new_heartbeat_event(self, source, etype, state, date, time):
         """ Insert a new heartbeat event in the `queue` table. If the event
             already exists, i.e., is *not* new, it will just increment the
             event count.
         """
 
+        record = {
+            'source' : [ '%(source)s',  source ],
+            'type'   : [ '%(type)s',    etype  ],
+            'state'  : [ '%(state)s',   state  ],
+            'handled': [ '%(handled)s', 1      ],
+            'date'   : [ '%(date)s',    date   ],
+            'time'   : [ '%(time)s',    time   ],
+        }
+
+        if self.upsert:
+            record['dedupkey'] = [ '%(dedupkey)s',
+                dedup_key(source, 0, 0, etype, state, None, None) ]
+
+            return self.db.upsert('queue', record,
+                { # Update fields (if duplicate)
+                  'ts':    'CURRENT_TIMESTAMP',
+                  'count': 'count + 1',
+                })
+
         # See if the event already exists (must have the same source,
         # event id, type and state)
         _id = self.__find_duplicate_without_names(source, 0, 0, etype, state)
 
         if _id is None:
-            return self.db.insert('queue', {
-                  'source' : [ '%(source)s',  source ],
-                  'type'   : [ '%(type)s',    etype  ],
-                  'state'  : [ '%(state)s',   state  ],
-                  'handled': [ '%(handled)s', 1      ],
-                  'date'   : [ '%(date)s',    date   ],
-                  'time'   : [ '%(time)s',    time   ],
-                })
+            return self.db.insert('queue', record)
         else:
-            return self.db.update('queue',
+            self.db.update('queue',
                 { # Update fileds
                   'ts':    'CURRENT_TIMESTAMP',
                   'count': 'count + 1',
@@ -237,6 +893,8 @@ class DbEvent():
                   'id': [ '%(id)s', _id ]
                 })
 
+            return _id
+
 
     def new_event(self, source, eventid, lasteventid, etype, state, \
         statetype, laststate, ipv4, ipv6, hostname, servicename, date, time, message):
@@ -254,33 +912,150 @@ class DbEvent():
         True
         """
 
+        if self.upsert:
+            return self.__upsert_event(source, eventid, lasteventid, etype,
+                state, statetype, laststate, ipv4, ipv6, hostname, servicename,
+                date, time, message)
+
         # See if the event already exists (must have the same source,
         # event id, type and state)
         _id = self.__find_duplicate(source, eventid, lasteventid, etype, state, hostname, servicename)
 
         if _id is None:
-            _id = self.db.insert('queue', {
-                      'source'     : [ '%(source)s',          source      ],
-                      'eventid'    : [ '%(eventid)s',         eventid     ],
-                      'lasteventid': [ '%(lasteventid)s',     lasteventid ],
-                      'type'       : [ '%(type)s',            etype       ],
-                      'state'      : [ '%(state)s',           state       ],
-                      'statetype'  : [ '%(statetype)s',       statetype   ],
-                      'laststate'  : [ '%(laststate)s',       laststate   ],
-                      'ipv4'       : [ 'INET_ATON(%(ipv4)s)', ipv4        ],
-                      'ipv6'       : [ '%(ipv6)s',            ipv6        ],
-                      'hostname'   : [ '%(hostname)s',        hostname    ],
-                      'servicename': [ '%(servicename)s',     servicename ],
-                      'date'       : [ '%(date)s',            date        ],
-                      'time'       : [ '%(time)s',            time        ],
-                      'message'    : [ '%(message)s',         message     ],
-                      })
+            _id = self.__insert_event(source, eventid, lasteventid, etype,
+                state, statetype, laststate, ipv4, ipv6, hostname, servicename,
+                date, time, message)
         else:
             self.increase_count(_id)
 
         return _id
 
 
+    def new_events(self, events):
+        """ Insert several events at once (see new_event). Each event is a
+            dictionary with the new_event() arguments as keys (using 'type'
+            for `etype`). All duplicates are searched with a single query.
+            Returns the list of ids, in the same order as `events`.
+
+            The new events are written with multi-row inserts (see
+            Db.insert_many), the duplicates of an event of the same batch
+            only increase its count.
+
+            Nothing is committed here, so that the caller can write the
+            whole batch in a single transaction.
+        """
+
+        if self.upsert:
+            return [ self.__upsert_event(e['source'],
+                         e['eventid'], e['lasteventid'], e['type'],
+                         e['state'], e['statetype'], e['laststate'],
+                         e['ipv4'], e['ipv6'], e['hostname'], e['servicename'],
+                         e['date'], e['time'], e['message'])
+                     for e in events ]
+
+        # Duplicates are matched as the database does (see dedup_value)
+        keys = [ tuple(dedup_value(v) for v in (e['source'],
+                     int(e['eventid']), int(e['lasteventid']), e['type'],
+                     e['state'], e['hostname'], e['servicename']))
+                 for e in events ]
+
+        found = self.__find_duplicates([k for k in set(keys) if None not in k])
+        counts = {}
+        records = []    # the new events
+        new = {}        # key -> position of the new event in records
+        refs = []       # per event: the existing id or the new event position
+
+        for e, key in zip(events, keys):
+            _id = found.get(key)
+
+            if _id is not None:
+                counts[_id] = counts.get(_id, 0) + 1
+                refs.append((_id, None))
+            elif key in new:
+                records[new[key]]['count'][1] += 1
+                refs.append((None, new[key]))
+            else:
+                record = self.__event_record(e['source'],
+                    e['eventid'], e['lasteventid'], e['type'],
+                    e['state'], e['statetype'], e['laststate'],
+                    e['ipv4'], e['ipv6'], e['hostname'], e['servicename'],
+                    e['date'], e['time'], e['message'])
+                record['count'] = [ '%(count)s', 1 ]
+
+                # NULL values never match a duplicate (as in new_event)
+                if None not in key:
+                    new[key] = len(records)
+
+                refs.append((None, len(records)))
+                records.append(record)
+
+                # It is the last event of its event id now
+                cache.discard((e['source'], int(e['eventid'])))
+
+        new_ids = self.db.insert_many('queue', records) if records else []
+        ids = [ new_ids[i] if _id is None else _id for _id, i in refs ]
+
+        for _id, count in counts.items():
+            self.db.update('queue',
+                { 'count': 'count + %d' % count, },
+                { 'id': [ '%(id)s', _id ] })
+
+        return ids
+
+
+    def __insert_event(self, source, eventid, lasteventid, etype, state, \
+        statetype, laststate, ipv4, ipv6, hostname, servicename, date, time, message):
+        """ Insert a new event in the `queue` table and return its id.
+        """
+
+        # It is the last event of its event id now
+        cache.discard((source, int(eventid)))
+
+        return self.db.insert('queue', self.__event_record(source, eventid,
+            lasteventid, etype, state, statetype, laststate, ipv4, ipv6,
+            hostname, servicename, date, time, message))
+
+
+    def __upsert_event(self, source, eventid, lasteventid, etype, state, \
+        statetype, laststate, ipv4, ipv6, hostname, servicename, date, time, message):
+        """ Insert a new event in the `queue` table or, if the event already
+            exists, increment its count. Returns the event id in both cases.
+        """
+
+        record = self.__event_record(source, eventid, lasteventid, etype,
+            state, statetype, laststate, ipv4, ipv6, hostname, servicename,
+            date, time, message)
+        record['dedupkey'] = [ '%(dedupkey)s', dedup_key(source, eventid,
+            lasteventid, etype, state, hostname, servicename) ]
+
+        cache.discard((source, int(eventid)))
+
+        return self.db.upsert('queue', record, { 'count': 'count + 1', })
+
+
+    def __event_record(self, source, eventid, lasteventid, etype, state, \
+        statetype, laststate, ipv4, ipv6, hostname, servicename, date, time, message):
+        """ Return the `queue` record of a new event (see Db.insert).
+        """
+
+        return {
+            'source'     : [ '%(source)s',          source      ],
+            'eventid'    : [ '%(eventid)s',         eventid     ],
+            'lasteventid': [ '%(lasteventid)s',     lasteventid ],
+            'type'       : [ '%(type)s',            etype       ],
+            'state'      : [ '%(state)s',           state       ],
+            'statetype'  : [ '%(statetype)s',       statetype   ],
+            'laststate'  : [ '%(laststate)s',       laststate   ],
+            'ipv4'       : [ 'INET_ATON(%(ipv4)s)', ipv4        ],
+            'ipv6'       : [ '%(ipv6)s',            ipv6        ],
+            'hostname'   : [ '%(hostname)s',        hostname    ],
+            'servicename': [ '%(servicename)s',     servicename ],
+            'date'       : [ '%(date)s',            date        ],
+            'time'       : [ '%(time)s',            time        ],
+            'message'    : [ '%(message)s',         message     ],
+        }
+
+
     def find_all(self, ts_max):
         """ Get a cursor for all events.
             If no records are found, returns returns None.
@@ -291,13 +1066,10 @@ class DbEvent():
             row = mydbevent.find_next()
         """
 
-        self.db.select('queue', self.cols,
+        return self.__find(
             { # Select criteria
               'ts': [ '<', '%(ts)s', ts_max ],
-            },
-            [ 'id' ])    # Ordered by...
-
-        return self.db.fetch_next()
+            })
 
 
     def find_heartbeat(self, ts_max):
@@ -305,49 +1077,200 @@ class DbEvent():
             If no records are found, returns returns None.
         """
 
-        self.db.select('queue', self.cols,
+        return self.__find(
             { # Select criteria
               'ts'  : [ '<',  '%(ts)s',   ts_max      ],
               'type': [ '=', '%(type)s', 'HEARTBEAT' ],
-            },
-            [ 'id' ])   # Ordered by...
-
-        return self.db.fetch_next()
+            })
 
 
-    def find_all_unhandled(self, ts_max):
-        """ Get a cursor for all unhandled events.
+    def find_all_unhandled(self, ts_max, since=None, filters=None,
+                           defer=False):
+        """ Get a cursor for all unhandled events (only the ones whose id is
+            greater than `since`, if given).
             If no records are found, returns returns None.
 
+            Only the events matching `filters` are fetched (see
+            filter_where). If `defer` is set, the message column is not
+            read (it is NULL in the rows, see find_message).
+
+            In pending mode (see PENDING_TABLE), the events are looked up
+            by the ids in the `pending` table, so the cost of the scan
+            depends on the number of unhandled events, not on the size of
+            the queue.
+
         >>> mydbevent = DbEvent()
         >>> row = mydbevent.find_all_unhandled(500)
         >>> while row is not None: \
             row = mydbevent.find_next()
+        >>> mydbevent.find_all_unhandled(500, since=2**31 - 1) is None
+        True
+        >>> mydbevent.find_all_unhandled(500, \
+                filters={'source': 'badnagios'}) is None
+        True
         """
 
-        self.db.select('queue', self.cols,
-            { # Select criteria
-              'ts'     : [ '<', '%(ts)s',      ts_max ],
-              'handled': [ '=', '%(handled)s', '0'    ],
-            },
-            [ 'id' ])   # Ordered by...
+        where = { # Select criteria
+            'ts'     : [ '<', '%(ts)s',      ts_max ],
+            'handled': [ '=', '%(handled)s', '0'    ],
+        }
+
+        if since is not None:
+            where['id'] = [ '>', '%(id)s', since ]
+
+        if filters:
+            where.update(filter_where(filters))
+
+        # Keep the row shape, just leave the message out
+        cols = self.cols[:-1] + [ 'NULL' ] if defer else None
+
+        return self.__find(where, cols, PENDING if self.pending else QUEUE)
+
+
+    def find_message(self, _id):
+        """ Return the message of the event `_id` (None if not found).
+        """
+
+        # Use a private cursor, so an ongoing scan is not affected
+        rows = self.db.query('SELECT message FROM queue WHERE id = %(id)s',
+                             { 'id': _id })
 
-        return self.db.fetch_next()
+        return rows[0][0] if rows else None
+
+
+    def get_watermark(self, name):
+        """ Return the last id processed by `name` (0 if none).
+
+        >>> mydbevent = DbEvent()
+        >>> mydbevent.set_watermark('test', 10)
+        >>> mydbevent.get_watermark('test')
+        10
+        >>> mydbevent.get_watermark('nonexistent')
+        0
+        """
+
+        # Use a private cursor, so an ongoing scan is not affected
+        rows = self.db.query('SELECT lastid FROM watermark '
+                             'WHERE name = %(name)s', { 'name': name })
+
+        return rows[0][0] if rows else 0
+
+
+    def set_watermark(self, name, lastid):
+        """ Set the last id processed by `name`.
+        """
+
+        self.db.execute('INSERT INTO watermark (name, lastid) '
+                        'VALUES (%(name)s, %(lastid)s) '
+                        'ON DUPLICATE KEY UPDATE lastid = VALUES(lastid)',
+                        { 'name': name, 'lastid': lastid })
 
 
     def find_eventid(self, source, eventid):
-        """ Find an event based on source and event ID.
+        """ Find an event based on source and event ID (the last one, if
+            there are several). Events found are cached (see EventCache).
+        """
+
+        row = cache.get((source, eventid))
+        if row is not None:
+            return row
+
+        # Use a private cursor, so an ongoing scan is not affected
+        rows = self.db.query('SELECT ' + ', '.join(self.cols) + ' FROM queue '
+                             'WHERE source = %(source)s '
+                             'AND eventid = %(eventid)s '
+                             'ORDER BY id DESC LIMIT 1',
+                             { 'source': source, 'eventid': eventid })
+
+        if not rows:
+            return None
+
+        cache.put((source, eventid), rows[0])
+
+        return rows[0]
+
+
+    def find_eventids(self, pairs):
+        """ Find the (last) event of each (source, event ID) pair at once.
+            Returns a dictionary pair -> row, without the pairs not found.
+            Only the pairs not cached are queried.
+
+        >>> mydbevent = DbEvent()
+        >>> list(mydbevent.find_eventids([('nagios1', 1)]))
+        [('nagios1', 1)]
+        >>> mydbevent.find_eventids([('badnagios', 1)])
+        {}
+        """
+
+        found = {}
+        missing = []
+
+        for pair in pairs:
+            row = cache.get(pair)
+            if row is None:
+                missing.append(pair)
+            else:
+                found[pair] = row
+
+        for i in range(0, len(missing), EVENTID_CHUNK):
+            where = []
+            params = {}
+
+            for j, (source, eventid) in enumerate(missing[i:i + EVENTID_CHUNK]):
+                where.append('(source = %%(s%d)s AND eventid = %%(e%d)s)' % (j, j))
+                params['s%d' % j] = source
+                params['e%d' % j] = eventid
+
+            # Use a private cursor, so an ongoing scan is not affected
+            rows = self.db.query('SELECT ' + ', '.join(self.cols) + ' FROM queue '
+                                 'WHERE ' + ' OR '.join(where) + ' ORDER BY id',
+                                 params)
+
+            # The last event of each pair wins
+            for row in rows:
+                found[(row[C_SOURCE], row[C_EVENTID])] = row
+
+            for pair in missing[i:i + EVENTID_CHUNK]:
+                if pair in found:
+                    cache.put(pair, found[pair])
+
+        return found
+
+
+    def cached(self, source, eventid):
+        """ Return True if the event of the given source and event ID is
+            cached (i.e., find_eventid won't query the database).
+        """
+
+        return (source, eventid) in cache
+
+
+    def clear_cache(self):
+        """ Forget the cached events. The cache only sees the changes made
+            by this process: the events inserted by the API and the ones
+            handled by other q runs are only seen once it is cleared (see
+            Q.commit).
         """
 
-        self.db.select('queue', self.cols,
-            where={
-              'source' : [ '=', '%(source)s',  source ],
-              'eventid': [ '=', '%(eventid)s', eventid ],
-            },
-            order=[ 'id' ],
-            desc=True)
+        cache.clear()
+
+
+    def cache_stats(self):
+        """ Return the hits, misses and size of the events cache. """
+
+        return cache.stats()
+
+
+def connect(**kwargs):
+    """ Open the event queue of the configured BACKEND: a DbEvent (with the
+        given arguments) or, for 'log', a LogEvent (see eventlog.py).
+    """
+
+    if BACKEND == 'log':
+        from eventlog.eventlog import LogEvent
+        return LogEvent(LOG_PATH)
 
-        return self.db.fetch_next()
+    return DbEvent(**kwargs)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Jorge Morgado <jorge (at) morgado (dot) ch>
+#
+
+"""
+ This module implements the scan engine: it runs all q scripts of a directory
+in a single process, sharing one queue instance (and one database connection)
+and one scan of the unhandled events.
+
+Scripts are executed in filename order. Each script walks the same in-memory
+snapshot of unhandled events, but only sees the events that the previous
+scripts have left unhandled - exactly as if each script was run on its own
+by the q interpreter.
+
+In checkpointed mode, each script only sees the events that arrived since its
+previous run (see Q.checkpoint), and the snapshot only holds the events above
+the lowest watermark of all scripts.
+
+In parallel mode, the scripts which only declare rules (see is_rule_script)
+are evaluated over partitions of the snapshot, i.e., the events with the same
+key (e.g., the same source), concurrently by several worker threads, each
+with its own queue instance. Within a partition, events are still processed
+in order (by id) and script after script. The other scripts (heartbeats,
+digests, ...) run once over the whole snapshot, in between.
+"""
+
+import os
+import sys
+import ast
+import glob
+import threading
+
+try:
+    import Queue as queue   # Python 2
+except ImportError:
+    import queue
+
+sys.path.append('..')
+from dbevent.dbevent import POOL_SIZE
+from rule.rule import RuleIndex
+
+__author__     = "Jorge Morgado"
+__copyright__  = "Copyright (c)2014, Jorge Morgado"
+__credits__    = []
+__license__    = "unknown"
+__version__    = "1.0.0"
+__maintainer__ = "Jorge Morgado"
+__email__      = "jorge (at) morgado (dot) ch"
+__status__     = "Production"
+
+# The keys events can be partitioned by in parallel mode
+PARTITIONS = {
+    'source'               : lambda e: e.source(),
+    'hostname'             : lambda e: e.hostname(),
+    'hostname+servicename' : lambda e: (e.hostname(), e.servicename()),
+}
+
+
+def lowest_watermark(marks):
+    """ Return the lowest of the watermarks of the scripts, i.e., the events
+        to fetch are the ones above it. Returns None (all events) if there
+        are no scripts or if they are not checkpointed (None watermarks).
+
+    >>> lowest_watermark([ 20, 10, 30 ])
+    10
+    >>> lowest_watermark([ None, None ]) is None
+    True
+    >>> lowest_watermark([]) is None
+    True
+    """
+
+    if not marks or None in marks:
+        return None
+
+    return min(marks)
+
+
+def is_rule_script(source):
+    """ Return True if the script only declares rules (see Q.rule), i.e., it
+        only has imports, assignments and function definitions (at least one
+        of them decorated with q.rule).
+
+    >>> is_rule_script("@q.rule(servicename='CPU')\\ndef f():\\n    q.ignore()")
+    True
+    >>> is_rule_script("q.first_unhandled()")
+    False
+    """
+
+    rules = False
+
+    for node in ast.parse(source).body:
+        if isinstance(node, (ast.Import, ast.ImportFrom, ast.Assign)):
+            continue
+
+        # Docstrings
+        if isinstance(node, ast.Expr) \
+                and node.value.__class__.__name__ in ('Str', 'Constant'):
+            continue
+
+        if not isinstance(node, ast.FunctionDef):
+            return False
+
+        for decorator in node.decorator_list:
+            if isinstance(decorator, ast.Call) \
+                    and isinstance(decorator.func, ast.Attribute) \
+                    and decorator.func.attr == 'rule' \
+                    and isinstance(decorator.func.value, ast.Name) \
+                    and decorator.func.value.id == 'q':
+                rules = True
+
+    return rules
+
+
+class Engine:
+    'Run several q scripts over a single scan of the queue.'
+
+    def __init__(self, q, checkpoint=False, workers=1, partition='source'):
+        """ Initialize the engine for the given queue instance (running the
+            scripts in checkpointed mode if `checkpoint` is True). If
+            `workers` is greater than 1, the events are partitioned by the
+            `partition` key (see PARTITIONS) and the rules evaluated in
+            parallel.
+
+            Each worker holds a pooled database connection of its own while
+            it runs, and `q` holds one more, so there can be at most
+            POOL_SIZE - 1 workers (more would just wait for a connection).
+        """
+
+        if partition not in PARTITIONS:
+            raise ValueError("Unknown partition key: %s" % partition)
+
+        if workers > 1 and workers >= POOL_SIZE:
+            raise ValueError("Too many workers: %d (at most %d, see "
+                             "POOL_SIZE in dbevent.py)" %
+                             (workers, POOL_SIZE - 1))
+
+        self.q = q
+        self.checkpoint = checkpoint
+        self.workers = workers
+        self.partition = partition
+
+        # List of (filename, code object) tuples, in execution order
+        self.scripts = []
+
+        # The scripts which only declare rules
+        self.rule_scripts = set()
+
+        # Where the scripts were loaded from and their modification times
+        # (see reload)
+        self.path = None
+        self.signature = None
+
+        # Serializes the workers' updates of the engine's queue instance
+        self.lock = threading.Lock()
+
+
+    def load(self, path):
+        """ Compile all q scripts found under `path` (must have the '.q'
+            extension). Returns the number of scripts loaded.
+        """
+
+        self.path = path
+        self.signature = self.__signature(path)
+
+        for fname in sorted(glob.glob(os.path.join(path, '*.q'))):
+            f = open(fname, 'r')
+            script = f.read()
+            f.close()
+
+            try:
+                self.scripts.append((fname, compile(script, fname, 'exec')))
+            except SyntaxError as e:
+                sys.stderr.write("Err %s: %s\n" % (fname, e))
+                continue
+
+            if is_rule_script(script):
+                self.rule_scripts.add(fname)
+
+        return len(self.scripts)
+
+
+    def reload(self):
+        """ Load the scripts again if any of them was added, changed or
+            removed since they were loaded. Returns True if reloaded.
+        """
+
+        if self.__signature(self.path) == self.signature:
+            return False
+
+        self.scripts = []
+        self.rule_scripts = set()
+        self.load(self.path)
+
+        return True
+
+
+    def __signature(self, path):
+        """ Return the names and modification times of the scripts. """
+
+        signature = []
+
+        for fname in sorted(glob.glob(os.path.join(path, '*.q'))):
+            try:
+                signature.append((fname, os.path.getmtime(fname)))
+            except OSError:
+                pass    # removed meanwhile
+
+        return signature
+
+
+    def run(self):
+        """ Fetch the unhandled events once and run them through all scripts.
+        """
+
+        if self.checkpoint:
+            marks = [ self.q.db.get_watermark(os.path.basename(fname))
+                      for fname, co in self.scripts ]
+        else:
+            marks = [ None ] * len(self.scripts)
+
+        self.q.load_unhandled(lowest_watermark(marks))
+        self.q.unsent = {}
+        snapshot = self.q.snapshot
+
+        self.__run_scripts(self.q, snapshot, marks)
+
+        self.q.snapshot = snapshot
+
+        if self.checkpoint:
+            self.__save_watermarks(marks)
+
+
+    def __stages(self, marks):
+        """ Group the scripts into stages: either a single script, or several
+            consecutive rule scripts (see is_rule_script). Returns a list of
+            lists of (filename, code object, watermark) tuples.
+        """
+
+        stages = []
+
+        for (fname, co), since in zip(self.scripts, marks):
+            if fname in self.rule_scripts and stages \
+                    and stages[-1][0][0] in self.rule_scripts:
+                stages[-1].append((fname, co, since))
+            else:
+                stages.append([ (fname, co, since) ])
+
+        return stages
+
+
+    def __run_scripts(self, q, events, marks):
+        """ Run all scripts over the given (snapshot of) events on queue `q`.
+            `marks` are the watermarks of the scripts (or None).
+        """
+
+        for stage in self.__stages(marks):
+            # Each script starts with the default settings (see Q.reset)
+            q.reset()
+
+            if stage[0][0] in self.rule_scripts:
+                if self.workers > 1:
+                    self.__run_parallel(events, stage)
+                else:
+                    self.__run_rules(q, events, stage)
+                continue
+
+            fname, co, since = stage[0]
+
+            q.script = fname
+            q.snapshot = [ e for e in events if since is None or e.id() > since ]
+
+            self.run_script(fname, co, q)
+
+            # Run the rules declared by the script (if any), as the q
+            # interpreter does
+            if q.rules:
+                try:
+                    q.run_rules()
+                except SystemExit:
+                    pass
+                except Exception as e:  # catch *all* exceptions
+                    sys.stderr.write("Err %s: %s\n" % (fname, e))
+
+            # Make the changes visible to the next scripts, as it would
+            # happen when each script runs on its own process
+            q.commit()
+
+
+    def __run_rules(self, q, events, stage):
+        """ Run a stage of rule scripts over the given events: the scripts
+            register their rules, which are indexed together. Then each
+            event is routed to its matching rules, script after script (as
+            long as the event is unhandled when its turn for a script comes).
+        """
+
+        rules = []
+        marks = {}
+
+        for fname, co, since in stage:
+            q.script = fname
+            q.rules = []
+            self.run_script(fname, co, q)
+
+            rules.extend(q.rules)
+            marks[fname] = since
+
+        q.rules = []
+        index = RuleIndex(rules)
+
+        for event in events:
+            if event.is_handled():
+                continue
+
+            q.event = event
+            script = None
+            skip = False
+
+            for rule in index.match(event):
+                if rule.script != script:
+                    script = rule.script
+                    since = marks[script]
+                    skip = event.is_handled() \
+                           or (since is not None and event.id() <= since)
+
+                if skip:
+                    continue
+
+                try:
+                    rule.func()
+                except SystemExit:
+                    pass
+                except Exception as e:  # catch *all* exceptions
+                    sys.stderr.write("Err %s: %s\n" % (script, e))
+
+        q.event = None
+        q.commit()
+
+
+    def __run_parallel(self, events, stage):
+        """ Run a stage of rule scripts over the partitions of the given
+            events, in parallel.
+        """
+
+        key = PARTITIONS[self.partition]
+
+        # Events are appended in id order, so each partition is in order
+        partitions = {}
+        for event in events:
+            if not event.is_handled():
+                partitions.setdefault(key(event), []).append(event)
+
+        todo = queue.Queue()
+        for part in partitions.values():
+            todo.put(part)
+
+        threads = []
+        for i in range(min(self.workers, len(partitions))):
+            t = threading.Thread(target=self.__worker, args=(todo, stage))
+            t.start()
+            threads.append(t)
+
+        for t in threads:
+            t.join()
+
+
+    def __worker(self, todo, stage):
+        """ Run a stage of rule scripts over the partitions taken from `todo`
+            (until none is left) on a queue instance of its own.
+        """
+
+        try:
+            q = self.q.__class__(self.q.ts_max)
+        except Exception as e:  # catch *all* exceptions
+            sys.stderr.write("Err worker: %s\n" % e)
+            return
+
+        try:
+            while True:
+                try:
+                    events = todo.get_nowait()
+                except queue.Empty:
+                    break
+
+                # The rules are registered on (and run with) this instance
+                q.reset()
+                q.snapshot = events
+                self.__run_rules(q, events, stage)
+        finally:
+            q.close()
+
+            # The watermarks are moved by the engine's queue instance
+            with self.lock:
+                for fname, lowest in q.unsent.items():
+                    self.q.unsent[fname] = min(self.q.unsent.get(fname,
+                                                                 lowest),
+                                               lowest)
+
+
+    def __save_watermarks(self, marks):
+        """ Move the watermark of each script past the events of the
+            snapshot (all of them have been through all scripts), except
+            the too young ones (see Q.checkpoint) and the ones whose digest
+            could not be sent (see Q.commit).
+        """
+
+        for (fname, co), since in zip(self.scripts, marks):
+            self.q.script = fname
+            self.q.checkpoint(since=since)
+
+            w = self.q.watermark
+            for event in self.q.snapshot:
+                if event.id() <= since:
+                    continue
+                if event.ts() is None or event.ts() >= w['cutoff']:
+                    break
+                w['next'] = event.id()
+
+            self.q.commit()
+            self.q.watermark = None
+
+
+    def run_script(self, fname, co, q=None):
+        """ Execute a single compiled script (on the given queue instance or
+            the engine's one). A failing script (or one that calls exit) must
+            not prevent the others from running.
+        """
+
+        env = {
+            '__name__': '__main__',
+            '__file__': fname,
+            'q'       : self.q if q is None else q,
+        }
+
+        try:
+            exec(co, env)
+        except SystemExit:
+            pass
+        except Exception as e:  # catch *all* exceptions
+            sys.stderr.write("Err %s: %s\n" % (fname, e))
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
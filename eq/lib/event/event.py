@@ -43,6 +43,13 @@ F_MESSAGE     = 17
 DATE_FMT = '%Y-%m-%d'
 TIME_FMT = '%H:%M:%S'
 
+# Week days (as numbered by datetime's weekday())
+WEEKDAYS = [ 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday',
+    'Saturday', 'Sunday' ]
+
+# An empty row (all columns unset)
+EMPTY_ROW = (None,) * (F_MESSAGE + 1)
+
 # Handled states (I mean, bits)
 IGNORED   = 0   # 2^0 = 1
 MAILSENT  = 1   # 2^1 = 2
@@ -67,28 +74,32 @@ SMSSENT   = 2   # 2^2 = 4
 #  6  1  1  0  Event was sent via email and SMS
 #     1  1  1  Invalid state (can't be ignored and another non-ignored)
 
-class Event():
+class Event(object):
     'Common base class for the event entity.'
 
-    def __init__(self, row):
-        """ Initialize the event object.
-        """
-
-        self.e = row
-        self.h = self.__column(F_HANDLED)
-
+    # Lots of events are kept in memory during a scan: no per-instance dict.
+    # The weekday and the time of day are only computed when first needed.
+    __slots__ = ('e', 'h', 'wd', 'tod', 'loader')
 
-    def __column(self, index):
-        """ Return the value in the column given by index. It should always
-            return some valid value, unless the cursor is not in a valid
-            row - in this case None will be returned (although, it shoudn't).
+    def __init__(self, row, loader=None):
+        """ Initialize the event object. If the row was fetched without the
+            message, `loader` is the function (of the event id) returning
+            it, called on first access.
         """
-        if self.e is None:
-            return None
-        elif self.e[index] is None:
-            return ''
+
+        # Columns are normalized once: NULL values are returned as ''. If
+        # the cursor is not in a valid row, all columns are None (although,
+        # it shoudn't happen).
+        if row is None:
+            self.e = EMPTY_ROW
+            self.h = None
         else:
-            return self.e[index]
+            self.e = tuple(['' if v is None else v for v in row])
+            self.h = int(self.e[F_HANDLED] or 0)
+
+        self.wd = None      # weekday (0 = Monday)
+        self.tod = None     # time of day (in seconds)
+        self.loader = None if row is None else loader
 
 
     def __str__(self):
@@ -187,45 +198,54 @@ class Event():
     # These should be used to get the field of the function with the same name.
     # For example, if the queue's cursor is in a valid row, you can get it's
     # ID by calling q.id(). To get the timestamp, call q.ts(), and so on...
-    def id(self):          return self.__column(F_ID)
-    def ts(self):          return self.__column(F_TS)
-    def source(self):      return self.__column(F_SOURCE)
-    def eventid(self):     return self.__column(F_EVENTID)
-    def lasteventid(self): return self.__column(F_LASTEVENTID)
-    def type(self):        return self.__column(F_TYPE)
-    def state(self):       return self.__column(F_STATE)
-    def statetype(self):   return self.__column(F_STATETYPE)
-    def laststate(self):   return self.__column(F_LASTSTATE)
-    def count(self):       return self.__column(F_COUNT)
+    def id(self):          return self.e[F_ID]
+    def ts(self):          return self.e[F_TS]
+    def source(self):      return self.e[F_SOURCE]
+    def eventid(self):     return self.e[F_EVENTID]
+    def lasteventid(self): return self.e[F_LASTEVENTID]
+    def type(self):        return self.e[F_TYPE]
+    def state(self):       return self.e[F_STATE]
+    def statetype(self):   return self.e[F_STATETYPE]
+    def laststate(self):   return self.e[F_LASTSTATE]
+    def count(self):       return self.e[F_COUNT]
     def handled(self):     return self.h
-    def ipv4(self):        return self.__column(F_IPV4)
-    def ipv6(self):        return self.__column(F_IPV6)
-    def hostname(self):    return self.__column(F_HOSTNAME)
-    def servicename(self): return self.__column(F_SERVICENAME)
-    def date(self):        return self.__column(F_DATE)
-    def time(self):        return self.__column(F_TIME)
-    def message(self):     return self.__column(F_MESSAGE)
+    def ipv4(self):        return self.e[F_IPV4]
+    def ipv6(self):        return self.e[F_IPV6]
+    def hostname(self):    return self.e[F_HOSTNAME]
+    def servicename(self): return self.e[F_SERVICENAME]
+    def date(self):        return self.e[F_DATE]
+    def time(self):        return self.e[F_TIME]
+    def message(self):
+        """ Return the message of the event (loaded on first access if the
+            row was fetched without it).
+        """
+
+        if self.loader is not None:
+            msg = self.loader(self.id())
+            self.e = self.e[:F_MESSAGE] + ('' if msg is None else msg,)
+            self.loader = None
+
+        return self.e[F_MESSAGE]
 
     def weekday(self):
         """ Return the weekday of the event.
         """
 
-        wd = [ 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday',
-            'Saturday', 'Sunday' ]
+        if self.wd is None:
+            self.wd = datetime.datetime.strptime(self.date(), DATE_FMT).weekday()
 
-        return wd[datetime.datetime.strptime(self.date(), DATE_FMT).weekday()]
+        return WEEKDAYS[self.wd]
 
 
     def time_is_between(self, hr1, min1, hr2, min2):
         """ Return True if event's time is between hr1:min1 and hr2:min2.
         """
 
-        time = datetime.datetime.strptime(self.date() + ' ' + self.time(),
-                                          DATE_FMT + ' ' + TIME_FMT)
-        time_min = time.replace(hour=hr1, minute=min1, second=0, microsecond=0)
-        time_max = time.replace(hour=hr2, minute=min2, second=0, microsecond=0)
+        if self.tod is None:
+            time = datetime.datetime.strptime(self.time(), TIME_FMT)
+            self.tod = time.hour * 3600 + time.minute * 60 + time.second
 
-        return time_min < time < time_max
+        return hr1 * 3600 + min1 * 60 < self.tod < hr2 * 3600 + min2 * 60
 
 
     def weekday_is_equal(self, weekday):
@@ -0,0 +1,1052 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Jorge Morgado <jorge (at) morgado (dot) ch>
+#
+
+"""
+An append-only log storage engine for the event queue (see BACKEND in
+dbevent.py). Events are appended and mostly read in order, so instead of a
+table (and its indexes), the queue is a directory of segment files:
+
+    <id>.log    the records of up to `capacity` events with consecutive ids
+                (from <id> on): a fixed header (see HEADER), followed by the
+                text fields (UTF-8), each prefixed by its length
+    <id>.idx    the number of records published, the end of the last one
+                and the segment capacity, followed by the offset of each
+                record
+    <id>.hnd    the handled value of each event, one byte per event
+    <id>.meta   the count and timestamp of each event (see META)
+    <id>.keys   the index entries of the events of a full segment (JSON),
+                written once all its events are indexed (see EventLog.save)
+
+Records are never changed: the columns that change (handled, count and ts)
+live in the fixed-size .hnd and .meta files, which are mmap'ed (as the .idx
+file) and updated in place. A batch of events is written at once and then
+published by updating the number of records, so readers never see a partial
+batch. Writers (of all processes) take turns on the LOCK file, readers don't
+lock at all.
+
+The duplicates of an event and the events of a source and event id are
+looked up in memory (see EventLog.follow). The index of the full segments
+is loaded from their .keys files, only the events of the last segment are
+decoded when a process starts. Old segments whose events are all
+handled are dropped (see EventLog.compact).
+
+To test the module use:
+$ python eventlog.py
+"""
+
+import os
+import sys
+import json
+import mmap
+import binascii
+import fcntl
+import struct
+import tempfile
+import threading
+from bisect import bisect_right
+from contextlib import contextmanager
+from datetime import datetime
+from time import time, mktime, strptime
+sys.path.append('..')
+from dbevent.dbevent import dedup_key, match_filters
+from event.event import Event
+from sqlitedb.sqlitedb import inet_aton, inet_ntoa
+
+__author__     = "Jorge Morgado"
+__copyright__  = "Copyright (c)2014, Jorge Morgado"
+__credits__    = []
+__license__    = "unknown"
+__version__    = "1.0.0"
+__maintainer__ = "Jorge Morgado"
+__email__      = "jorge (at) morgado (dot) ch"
+__status__     = "Production"
+
+# TODO Set this from a configuration file
+# How many events per segment (of a new log)
+SEGMENT_EVENTS = 1 << 20
+
+# TODO Set this from a configuration file
+# Write the files to disk on commit. If not set, the events survive a crash
+# of the process, but not of the system.
+SYNC = False
+
+# TODO Set this from a configuration file
+# Drop the segments whose events are all handled and older than this many
+# days (see EventLog.compact)
+COMPACT_DAYS = 30
+
+# How much to grow the .log files at once (they are sparse)
+LOG_GROW = 64 << 20
+
+# Text fields of the records, in order
+FIELDS = [
+    'source',
+    'type',
+    'state',
+    'statetype',
+    'laststate',
+    'ipv4',
+    'ipv6',
+    'hostname',
+    'servicename',
+    'date',
+    'time',
+    'message',
+]
+IPV6 = FIELDS.index('ipv6')
+
+# Record header: length of the record (in bytes), event id, last event id
+# and the length of each field (in characters, -1 if NULL). The fields are
+# encoded (and decoded) as a whole, the binary IPv6 address as Latin-1 text.
+HEADER = struct.Struct('<Iqq%di' % len(FIELDS))
+
+# .idx header (records published, end of the last one, capacity), offset of
+# a record, .meta entry (count, ts) and .hnd entry
+IDX_HEADER = struct.Struct('<QQQ')
+OFFSET = struct.Struct('<Q')
+META = struct.Struct('<II')
+HANDLED = struct.Struct('B')
+
+# The text type (unicode in Python 2)
+TEXT = type(u'')
+
+# Timestamp format (as in the q scripts)
+TS_FMT = '%Y-%m-%d %H:%M:%S'
+
+# Logs shared by all LogEvent instances (see get_log)
+logs = {}
+logs_lock = threading.Lock()
+
+
+def get_log(path, capacity=None):
+    """ Return the log of the given directory, opening it on the first
+        call.
+    """
+
+    with logs_lock:
+        if path not in logs:
+            logs[path] = EventLog(path, capacity)
+
+        return logs[path]
+
+
+def encode(eventid, lasteventid, values):
+    """ Return the record of an event (see HEADER), with the `values` of
+        FIELDS.
+
+    >>> values = [ u'nagios1', 'RECOVERY' ] + [ None ] * 4 + [ b'\\xfe\\x80' ]
+    >>> record = encode(1, 0, values + [ None, u'caf\\xe9' ] + [ None ] * 3)
+    >>> len(record) == HEADER.size + 24
+    True
+    >>> eventid, lasteventid, values = decode(record, 0)
+    >>> eventid, lasteventid, values[IPV6] == b'\\xfe\\x80'
+    (1, 0, True)
+    >>> values[8] == u'caf\\xe9'
+    True
+    """
+
+    ipv6 = values[IPV6]
+    texts = [ v if v is None or type(v) is TEXT
+              else v.decode('utf-8') if isinstance(v, bytes) else u'%s' % v
+              for v in values[:IPV6] + [ None ] + values[IPV6 + 1:] ]
+
+    if ipv6 is not None:
+        if not isinstance(ipv6, bytes):
+            ipv6 = (u'%s' % ipv6).encode('utf-8')
+        texts[IPV6] = ipv6.decode('latin-1')
+
+    lengths = [ -1 if v is None else len(v) for v in texts ]
+    data = u''.join([ v for v in texts if v ]).encode('utf-8')
+
+    return HEADER.pack(HEADER.size + len(data), int(eventid),
+                       int(lasteventid), *lengths) + data
+
+
+def decode(buf, offset):
+    """ Return the event id, last event id and the FIELDS values of the
+        record at `offset` of `buf`.
+    """
+
+    header = HEADER.unpack_from(buf, offset)
+    text = buf[offset + HEADER.size:offset + header[0]].decode('utf-8')
+    pos = 0
+    values = []
+
+    for n in header[3:]:
+        if n < 0:
+            values.append(None)
+        else:
+            values.append(text[pos:pos + n])
+            pos += n
+
+    if values[IPV6] is not None:
+        values[IPV6] = values[IPV6].encode('latin-1')
+
+    return header[1], header[2], values
+
+
+def event_key(source, eventid, lasteventid, etype, state, hostname,
+              servicename):
+    """ Return the key of the duplicates of an event (see dedup_key) or None
+        if it has none (NULL values never match, as in MySQL).
+    """
+
+    if None in (source, etype, state, hostname, servicename):
+        return None
+
+    return dedup_key(source, eventid, lasteventid, etype, state, hostname,
+                     servicename)
+
+
+def timestamp(ts):
+    """ Return the given time (a datetime or a string as in the q scripts)
+        as seconds since the epoch.
+    """
+
+    if isinstance(ts, datetime):
+        return mktime(ts.timetuple())
+
+    if isinstance(ts, (int, float)):
+        return ts
+
+    return mktime(strptime(ts, TS_FMT))
+
+
+def map_file(name):
+    """ Return a (read-write) map of the whole file. """
+
+    with open(name, 'r+b') as f:
+        return mmap.mmap(f.fileno(), 0)
+
+
+class Segment:
+    'The files of a segment of the log (see the module documentation).'
+
+    def __init__(self, path, base, capacity=None):
+        """ Open the segment of the log directory `path` whose first id is
+            `base`. If `capacity` is given, the segment is created (the .idx
+            file goes last, as the segments are found by it).
+        """
+
+        self.base = base
+        name = os.path.join(path, '%020d' % base)
+
+        if capacity is not None:
+            for ext, size in (('.log', LOG_GROW), ('.hnd', capacity),
+                              ('.meta', META.size * capacity)):
+                with open(name + ext, 'wb') as f:
+                    f.truncate(size)
+
+            with open(name + '.tmp', 'wb') as f:
+                f.write(IDX_HEADER.pack(0, 0, capacity))
+                f.truncate(IDX_HEADER.size + OFFSET.size * capacity)
+            os.rename(name + '.tmp', name + '.idx')
+
+        self.name = name
+        self.log = open(name + '.log', 'r+b')
+        self.idx = map_file(name + '.idx')
+        self.hnd = map_file(name + '.hnd')
+        self.meta = map_file(name + '.meta')
+        self.capacity = IDX_HEADER.unpack_from(self.idx, 0)[2]
+
+        # The index entries are in the .keys file (see EventLog.save)
+        self.saved = os.path.exists(name + '.keys')
+
+        # Read-only map of the records (remapped as the file grows)
+        self.data = None
+
+
+    def count(self):
+        """ Return the number of records published. """
+
+        return IDX_HEADER.unpack_from(self.idx, 0)[0]
+
+
+    def record(self, i):
+        """ Return the buffer and the offset of the `i`th record. """
+
+        offset = OFFSET.unpack_from(self.idx, IDX_HEADER.size +
+                                    OFFSET.size * i)[0]
+        data = self.data
+
+        if data is None or offset + HEADER.size > len(data) \
+                or offset + HEADER.unpack_from(data, offset)[0] > len(data):
+            data = self.data = mmap.mmap(self.log.fileno(), 0,
+                                         access=mmap.ACCESS_READ)
+
+        return data, offset
+
+
+    def row(self, i, message=True):
+        """ Return the `i`th event, as a queue row (see DbEvent cols). The
+            message is left out (None) unless `message` is set.
+        """
+
+        eventid, lasteventid, v = decode(*self.record(i))
+        count, ts = META.unpack_from(self.meta, META.size * i)
+
+        return ( self.base + i, datetime.fromtimestamp(ts), v[0], eventid,
+                 lasteventid, v[1], v[2], v[3], v[4], count,
+                 HANDLED.unpack_from(self.hnd, i)[0], v[5], v[6], v[7], v[8],
+                 v[9], v[10], v[11] if message else None )
+
+
+    def append(self, records):
+        """ Append the given (record, count, handled) events, at most as
+            many as there is room for, and publish them. Returns the number
+            of events appended. The caller holds the log's lock.
+        """
+
+        count, end, capacity = IDX_HEADER.unpack_from(self.idx, 0)
+        records = records[:capacity - count]
+        data = b''.join([ r[0] for r in records ])
+        ts = int(time())
+
+        if end + len(data) > os.fstat(self.log.fileno()).st_size:
+            self.log.truncate(end + len(data) + LOG_GROW)
+
+        self.log.seek(end)
+        self.log.write(data)
+        self.log.flush()
+
+        for i, (record, n, handled) in enumerate(records, count):
+            OFFSET.pack_into(self.idx, IDX_HEADER.size + OFFSET.size * i, end)
+            META.pack_into(self.meta, META.size * i, n, ts)
+            HANDLED.pack_into(self.hnd, i, handled)
+            end += len(record)
+
+        # Publish them
+        IDX_HEADER.pack_into(self.idx, 0, count + len(records), end, capacity)
+
+        return len(records)
+
+
+    def handled(self):
+        """ Return True if all events of the segment are handled. """
+
+        return self.hnd.find(b'\x00', 0, self.count()) < 0
+
+
+    def sync(self):
+        """ Write the segment files to disk. """
+
+        os.fsync(self.log.fileno())
+        for m in (self.idx, self.hnd, self.meta):
+            m.flush()
+
+
+    def close(self):
+        self.log.close()
+        for m in (self.idx, self.hnd, self.meta):
+            m.close()
+
+
+    def remove(self):
+        """ Delete the segment files (the .idx first, see __init__). """
+
+        self.close()
+        for ext in ('.idx', '.log', '.hnd', '.meta'):
+            os.remove(self.name + ext)
+
+        if os.path.exists(self.name + '.keys'):
+            os.remove(self.name + '.keys')
+
+
+class EventLog:
+    'The segments of a log directory (see the module documentation).'
+
+    def __init__(self, path, capacity=None):
+        """ Open the log of the directory `path`, creating it if needed.
+            New segments hold `capacity` (SEGMENT_EVENTS by default) events.
+        """
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.path = path
+        self.capacity = capacity or SEGMENT_EVENTS
+        self.lock = threading.RLock()
+        self.lockfile = open(os.path.join(path, 'LOCK'), 'a')
+        self.locked = 0
+
+        # The segments, sorted by their first id
+        self.segments = []
+        self.bases = []
+
+        # The events indexed so far (see follow): first id of each dedup
+        # key and of each heartbeat, last id of each source and event id,
+        # and the next id to index
+        self.dedup = {}
+        self.heartbeats = {}
+        self.eventids = {}
+        self.followed = 0
+
+        self.refresh()
+
+
+    @contextmanager
+    def writing(self):
+        """ Run a block with the log locked for writing (by this thread
+            only), with all events published so far indexed.
+        """
+
+        with self.lock:
+            if not self.locked:
+                fcntl.flock(self.lockfile, fcntl.LOCK_EX)
+            self.locked += 1
+
+            try:
+                self.follow()
+                self.save()
+                yield self
+            finally:
+                self.locked -= 1
+                if not self.locked:
+                    fcntl.flock(self.lockfile, fcntl.LOCK_UN)
+
+
+    def refresh(self):
+        """ Open the segments created and forget the ones dropped (by any
+            process) since the last call.
+        """
+
+        with self.lock:
+            bases = sorted([ int(f[:-4]) for f in os.listdir(self.path)
+                             if f.endswith('.idx') ])
+            known = dict(zip(self.bases, self.segments))
+
+            self.segments = [ known.pop(b, None) or Segment(self.path, b)
+                              for b in bases ]
+            self.bases = bases
+
+            for segment in known.values():
+                segment.close()
+
+            if known:
+                self.__purge()
+
+
+    def __purge(self):
+        """ Forget the indexed events of the segments dropped. """
+
+        first = self.bases[0] if self.bases else self.followed
+        for index in (self.dedup, self.heartbeats, self.eventids):
+            for key in [ k for k, v in index.items() if v < first ]:
+                del index[key]
+
+
+    def last(self):
+        """ Return the last segment (with room for more events), creating it
+            if needed. The caller holds the lock.
+        """
+
+        segment = self.segments[-1] if self.segments else None
+
+        if segment is None or segment.count() >= segment.capacity:
+            self.refresh()
+            segment = self.segments[-1] if self.segments else None
+
+        if segment is None or segment.count() >= segment.capacity:
+            base = segment.base + segment.capacity if segment else 1
+            self.segments.append(Segment(self.path, base, self.capacity))
+            self.bases.append(base)
+
+            # Good time to drop what is not needed anymore
+            self.compact()
+            segment = self.segments[-1]
+
+        return segment
+
+
+    def segment(self, _id):
+        """ Return the segment of the event `_id` (or, if it was dropped,
+            the first one after it). Returns None if there is no such
+            segment (yet).
+        """
+
+        i = bisect_right(self.bases, _id) - 1
+        segments = self.segments
+
+        if i >= 0 and _id < segments[i].base + segments[i].capacity:
+            return segments[i]
+        if i + 1 < len(segments):
+            return segments[i + 1]
+
+        # Maybe created by another process
+        self.refresh()
+        i = bisect_right(self.bases, _id) - 1
+        if i >= 0 and _id < self.segments[i].base + self.segments[i].capacity:
+            return self.segments[i]
+
+        return self.segments[i + 1] if i + 1 < len(self.segments) else None
+
+
+    def row(self, _id, message=True):
+        """ Return the event `_id` (None if not found). """
+
+        segment = self.segment(_id)
+        if segment is None or _id < segment.base \
+                or _id - segment.base >= segment.count():
+            return None
+
+        return segment.row(_id - segment.base, message)
+
+
+    def append(self, records):
+        """ Append the given (record, count, handled) events. Returns the id
+            of the first one (the ids are consecutive). The caller holds the
+            lock.
+        """
+
+        first = None
+
+        while records:
+            segment = self.last()
+            if first is None:
+                first = segment.base + segment.count()
+
+            records = records[segment.append(records):]
+
+        return first
+
+
+    def follow(self):
+        """ Index the events published since the last call (by any process),
+            see index. The full segments not indexed at all are loaded from
+            their .keys file, if any (see save).
+        """
+
+        with self.lock:
+            segment = self.segment(self.followed)
+
+            while segment is not None:
+                i = max(self.followed - segment.base, 0)
+                count = segment.count()
+
+                if not i and segment.saved:
+                    self.load(segment)
+                    i = count
+
+                for i in range(i, count):
+                    eventid, lasteventid, v = decode(*segment.record(i))
+                    self.index(segment.base + i, event_key(v[0], eventid,
+                        lasteventid, v[1], v[2], v[7], v[8]), v[0], eventid,
+                        lasteventid, v[1], v[2])
+
+                self.followed = max(self.followed, segment.base + count)
+
+                if count < segment.capacity:
+                    break
+                segment = self.segment(segment.base + segment.capacity)
+
+
+    def index(self, _id, key, source, eventid, lasteventid, etype, state):
+        """ Index the event `_id`: by its dedup `key` (see event_key), as a
+            heartbeat and by source and event id.
+        """
+
+        if key is not None:
+            self.dedup.setdefault(key, _id)
+
+        if not eventid and not lasteventid:
+            self.heartbeats.setdefault((source, etype, state), _id)
+
+        self.eventids[(source, int(eventid))] = _id
+
+
+    def save(self):
+        """ Write the .keys file of the full segments whose events are all
+            indexed: the entries of the indexes that point to them (as they
+            are now, see load). The caller holds the lock.
+        """
+
+        for segment in self.segments[:-1]:
+            base, end = segment.base, segment.base + segment.capacity
+            if end > self.followed:
+                break
+
+            # Maybe saved by another process
+            segment.saved = segment.saved or \
+                            os.path.exists(segment.name + '.keys')
+            if segment.saved:
+                continue
+
+            keys = {
+                'dedup': [ [ binascii.hexlify(k).decode('ascii'), v ]
+                           for k, v in self.dedup.items()
+                           if base <= v < end ],
+                'heartbeats': [ list(k) + [ v ]
+                                for k, v in self.heartbeats.items()
+                                if base <= v < end ],
+                'eventids': [ list(k) + [ v ]
+                              for k, v in self.eventids.items()
+                              if base <= v < end ],
+            }
+
+            tmp = segment.name + '.keys.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(keys, f)
+                f.flush()
+                if SYNC:
+                    os.fsync(f.fileno())
+            os.rename(tmp, segment.name + '.keys')
+            segment.saved = True
+
+
+    def load(self, segment):
+        """ Index the events of the (full) `segment` from its .keys file
+            (see save), as index would.
+        """
+
+        with open(segment.name + '.keys', 'r') as f:
+            keys = json.load(f)
+
+        for k, v in keys['dedup']:
+            self.dedup.setdefault(binascii.unhexlify(k), v)
+
+        for source, etype, state, v in keys['heartbeats']:
+            self.heartbeats.setdefault((source, etype, state), v)
+
+        for source, eventid, v in keys['eventids']:
+            self.eventids[(source, eventid)] = v
+
+
+    def add(self, _id, n=1, ts=None):
+        """ Add `n` to the count of the event `_id` (and set its timestamp
+            to `ts`, if given). The caller holds the lock.
+        """
+
+        segment = self.segment(_id)
+        i = META.size * (_id - segment.base)
+        count, old = META.unpack_from(segment.meta, i)
+        META.pack_into(segment.meta, i, count + n, old if ts is None else ts)
+
+
+    def set_handled(self, ids, handled):
+        """ Set the handled value of the given events (in place). """
+
+        for _id in ids:
+            segment = self.segment(_id)
+            if segment is not None and _id >= segment.base:
+                HANDLED.pack_into(segment.hnd, _id - segment.base, handled)
+
+
+    def compact(self, days=None):
+        """ Drop the oldest segments whose events are all handled and older
+            than `days` (COMPACT_DAYS by default). The last segment is always
+            kept. Returns the number of segments dropped.
+        """
+
+        days = COMPACT_DAYS if days is None else days
+        cutoff = time() - days * 86400
+        dropped = 0
+
+        with self.writing():
+            for segment in self.segments[:-1]:
+                count = segment.count()
+                if not count or not segment.handled() or \
+                        META.unpack_from(segment.meta,
+                                         META.size * (count - 1))[1] >= cutoff:
+                    break
+
+                segment.remove()
+                dropped += 1
+
+            if dropped:
+                self.segments = self.segments[dropped:]
+                self.bases = self.bases[dropped:]
+                self.__purge()
+
+        return dropped
+
+
+    def sync(self):
+        """ Write the last segment to disk (the others are complete). """
+
+        with self.lock:
+            if self.segments:
+                self.segments[-1].sync()
+
+
+class LogEvent:
+    'The event queue (same interface as DbEvent) stored in an EventLog.'
+
+    def __init__(self, path, capacity=None):
+        """ Open the event log of the directory `path` (see EventLog).
+
+        >>> mylogevent = LogEvent(tempfile.mkdtemp())
+        """
+
+        self.log = get_log(path, capacity)
+        self.rows = iter(())
+
+
+    def close(self):
+        self.commit()
+
+
+    def ping(self):
+        pass
+
+
+    def commit(self):
+        """ The events are written (and published) at once, only write them
+            to disk (if SYNC is set).
+        """
+
+        if SYNC:
+            self.log.sync()
+
+
+    def rollback(self):
+        """ Nothing to do: each write is published at once (a batch of
+            new_events as a whole).
+        """
+
+        pass
+
+
+    @contextmanager
+    def transaction(self):
+        yield self
+        self.commit()
+
+
+    def stream(self, chunk):
+        """ Nothing to do, the events are always read as they are needed.
+        """
+
+        pass
+
+
+    def find_next(self):
+        """ Get the next event of the scan or None if there are no more.
+        """
+
+        return next(self.rows, None)
+
+
+    def buffered(self):
+        """ Nothing is read ahead (see cached). """
+
+        return []
+
+
+    def __find(self, rows):
+        self.rows = rows
+
+        return self.find_next()
+
+
+    def __scan(self, ts_max, since=None, unhandled=False, etype=None,
+               filters=None, defer=False):
+        """ Generate the events (by increasing id) whose id is greater than
+            `since`, older than `ts_max` and, if given, `unhandled`, of type
+            `etype` and matching the `filters`.
+        """
+
+        ts_max = timestamp(ts_max)
+        log = self.log
+        _id = (since or 0) + 1
+        segment = log.segment(_id)
+
+        while segment is not None:
+            i = max(_id - segment.base, 0)
+            count = segment.count()
+
+            while i < count:
+                # Skip the handled events in one go
+                if unhandled:
+                    i = segment.hnd.find(b'\x00', i, count)
+                    if i < 0:
+                        break
+
+                if META.unpack_from(segment.meta, META.size * i)[1] < ts_max:
+                    row = segment.row(i, not defer)
+
+                    if (etype is None or row[5] == etype) and \
+                       (not filters or match_filters(Event(row), filters)):
+                        yield row
+
+                i += 1
+
+            if count < segment.capacity:
+                return
+
+            _id = segment.base + segment.capacity
+            segment = log.segment(_id)
+
+
+    def find_all(self, ts_max):
+        """ Get a cursor for all events (see DbEvent.find_all). """
+
+        return self.__find(self.__scan(ts_max))
+
+
+    def find_heartbeat(self, ts_max):
+        """ Get a cursor for all heartbeat events. """
+
+        return self.__find(self.__scan(ts_max, etype='HEARTBEAT'))
+
+
+    def find_all_unhandled(self, ts_max, since=None, filters=None,
+                           defer=False):
+        """ Get a cursor for all unhandled events (see
+            DbEvent.find_all_unhandled). The filters are evaluated here
+            (see match_filters).
+        """
+
+        return self.__find(self.__scan(ts_max, since, True, None, filters,
+                                       defer))
+
+
+    def find_message(self, _id):
+        """ Return the message of the event `_id` (None if not found). """
+
+        row = self.log.row(_id)
+
+        return row[-1] if row is not None else None
+
+
+    def find_eventid(self, source, eventid):
+        """ Find the (last) event of the given source and event ID. """
+
+        self.log.follow()
+
+        _id = self.log.eventids.get((source, int(eventid)))
+
+        return self.log.row(_id) if _id is not None else None
+
+
+    def find_eventids(self, pairs):
+        """ Find the (last) event of each (source, event ID) pair. Returns
+            a dictionary pair -> row, without the pairs not found.
+        """
+
+        found = {}
+
+        for pair in pairs:
+            row = self.find_eventid(*pair)
+            if row is not None:
+                found[pair] = row
+
+        return found
+
+
+    def cached(self, source, eventid):
+        """ Always True: the events are found in memory (see EventLog.follow).
+        """
+
+        return True
+
+
+    def clear_cache(self):
+        """ Nothing to do: the events index follows the log (see
+            EventLog.follow).
+        """
+
+        pass
+
+
+    def cache_stats(self):
+        """ Return the size of the events index. """
+
+        return { 'hits': 0, 'misses': 0, 'size': len(self.log.eventids) }
+
+
+    def get_watermark(self, name):
+        """ Return the last id processed by `name` (0 if none). """
+
+        return self.__watermarks().get(name, 0)
+
+
+    def set_watermark(self, name, lastid):
+        """ Set the last id processed by `name`. """
+
+        with self.log.writing():
+            watermarks = self.__watermarks()
+            watermarks[name] = lastid
+
+            name = os.path.join(self.log.path, 'watermarks')
+            with open(name + '.tmp', 'w') as f:
+                json.dump(watermarks, f)
+            os.rename(name + '.tmp', name)
+
+
+    def __watermarks(self):
+        try:
+            with open(os.path.join(self.log.path, 'watermarks')) as f:
+                return json.load(f)
+        except IOError:
+            return {}
+
+
+    def set_handled(self, _id, handled):
+        """ Set the event handled value (in place). """
+
+        self.log.set_handled([ _id ], int(handled))
+
+
+    def set_handled_many(self, ids, handled):
+        """ Set the same handled value on several events at once. """
+
+        self.log.set_handled(ids, int(handled))
+
+
+    def update_many(self, records, commit=False):
+        """ Update several events at once (see DbEvent.update_many). Only
+            the handled value and the count can be changed, the rest of the
+            event is never written again.
+        """
+
+        for record in records:
+            for column in record:
+                if column not in ('id', 'handled', 'count'):
+                    raise ValueError("Column can't be updated: %s" % column)
+
+        with self.log.writing():
+            for record in records:
+                if 'handled' in record:
+                    self.log.set_handled([ record['id'] ],
+                                         int(record['handled']))
+                if 'count' in record:
+                    row = self.log.row(record['id'], False)
+                    self.log.add(record['id'], int(record['count']) - row[9])
+
+        return len(records)
+
+
+    def increase_count(self, _id):
+        """ Increment the event count for the sepecified `id`. """
+
+        with self.log.writing():
+            self.log.add(_id)
+
+        return True
+
+
+    def new_heartbeat_event(self, source, etype, state, date, time_):
+        """ Insert a new heartbeat event (handled) or, if it already exists,
+            increment its count and update its timestamp.
+        """
+
+        with self.log.writing():
+            _id = self.log.heartbeats.get((source, etype, state))
+
+            if _id is not None and _id >= self.log.bases[0]:
+                self.log.add(_id, ts=int(time()))
+                return _id
+
+            values = [ source, etype, state, None, None, None, None, None,
+                       None, date, time_, None ]
+            _id = self.log.append([ (encode(0, 0, values), 1, 1) ])
+            self.__index(_id, None, 0, 0, values)
+
+            return _id
+
+
+    def new_event(self, source, eventid, lasteventid, etype, state, \
+        statetype, laststate, ipv4, ipv6, hostname, servicename, date, time, message):
+        """ Insert a new event or, if it already exists, increment its
+            count. Returns the event id in both cases.
+        """
+
+        return self.new_events([ {
+            'source': source, 'eventid': eventid, 'lasteventid': lasteventid,
+            'type': etype, 'state': state, 'statetype': statetype,
+            'laststate': laststate, 'ipv4': ipv4, 'ipv6': ipv6,
+            'hostname': hostname, 'servicename': servicename, 'date': date,
+            'time': time, 'message': message,
+        } ])[0]
+
+
+    def new_events(self, events):
+        """ Insert several events at once (see DbEvent.new_events). The new
+            events are appended with a single write and published at once.
+            Returns the list of ids, in the same order as `events`.
+
+        >>> mylogevent = LogEvent(tempfile.mkdtemp())
+        >>> e = dict(source='nagios1', eventid=1, lasteventid=0,
+        ...     type='PROBLEM', state='CRITICAL', statetype='HARD',
+        ...     laststate='OK', ipv4='10.0.0.1', ipv6=None, hostname='gw',
+        ...     servicename='HTTP', date='2014-06-10', time='17:33:00',
+        ...     message='Down')
+        >>> mylogevent.new_events([ e, e, dict(e, eventid=2) ])
+        [1, 1, 2]
+        >>> mylogevent.new_events([ dict(e, eventid=2), dict(e, hostname=None) ])
+        [2, 3]
+        >>> row = mylogevent.find_eventid('nagios1', 2)
+        >>> print('%s %s %s' % (row[0], row[9], row[11]))
+        2 2 10.0.0.1
+        >>> mylogevent.set_handled(1, 1)
+        >>> mylogevent.find_all_unhandled('2100-01-01 00:00:00')[0]
+        2
+        """
+
+        with self.log.writing():
+            log = self.log
+            first = log.bases[0] if log.bases else 0
+            counts = {}
+            records = []    # the new events
+            new = {}        # dedup key -> position of the new event
+            refs = []       # per event: the existing id or the position
+
+            for e in events:
+                key = event_key(e['source'], e['eventid'], e['lasteventid'],
+                    e['type'], e['state'], e['hostname'], e['servicename'])
+                _id = log.dedup.get(key)
+
+                if _id is not None and _id >= first:
+                    counts[_id] = counts.get(_id, 0) + 1
+                    refs.append((_id, None))
+                elif key in new:
+                    records[new[key]][1] += 1
+                    refs.append((None, new[key]))
+                else:
+                    if key is not None:
+                        new[key] = len(records)
+
+                    values = [ e['source'], e['type'], e['state'],
+                               e['statetype'], e['laststate'],
+                               inet_ntoa(inet_aton(e['ipv4'])), e['ipv6'],
+                               e['hostname'], e['servicename'], e['date'],
+                               e['time'], e['message'] ]
+
+                    refs.append((None, len(records)))
+                    records.append([ encode(e['eventid'], e['lasteventid'],
+                        values), 1, 0, key, e['eventid'], e['lasteventid'],
+                        values ])
+
+            _id = log.append([ r[:3] for r in records ]) if records else None
+
+            for i, r in enumerate(records):
+                self.__index(_id + i, *r[3:])
+
+            for existing, n in counts.items():
+                log.add(existing, n)
+
+        return [ _id + i if existing is None else existing
+                 for existing, i in refs ]
+
+
+    def __index(self, _id, key, eventid, lasteventid, values):
+        """ Index the event `_id` just appended (see EventLog.index). """
+
+        self.log.index(_id, key, values[0], eventid, lasteventid, values[1],
+                       values[2])
+        self.log.followed = _id + 1
+
+
+    def compact(self, days=None):
+        """ Drop the old segments of handled events (see EventLog.compact).
+        """
+
+        return self.log.compact(days)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
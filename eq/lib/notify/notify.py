@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Jorge Morgado <jorge (at) morgado (dot) ch>
+#
+
+"""
+ This module implements the delivery of notifications by email and SMS, a
+pool of reusable SMTP sessions and a token bucket rate limiter per gateway.
+"""
+
+import atexit
+import socket
+import smtplib
+import threading
+from email.mime.text import MIMEText
+from subprocess import call
+from time import sleep, time
+
+try:
+    import Queue as queue   # Python 2
+except ImportError:
+    import queue
+
+__author__     = "Jorge Morgado"
+__copyright__  = "Copyright (c)2014, Jorge Morgado"
+__credits__    = []
+__license__    = "unknown"
+__version__    = "1.0.0"
+__maintainer__ = "Jorge Morgado"
+__email__      = "jorge (at) morgado (dot) ch"
+__status__     = "Production"
+
+# TODO Set this from a configuration file
+# The command used to send SMS via SMPP
+smpp_command = '/usr/local/q/bin/send-sms-smpp'
+
+# TODO Set this from a configuration file
+# The email domain of the SMS gateway (SMS via SMTP)
+sms_domain = 'sms.your.gateway.com'
+
+# Rate limiters and SMTP pools shared by all threads (see get_limiter and
+# get_smtp_pool)
+limiters = {}
+limiters_lock = threading.Lock()
+smtp_pools = {}
+smtp_pools_lock = threading.Lock()
+
+
+def get_limiter(gateway, rate, burst):
+    """ Return the rate limiter of the given gateway, creating it on the
+        first call.
+    """
+
+    with limiters_lock:
+        if gateway not in limiters:
+            limiters[gateway] = TokenBucket(rate, burst)
+
+        return limiters[gateway]
+
+
+def get_smtp_pool(host='localhost', port=25):
+    """ Return the pool of SMTP sessions to the given mail server, creating it
+        on the first call.
+    """
+
+    with smtp_pools_lock:
+        if (host, port) not in smtp_pools:
+            smtp_pools[(host, port)] = SmtpPool(host, port)
+
+        return smtp_pools[(host, port)]
+
+
+@atexit.register
+def close_smtp_pools():
+    """ Politely close (QUIT) the idle SMTP sessions when the process exits.
+    """
+
+    with smtp_pools_lock:
+        for pool in smtp_pools.values():
+            pool.close()
+
+
+class Notifier:
+    'Deliver notifications by email and SMS.'
+
+    def __init__(self, sender, smtp_host='localhost'):
+        """ Send all notifications from the `sender` email address via the
+            `smtp_host` mail server.
+        """
+
+        self.sender = sender
+        self.smtp = get_smtp_pool(smtp_host)
+
+
+    def mail(self, rcpts, subject, body):
+        """ Send an email to the `rcpts` list of addresses.
+        """
+
+        # Create a text/plain message
+        msg = MIMEText(body)
+        msg['Subject'] = subject
+        msg['From'] = self.sender
+        msg['To'] = ','.join(rcpts)
+
+        # Send message via local server, but don't include the envelope header
+        self.smtp.sendmail(self.sender, rcpts, msg.as_string())
+
+        return True
+
+
+    def sms_via_smpp(self, number, message):
+        """ Send the given message by SMS via SMPP. If that fails, send an
+            SMS via SMTP instead (with the error) and return False.
+        """
+
+        ret = False
+
+        # Send SMS via SMPP
+        try:
+            retcode = call([
+                smpp_command,
+                '--destination', number,
+                '--message', message
+            ])
+
+            if retcode < 0:
+                self.sms_via_smtp(number, "SMS via SMPP failed. " \
+                                  "Child exit code = %d\n\n" \
+                                  "Message was:\n" \
+                                  "%s" % (retcode, message))
+            else:
+                ret = True
+        except OSError as e:
+            self.sms_via_smtp(number, "SMS via SMPP failed. " \
+                              "Execution failed: %s\n\n" \
+                              "Message was:\n" \
+                              "%s" % (e, message))
+
+        return ret
+
+
+    def sms_via_smtp(self, number, message):
+        """ Send the given message by SMS via SMTP.
+        """
+
+        rcpt = number + "@" + sms_domain
+
+        # Create a text/plain message
+        msg = MIMEText(message)
+
+        msg['From'] = self.sender
+        msg['To'] = rcpt
+        #msg['Subject'] = ''
+
+        # Send message via local server, but don't include the envelope header
+        self.smtp.sendmail(self.sender, [rcpt], msg.as_string())
+
+        return True
+
+
+class TokenBucket:
+    'A token bucket rate limiter.'
+
+    def __init__(self, rate, burst):
+        """ Allow up to `rate` operations per second on average, with bursts
+            of up to `burst` operations.
+        """
+
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = burst
+        self.last = time()
+        self.lock = threading.Lock()
+
+
+    def acquire(self):
+        """ Take a token, sleeping until one is available. Returns the number
+            of seconds slept (0 when under the rate limit).
+
+        >>> bucket = TokenBucket(10, 2)
+        >>> bucket.acquire(), bucket.acquire()
+        (0, 0)
+        >>> bucket.acquire() > 0
+        True
+        """
+
+        with self.lock:
+            now = time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+            # Tokens might get negative: the waiting time is reserved
+            self.tokens -= 1
+            wait = 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+        if wait:
+            sleep(wait)
+
+        return wait
+
+
+class SmtpPool:
+    'A pool of reusable SMTP sessions to a mail server.'
+
+    def __init__(self, host='localhost', port=25, size=2, max_idle=30):
+        """ Keep up to `size` sessions open to the `host` mail server. A
+            session idle for more than `max_idle` seconds is checked (with
+            NOOP) before being used again.
+        """
+
+        self.host = host
+        self.port = port
+        self.size = size
+        self.max_idle = max_idle
+
+        # Idle sessions (and when they were last used)
+        self.idle = queue.LifoQueue()
+
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        """ Send a message through an open session, reconnecting (and trying
+            once more) if the server has closed it.
+        """
+
+        session = self.__get()
+
+        try:
+            session.sendmail(from_addr, to_addrs, msg)
+        except (smtplib.SMTPServerDisconnected, socket.error):
+            self.__close(session)
+            session = self.__connect()
+            session.sendmail(from_addr, to_addrs, msg)
+        except smtplib.SMTPException:
+            # Refused by the server, but the session is still usable
+            self.__put(session)
+            raise
+
+        self.__put(session)
+
+
+    def close(self):
+        """ Close all idle sessions.
+        """
+
+        while True:
+            try:
+                session, used = self.idle.get_nowait()
+            except queue.Empty:
+                break
+
+            try:
+                session.quit()
+            except Exception:   # catch *all* exceptions
+                pass            # but ignore them as we are closing
+
+
+    def __connect(self):
+        """ Open a new session. """
+
+        return smtplib.SMTP(self.host, self.port)
+
+
+    def __get(self):
+        """ Get an idle (and working) session or open a new one. """
+
+        while True:
+            try:
+                session, used = self.idle.get_nowait()
+            except queue.Empty:
+                return self.__connect()
+
+            if time() - used < self.max_idle:
+                return session
+
+            try:
+                if session.noop()[0] == 250:
+                    return session
+            except (smtplib.SMTPException, socket.error):
+                pass
+
+            self.__close(session)
+
+
+    def __put(self, session):
+        """ Give a session back to the pool (or close it if the pool is full).
+        """
+
+        if self.idle.qsize() < self.size:
+            self.idle.put((session, time()))
+        else:
+            self.__close(session)
+
+
+    def __close(self, session):
+        """ Close a session, ignoring errors. """
+
+        try:
+            session.quit()
+        except Exception:   # catch *all* exceptions
+            try:
+                session.close()
+            except Exception:
+                pass
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
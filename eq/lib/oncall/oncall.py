@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Jorge Morgado <jorge (at) morgado (dot) ch>
+#
+
+"""
+ This module resolves the phone number of the on-call engineer, from the file
+written by set-oncall-phone or, for a given time, from a rota file. Both files
+are kept in memory and only read again when they change.
+
+The rota file has one shift per line (the start and end date/time and the
+phone number), e.g.:
+
+# start            end                number
+2014-06-10 08:00   2014-06-10 20:00   +41790000001
+2014-06-10 20:00   2014-06-11 08:00   +41790000002
+
+To test the module use:
+$ python oncall.py
+"""
+
+import os
+import threading
+from bisect import bisect_right
+from datetime import datetime
+
+__author__     = "Jorge Morgado"
+__copyright__  = "Copyright (c)2014, Jorge Morgado"
+__credits__    = []
+__license__    = "unknown"
+__version__    = "1.0.0"
+__maintainer__ = "Jorge Morgado"
+__email__      = "jorge (at) morgado (dot) ch"
+__status__     = "Production"
+
+# Date and time format of the rota file
+ROTA_FMT = '%Y-%m-%d %H:%M'
+
+# On-call resolvers shared by all threads (see get_oncall)
+resolvers = {}
+resolvers_lock = threading.Lock()
+
+
+def get_oncall(phone_file, rota_file=None):
+    """ Return the on-call resolver of the given files, creating it on the
+        first call.
+    """
+
+    with resolvers_lock:
+        if (phone_file, rota_file) not in resolvers:
+            resolvers[(phone_file, rota_file)] = OnCall(phone_file, rota_file)
+
+        return resolvers[(phone_file, rota_file)]
+
+
+def parse_rota(lines):
+    """ Return the shifts of the rota (sorted by start) as a list of (start,
+        end, number) tuples. Empty lines and comments are skipped.
+
+    >>> parse_rota(['# start end number', '', \
+                    '2014-06-10 20:00 2014-06-11 08:00 +41790000002', \
+                    '2014-06-10 08:00 2014-06-10 20:00 +41790000001'])[0]
+    (datetime.datetime(2014, 6, 10, 8, 0), datetime.datetime(2014, 6, 10, 20, 0), '+41790000001')
+    >>> parse_rota(['2014-06-10 08:00 +41790000001'])
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid rota line: 2014-06-10 08:00 +41790000001
+    """
+
+    shifts = []
+
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        fields = line.split()
+        if len(fields) != 5:
+            raise ValueError("Invalid rota line: %s" % line)
+
+        shifts.append((
+            datetime.strptime(' '.join(fields[0:2]), ROTA_FMT),
+            datetime.strptime(' '.join(fields[2:4]), ROTA_FMT),
+            fields[4],
+        ))
+
+    return sorted(shifts)
+
+
+class OnCall:
+    'The phone number of the on-call engineer.'
+
+    def __init__(self, phone_file, rota_file=None):
+        """ Read the current on-call number from `phone_file` and the
+            numbers by time from `rota_file` (if given).
+        """
+
+        self.phone_file = phone_file
+        self.rota_file = rota_file
+        self.lock = threading.Lock()
+
+        # The signature (see __signature) and contents of each file
+        self.phone_sig = None
+        self.phone = None
+        self.rota_sig = None
+        self.starts = []
+        self.shifts = []
+
+
+    def number(self, when=None):
+        """ Return the phone number of the on-call at `when` (a datetime)
+            from the rota or, if not given or not found in the rota, the
+            current one. Returns None if not found.
+
+        >>> import tempfile
+        >>> d = tempfile.mkdtemp()
+        >>> _ = open(d + '/phone', 'w').write('+41790000000')
+        >>> _ = open(d + '/rota', 'w').write(\
+                '2014-06-10 08:00 2014-06-10 20:00 +41790000001\\n')
+        >>> oncall = OnCall(d + '/phone', d + '/rota')
+        >>> oncall.number()
+        '+41790000000'
+        >>> oncall.number(datetime(2014, 6, 10, 9, 30))
+        '+41790000001'
+        >>> oncall.number(datetime(2014, 6, 10, 20, 0))
+        '+41790000000'
+        >>> OnCall(d + '/nonexistent').number() is None
+        True
+        """
+
+        with self.lock:
+            if when is not None and self.rota_file is not None:
+                self.__load_rota()
+
+                # The last shift started by then (if not over yet)
+                i = bisect_right(self.starts, when) - 1
+                if i >= 0 and when < self.shifts[i][1]:
+                    return self.shifts[i][2]
+
+            self.__load_phone()
+
+            return self.phone
+
+
+    def __signature(self, path):
+        """ Return the signature of a file (None if it doesn't exist): if it
+            doesn't change, neither did the file.
+        """
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+
+        return (st.st_ino, st.st_mtime, st.st_size)
+
+
+    def __load_phone(self):
+        """ Read the phone file (again) if it has changed. """
+
+        sig = self.__signature(self.phone_file)
+        if sig == self.phone_sig:
+            return
+
+        self.phone = None
+        if sig is not None:
+            f = open(self.phone_file, 'r')
+            self.phone = f.read()
+            f.close()
+
+        self.phone_sig = sig
+
+
+    def __load_rota(self):
+        """ Read the rota file (again) if it has changed. """
+
+        sig = self.__signature(self.rota_file)
+        if sig == self.rota_sig:
+            return
+
+        shifts = []
+        if sig is not None:
+            f = open(self.rota_file, 'r')
+            try:
+                shifts = parse_rota(f)
+            except ValueError as e:
+                print("Err %s" % e)
+            f.close()
+
+        self.shifts = shifts
+        self.starts = [ s[0] for s in shifts ]
+        self.rota_sig = sig
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Jorge Morgado <jorge (at) morgado (dot) ch>
+#
+
+"""
+ This module implements the notification outbox: the q scripts enqueue the
+rendered notifications (see Q.use_outbox) and the eq-dispatch workers claim
+and deliver them.
+
+Notifications are enqueued on the queue's database connection, so they are
+committed in the same transaction as the handled state of their events:
+either both are written or none. Each notification has a key (computed from
+its recipient and events) so that it is never enqueued twice. Delivery is
+at-least-once: if a worker dies after sending a notification but before
+recording it, the notification is sent again after its lease expires.
+"""
+
+import sys
+import hashlib
+
+sys.path.append('..')
+from db.db import Db
+from dbevent.dbevent import BACKEND, POOL_SIZE, SQLITE_PATH, SQLITE_SCHEMA
+from sqlitedb.sqlitedb import SqliteDb
+
+__author__     = "Jorge Morgado"
+__copyright__  = "Copyright (c)2014, Jorge Morgado"
+__credits__    = []
+__license__    = "unknown"
+__version__    = "1.0.0"
+__maintainer__ = "Jorge Morgado"
+__email__      = "jorge (at) morgado (dot) ch"
+__status__     = "Production"
+
+# Notification channels
+MAIL = 'mail'
+SMS  = 'sms'
+
+# Notification states
+PENDING = 'pending'
+SENDING = 'sending'
+SENT    = 'sent'
+FAILED  = 'failed'
+
+
+def outbox_key(channel, rcpt, ids):
+    """ Return the key of the notification sent to `rcpt` via `channel` for
+        the events `ids` (as 20 raw bytes).
+
+    >>> len(outbox_key(MAIL, 'eq-admin@your.domain.com', [ 1 ]))
+    20
+    >>> outbox_key(SMS, '123', [ 1, 2 ]) == outbox_key(SMS, '123', [ 2, 1 ])
+    True
+    >>> outbox_key(SMS, '123', [ 1 ]) == outbox_key(MAIL, '123', [ 1 ])
+    False
+    """
+
+    value = '\x1f'.join([ channel, rcpt ] + [ str(i) for i in sorted(ids) ])
+
+    return hashlib.sha1(value.encode('utf-8')).digest()
+
+
+class Outbox:
+    'Common base class for the outbox of notifications.'
+
+    def __init__(self):
+        # Connections are taken from the same pool as the queue's (so the
+        # outbox of a thread shares its connection and transaction)
+        if BACKEND == 'sqlite':
+            self.db = SqliteDb(SQLITE_PATH, SQLITE_SCHEMA,
+                               pool_size=POOL_SIZE)
+        else:
+            self.db = Db('qapi', 'password', 'event', pool_size=POOL_SIZE)
+
+
+    def __del__(self):
+        self.close()
+
+
+    def close(self):
+        """ Close the database connection (and commit data). """
+
+        self.db.close()
+
+
+    def commit(self):
+        """ Commit all changes done so far. """
+
+        self.db.commit()
+
+
+    def enqueue(self, key, channel, rcpt, body, subject=None, proto=None):
+        """ Add a notification to the outbox, unless one with the same `key`
+            was already added. Returns the ID of the notification.
+        """
+
+        # Not INSERT IGNORE: the warning it raises on a duplicate key would
+        # be an error (the connection is shared, see raise_on_warnings)
+        return self.db.upsert('outbox', {
+                'dedupkey': [ '%(dedupkey)s', key     ],
+                'channel' : [ '%(channel)s',  channel ],
+                'proto'   : [ '%(proto)s',    proto   ],
+                'rcpt'    : [ '%(rcpt)s',     rcpt    ],
+                'subject' : [ '%(subject)s',  subject ],
+                'body'    : [ '%(body)s',     body    ],
+                'nextts'  : [ 'NOW()',        None    ],
+            }, {
+                'dedupkey': 'VALUES(dedupkey)',
+            })
+
+
+    def claim(self, worker, limit=10, lease=300):
+        """ Claim up to `limit` notifications due for delivery (including the
+            ones whose previous worker didn't finish within `lease` seconds)
+            for the given `worker`, and commit. Returns a list of tuples
+            (id, channel, proto, rcpt, subject, body, attempts).
+        """
+
+        claimed = self.db.execute(
+            'UPDATE outbox SET state = %(sending)s, claimedby = %(worker)s, '
+            'attempts = attempts + 1, '
+            'nextts = NOW() + INTERVAL %(lease)s SECOND '
+            'WHERE state IN (%(pending)s, %(sending)s) AND nextts <= NOW() '
+            'ORDER BY id LIMIT %(limit)s', {
+                'pending' : PENDING,
+                'sending' : SENDING,
+                'worker'  : worker,
+                'lease'   : lease,
+                'limit'   : limit,
+            })
+
+        self.db.commit()
+
+        if not claimed:
+            return []
+
+        return self.db.query(
+            'SELECT id, channel, proto, rcpt, subject, body, attempts '
+            'FROM outbox WHERE state = %(sending)s AND claimedby = %(worker)s '
+            'ORDER BY id', {
+                'sending' : SENDING,
+                'worker'  : worker,
+            })
+
+
+    def sent(self, _id, note=None):
+        """ Record the notification as delivered (and commit). """
+
+        self.__set_state(_id, SENT, note)
+
+
+    def retry(self, _id, error, delay):
+        """ Record a failed delivery, to be retried in `delay` seconds (and
+            commit).
+        """
+
+        self.__set_state(_id, PENDING, error, delay)
+
+
+    def fail(self, _id, error):
+        """ Record the notification as undeliverable (and commit). """
+
+        self.__set_state(_id, FAILED, error)
+
+
+    def __set_state(self, _id, state, error=None, delay=0):
+        """ Set the state of a claimed notification and commit. """
+
+        self.db.execute(
+            'UPDATE outbox SET state = %(state)s, error = %(error)s, '
+            'nextts = NOW() + INTERVAL %(delay)s SECOND '
+            'WHERE id = %(id)s', {
+                'id'    : _id,
+                'state' : state,
+                'error' : None if error is None else str(error)[:255],
+                'delay' : delay,
+            })
+
+        self.db.commit()
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -11,15 +11,16 @@ to the event queue.
 
 import os
 import sys
-import smtplib
-from datetime import datetime
-from email.mime.text import MIMEText
-from time import sleep
-from subprocess import call
+from datetime import datetime, timedelta
+from time import sleep, time
 
 sys.path.append('../lib')
-from dbevent.dbevent import DbEvent
-from event.event import Event
+from dbevent.dbevent import connect, match_filters
+from event.event import Event, MAILSENT, SMSSENT
+from notify.notify import Notifier, get_limiter
+from oncall.oncall import get_oncall
+from outbox.outbox import Outbox, outbox_key, MAIL, SMS
+from rule.rule import Rule, RuleIndex
 
 __author__     = "Jorge Morgado"
 __copyright__  = "Copyright (c)2014, Jorge Morgado"
@@ -41,12 +42,50 @@ class Q:
     # The relative path to the file that holds the on-call phone number
     oncall_phone_file = "../../var/set-oncall-phone"
 
+    # TODO Set this from a configuration file
+    # The relative path to the on-call rota (numbers by time, see oncall.py)
+    oncall_rota_file = "../../var/oncall-rota"
+
+    # TODO Set this from a configuration file
+    # Changes to the events' handled state are buffered and written (and
+    # committed) at once when there are flush_size of them or flush_interval
+    # seconds after the previous write
+    flush_size = 100
+    flush_interval = 5
+
+    # TODO Set this from a configuration file
+    # The mail server used to send emails (and SMS via SMTP)
+    smtp_host = 'localhost'
+
+    # TODO Set this from a configuration file
+    # Maximum rate (messages per second) and burst of messages sent to each
+    # gateway, to prevent hammering them
+    rate_limits = {
+        'mail': (4, 10),
+        'sms':  (4, 10),
+    }
+
+    # TODO Set this from a configuration file
+    # In checkpointed mode (see checkpoint), the watermark is not moved past
+    # events younger than this (in seconds), as events inserted at the same
+    # time might be committed out of order (i.e., with a lower id)
+    checkpoint_grace = 60
+
+    # TODO Set this from a configuration file
+    # Maximum length of the SMS sent in digest mode (see digest)
+    sms_digest_length = 160
+
+    # TODO Set this from a configuration file
+    # For how many of the next events of a scan the antecessors are fetched
+    # along (see find_last_event)
+    predecessor_window = 500
+
     # The following protocols can be used when sending SMS
     SMPP = 1
     SMTP = 2
 
 
-    def __init__(self):
+    def __init__(self, ts_max=None):
         """ Initialize the queue for normal operations.
         """
 
@@ -56,23 +95,112 @@ class Q:
         # date/time to ensure newer events (which might arrive after processing
         # has started) won't be processed. If not provided as an argument to
         # the q-script, takes the system's date/time when each script runs.
-        self.ts_max = sys.argv[2] \
-            if len(sys.argv) > 2 \
-            else datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        if ts_max is not None:
+            self.ts_max = ts_max
+        else:
+            self.ts_max = sys.argv[2] \
+                if len(sys.argv) > 2 \
+                else datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
         # Open the database connection
-        self.db = DbEvent()
+        self.db = connect()
+
+        # Notifications are sent right away, unless an outbox is used (see
+        # use_outbox)
+        self.notifier = Notifier(self.oncall_email_address, self.smtp_host)
+        self.outbox = None
+
+        # The on-call phone numbers (the files are read only when changed)
+        realpath = os.path.dirname(os.path.realpath(__file__))
+        self.oncall = get_oncall(realpath + "/" + self.oncall_phone_file,
+                                 realpath + "/" + self.oncall_rota_file)
 
         # At init time, there is no event set
         self.event = None
 
+        # The running script (see checkpoint)
+        self.script = sys.argv[1] if len(sys.argv) > 1 else None
+
+        # The watermark of the checkpointed mode (see checkpoint)
+        self.watermark = None
+
+        # The rules registered by the script (see rule)
+        self.rules = []
+
+        # Unhandled events loaded once and shared by several scripts (see
+        # load_unhandled) and the iterator walking over them
+        self.snapshot = None
+        self.cursor = None
+
+        # Loads the message of the events fetched without it (see
+        # first_unhandled)
+        self.loader = None
+
+        # Antecessors not found (source and event id) until the next commit
+        # and the position of the events in the snapshot (see
+        # find_last_event)
+        self.missing = set()
+        self.snapshot_pos = None
+
+        # Buffered handled-state changes (event id -> handled value)
+        self.marks = {}
+        self.last_flush = time()
+
+        # Digest mode (see digest): events collected per recipient and the
+        # bits they will set once sent (event id -> handled bits)
+        self.digest_window = None
+        self.digests = {}
+        self.held = {}
+
+        # The lowest id of the events whose digest could not be sent, per
+        # script: the watermark is not moved past them (see commit)
+        self.unsent = {}
+
 
     def __del__(self):
         """ Finalize the queue.
         """
 
-        # Destroy the database instance (and commit data)
-        del self.db
+        self.close()
+
+
+    def close(self):
+        """ Send the collected digests, write the pending changes and close
+            the database connection.
+        """
+
+        if self.db is None:
+            return
+
+        self.send_digests()
+
+        if self.outbox is not None:
+            self.outbox.close()
+            self.outbox = None
+
+        # Close the database instance (and commit data)
+        self.db.close()
+        self.db = None
+
+
+    def reset(self):
+        """ Restore the settings a script may change (digest mode, outbox,
+            deferred messages, streaming, checkpointed mode and rules) to
+            their defaults, so they don't leak into the next script run on the
+            same queue instance (see Engine). Collected digests are sent first.
+        """
+
+        self.send_digests()
+        self.digest_window = None
+
+        if self.outbox is not None:
+            self.outbox.close()
+            self.outbox = None
+
+        self.loader = None
+        self.db.stream(None)
+        self.watermark = None
+        self.rules = []
 
 
     def age(self):
@@ -96,31 +224,37 @@ class Q:
         sleep(secs)
 
 
-    def whoisoncall(self):
-        """ Return the phone number of the current on-call or None if not found.
+    def throttle(self, gateway):
+        """ Wait until a message can be sent to the given gateway without
+            exceeding its rate limit.
         """
 
-        number = None
+        rate, burst = self.rate_limits[gateway]
+        get_limiter(gateway, rate, burst).acquire()
 
-        # TODO realpath is not needed if the on-call phone number would be set
-        # TODO from a configuration file (see class constructor)
-        # Find the real and absolute path of this file
-        realpath = os.path.dirname(os.path.realpath(__file__))
-        phone_file = realpath + "/" + self.oncall_phone_file
 
-        if os.path.exists(phone_file):
-            f = open(phone_file, 'r')
-            number = f.read()
-            f.close()
+    def use_outbox(self):
+        """ Enqueue the notifications in the outbox (to be delivered by the
+            eq-dispatch workers) instead of sending them right away.
+        """
+
+        self.outbox = Outbox()
+
 
-        return number
+    def whoisoncall(self, when=None):
+        """ Return the phone number of the current on-call or None if not found.
+            If `when` (a datetime, e.g. q.event.ts()) is given, return the
+            on-call at that time according to the rota, if any.
+        """
+
+        return self.oncall.number(when)
 
 
     def ignore(self):
         """ Mark the current event as 'to be ignored'.
         """
 
-        self.db.set_handled(self.event.id(), self.event.set_ignored())
+        self.__mark(self.event.set_ignored())
         return True
 
 
@@ -136,44 +270,17 @@ class Q:
         if self.event is None:
             return False
 
-        # Set some fields depending if this is a host or service event
-        if not self.event.servicename():
-            origin = 'HOST'
-            subj = "%s on %s (state: %s) - Host" % \
-                   (self.event.type(), self.event.hostname(), \
-                   self.event.state())
-            desc = "Host: %s (%s)" % \
-                   (self.event.hostname(), self.event.ipv4())
-        else:
-            origin = 'SERVICE'
-            subj = "%s on %s (state: %s) - Service '%s'" % \
-                   (self.event.type(), self.event.hostname(), \
-                   self.event.state(), self.event.servicename())
-            desc = "Service: '%s' on %s" % \
-                   (self.event.servicename(), self.event.hostname())
-
-        # Create a text/plain message
-        msg = MIMEText("**EQ %s event**\n\nType: %s\n%s\nState: %s\n" \
-                       "Sent on: %s %s\nReceived on: %s\nSource: %s\n" \
-                       "Event count: %d\n----\n%s" % \
-                       (origin, self.event.type(), desc, self.event.state(), \
-                        self.event.date(), self.event.time(), \
-                        self.event.ts(), self.event.source(), \
-                        self.event.count(), self.event.message()))
-        msg['Subject'] = subj
-        msg['From'] = self.oncall_email_address
-        msg['To'] = ','.join(email)
-
-        # Send message via local server, but don't include the envelope header
-        s = smtplib.SMTP('localhost')
-        s.sendmail(self.oncall_email_address, email, msg.as_string())
-        s.quit()
+        # In digest mode, the event is sent (and marked) later along with
+        # others
+        if self.digest_window is not None:
+            self.__hold(('mail', tuple(email)), MAILSENT)
+            return True
 
-        # Mark the event as 'mail has been sent'
-        self.db.set_handled(self.event.id(), self.event.set_mailsent())
+        subj, body = self.__mail_text(self.event)
+        self.__send_mail(email, subj, body, [ self.event.id() ])
 
-        # Sleep between emails to prevent hammering the remote gateway
-        self.sleep(.25)
+        # Mark the event as 'mail has been sent'
+        self.__mark(self.event.set_mailsent())
 
         return True
 
@@ -182,52 +289,14 @@ class Q:
         """ Send the given message by SMS via SMPP.
         """
 
-        ret = False
-
-        # Send SMS via SMPP
-        try:
-            retcode = call([
-                '/usr/local/q/bin/send-sms-smpp',
-                '--destination', number,
-                '--message', message
-            ])
-
-            if retcode < 0:
-                self.send_sms_via_smtp(number, "SMS via SMPP failed. " \
-                                    "Child exit code = %d\n\n" \
-                                    "Message was:\n" \
-                                    "%s" % (retcode, message))
-            else:
-                ret = True
-        except OSError as e:
-            message = ("Execution failed: ", e) + "\n\n" + message
-            self.send_sms_via_smtp(number, "SMS via SMPP failed. " \
-                                "Execution failed: %s\n\n" \
-                                "Message was:\n" \
-                                "%s" % (e, message))
-
-        return ret
+        return self.notifier.sms_via_smpp(number, message)
 
 
     def send_sms_via_smtp(self, number, message):
         """ Send the given message by SMS via SMTP.
         """
 
-        rcpt = number + "@sms.your.gateway.com"
-
-        # Create a text/plain message
-        msg = MIMEText(message)
-
-        msg['From'] = self.oncall_email_address
-        msg['To'] = rcpt
-        #msg['Subject'] = ''
-
-        # Send message via local server, but don't include the envelope header
-        s = smtplib.SMTP('localhost')
-        s.sendmail(self.oncall_email_address, [rcpt], msg.as_string())
-        s.quit()
-
-        return True
+        return self.notifier.sms_via_smtp(number, message)
 
 
     def sendsms(self, number, proto=SMPP):
@@ -238,24 +307,278 @@ class Q:
         if number is None or self.event is None:
             return False
 
+        # In digest mode, the event is sent (and marked) later along with
+        # others. If the digest can't be sent via SMPP, it is sent via SMTP
+        # (see send_digests).
+        if self.digest_window is not None:
+            self.__hold(('sms', number, proto), SMSSENT)
+            return True
+
+        # Mark the event as 'SMS has been sent'
+        self.__mark(self.event.set_smssent())
+
+        return self.__send_sms(number, proto, self.__sms_text(self.event),
+                               [ self.event.id() ])
+
+
+    def digest(self, window=60):
+        """ Enable the digest mode: instead of one message per event, the
+            events sent to the same recipient are collected and sent at once
+            (as a single message) when the script ends, or `window` seconds
+            after the first one was collected. Set `window` to None to send
+            one message per event again.
+        """
+
+        if window is None:
+            self.send_digests()
+
+        self.digest_window = window
+
+
+    def send_digests(self, expired=False):
+        """ Send the collected events (only the ones collected more than
+            digest_window seconds ago if `expired` is True), one message per
+            recipient, and mark them all as sent at once. Only the bit of
+            the digests actually sent is set: the events of a digest not
+            sent are left as they are.
+        """
+
+        now = time()
+
+        for key in sorted(self.digests):
+            started, events = self.digests[key]
+            if expired and now - started < self.digest_window:
+                continue
+
+            del self.digests[key]
+
+            try:
+                sent = self.__send_digest(key, events)
+            except Exception as e:
+                sys.stderr.write("Err %s: %s\n" % (key, e))
+                self.__unsent(events)
+                continue
+
+            if not sent:
+                sys.stderr.write("Err %s: digest not sent\n" % (key,))
+                self.__unsent(events)
+                continue
+
+            for event in events:
+                if key[0] == 'mail':
+                    self.marks[event.id()] = event.set_mailsent()
+                else:
+                    self.marks[event.id()] = event.set_smssent()
+
+        # Write all marks of the digests sent at once
+        self.held = {}
+        for key, (started, events) in self.digests.items():
+            bit = 1 << (MAILSENT if key[0] == 'mail' else SMSSENT)
+            for event in events:
+                self.held[event.id()] = self.held.get(event.id(), 0) | bit
+        self.flush()
+
+
+    def __unsent(self, events):
+        """ Keep the lowest id of the given events, whose digest could not
+            be sent, so they are processed again by the next run (see
+            commit).
+        """
+
+        lowest = min([ e.id() for e in events ])
+        self.unsent[self.script] = min(self.unsent.get(self.script, lowest),
+                                       lowest)
+
+
+    def __send_digest(self, key, events):
+        """ Send the digest of the recipient `key`. A SMS digest that can't
+            be sent via SMPP is sent via SMTP (as the scripts do for single
+            events). Returns True if it was sent.
+        """
+
+        if key[0] == 'mail':
+            return self.__send_mail_digest(list(key[1]), events)
+
+        number, proto = key[1], key[2]
+        if proto == self.SMTP:
+            return self.__send_sms_digest(number, proto, events)
+
+        try:
+            if self.__send_sms_digest(number, proto, events):
+                return True
+        except Exception as e:
+            sys.stderr.write("Err %s: %s\n" % (key, e))
+
+        return self.__send_sms_digest(number, self.SMTP, events)
+
+
+    def __hold(self, key, bit):
+        """ Collect the current event in the digest of the given recipient
+            `key`. The handled `bit` is only set once the digest is sent
+            (see send_digests).
+        """
+
+        if key not in self.digests:
+            self.digests[key] = (time(), [])
+
+        self.digests[key][1].append(self.event)
+        self.held[self.event.id()] = self.held.get(self.event.id(), 0) \
+                                     | (1 << bit)
+
+        started = min(started for started, events in self.digests.values())
+        if time() - started >= self.digest_window:
+            self.send_digests(expired=True)
+
+
+    def __mail_text(self, event):
+        """ Return the subject and body of the email of the given event.
+        """
+
         # Set some fields depending if this is a host or service event
-        if self.event.servicename():
+        if not event.servicename():
+            origin = 'HOST'
+            subj = "%s on %s (state: %s) - Host" % \
+                   (event.type(), event.hostname(), event.state())
+            desc = "Host: %s (%s)" % \
+                   (event.hostname(), event.ipv4())
+        else:
+            origin = 'SERVICE'
+            subj = "%s on %s (state: %s) - Service '%s'" % \
+                   (event.type(), event.hostname(), \
+                   event.state(), event.servicename())
+            desc = "Service: '%s' on %s" % \
+                   (event.servicename(), event.hostname())
+
+        body = "**EQ %s event**\n\nType: %s\n%s\nState: %s\n" \
+               "Sent on: %s %s\nReceived on: %s\nSource: %s\n" \
+               "Event count: %d\n----\n%s" % \
+               (origin, event.type(), desc, event.state(), \
+                event.date(), event.time(), \
+                event.ts(), event.source(), \
+                event.count(), event.message())
+
+        return subj, body
+
+
+    def __sms_text(self, event):
+        """ Return the SMS text of the given event.
+        """
+
+        # Set some fields depending if this is a host or service event
+        if event.servicename():
             desc = "EQ Service '%s' on %s" % \
-                   (self.event.servicename(), self.event.hostname())
+                   (event.servicename(), event.hostname())
         else:
             desc = "EQ Host %s" % \
-                   (self.event.hostname())
+                   (event.hostname())
 
-        message = "%s/%s, %s. Info: %s. Time: %s %s" % \
-                  (self.event.type(), self.event.state(),
-                   desc, self.event.message(),
-                   self.event.date(), self.event.time())
+        return "%s/%s, %s. Info: %s. Time: %s %s" % \
+               (event.type(), event.state(), desc, event.message(),
+                event.date(), event.time())
 
-        # Mark the event as 'SMS has been sent'
-        self.db.set_handled(self.event.id(), self.event.set_smssent())
 
-        # Sleep between SMS to prevent hammering the remote gateway
-        self.sleep(.25)
+    def __group(self, events):
+        """ Group the given events by host, service, type and state. Returns
+            a sorted list of (hostname, servicename, type, state, events).
+        """
+
+        groups = {}
+        for event in events:
+            key = (event.hostname() or '', event.servicename() or '',
+                   event.type() or '', event.state() or '')
+            groups.setdefault(key, []).append(event)
+
+        return [key + (groups[key],) for key in sorted(groups)]
+
+
+    def __send_mail_digest(self, email, events):
+        """ Send the given events to email, in a single message.
+        """
+
+        if len(events) == 1:
+            subj, body = self.__mail_text(events[0])
+            return self.__send_mail(email, subj, body, [ events[0].id() ])
+
+        groups = self.__group(events)
+        hosts = sorted(set(g[0] for g in groups))
+
+        subj = "EQ digest: %d events on %d hosts" % (len(events), len(hosts))
+        lines = ["**EQ digest of %d events**" % len(events)]
+
+        previous = None
+        for host, service, etype, state, evs in groups:
+            # One paragraph per host
+            if host != previous:
+                lines.extend(['', "Host: %s (%s)" % (host, evs[-1].ipv4())])
+                previous = host
+
+            last = evs[-1]
+            what = "Service '%s'" % service if service else "Host"
+            lines.append("  %s: %s/%s (x%d), last sent on %s %s: %s" %
+                         (what, etype, state, len(evs), last.date(),
+                          last.time(), last.message()))
+
+        return self.__send_mail(email, subj, "\n".join(lines) + "\n",
+                                [ e.id() for e in events ])
+
+
+    def __send_sms_digest(self, number, proto, events):
+        """ Send the given events to SMS, in a single (truncated) message.
+        """
+
+        if len(events) == 1:
+            return self.__send_sms(number, proto, self.__sms_text(events[0]),
+                                   [ events[0].id() ])
+
+        hosts = []
+        for host, service, etype, state, evs in self.__group(events):
+            text = "%s %s%s" % (service or 'Host', state,
+                                "" if len(evs) == 1 else " x%d" % len(evs))
+            if hosts and hosts[-1][0] == host:
+                hosts[-1][1].append(text)
+            else:
+                hosts.append((host, [text]))
+
+        message = "EQ digest: %d events. %s" % \
+                  (len(events),
+                   "; ".join("%s: %s" % (h, ", ".join(t)) for h, t in hosts))
+
+        if len(message) > self.sms_digest_length:
+            message = message[:self.sms_digest_length - 3] + "..."
+
+        return self.__send_sms(number, proto, message,
+                               [ e.id() for e in events ])
+
+
+    def __send_mail(self, email, subj, body, ids):
+        """ Send an email with the given subject and body about the events
+            `ids` (or add it to the outbox).
+        """
+
+        if self.outbox is not None:
+            rcpt = ','.join(email)
+            self.outbox.enqueue(outbox_key(MAIL, rcpt, ids), MAIL, rcpt, body,
+                                subject=subj)
+            return True
+
+        # Wait for our turn to prevent hammering the remote gateway
+        self.throttle('mail')
+
+        return self.notifier.mail(email, subj, body)
+
+
+    def __send_sms(self, number, proto, message, ids):
+        """ Send the given message about the events `ids` by SMS via the
+            specified protocol (or add it to the outbox).
+        """
+
+        if self.outbox is not None:
+            self.outbox.enqueue(outbox_key(SMS, number, ids), SMS, number,
+                                message, proto=proto)
+            return True
+
+        # Wait for our turn to prevent hammering the remote gateway
+        self.throttle('sms')
 
         if proto == self.SMTP:
             return self.send_sms_via_smtp(number, message)
@@ -264,10 +587,189 @@ class Q:
             return self.send_sms_via_smpp(number, message)
 
 
+    def rule(self, **conditions):
+        """ Decorator registering a function to be called for each unhandled
+            event matching all `conditions` (see rule.py), with the event set
+            as q.event. The function must not move the cursor (e.g., with
+            q.next()). The rules are run (see run_rules) after the script.
+        """
+
+        def register(func):
+            self.rules.append(Rule(func, conditions, self.script))
+            return func
+
+        return register
+
+
+    def run_rules(self):
+        """ Run the registered rules over the unhandled events, in order: each
+            event is passed to all the rules it matches, as a loop over
+            first_unhandled() testing each rule's conditions would do.
+            Returns the number of rules called.
+        """
+
+        index = RuleIndex(self.rules)
+        self.rules = []
+        called = 0
+
+        self.first_unhandled()
+
+        while self.event is not None:
+            for rule in index.match(self.event):
+                rule.func()
+                called += 1
+
+            self.next()
+
+        return called
+
+
+    def commit(self):
+        """ Send the collected digests (if any) and commit all changes done so
+            far to the queue (and move the watermark in checkpointed mode,
+            but not past the events whose digest could not be sent).
+        """
+
+        self.send_digests()
+
+        w = self.watermark
+        if w is not None and self.script in self.unsent:
+            w['next'] = min(w['next'], self.unsent[self.script] - 1)
+
+        if w is not None and w['next'] > w['lastid']:
+            self.db.set_watermark(w['name'], w['next'])
+            w['lastid'] = w['next']
+            self.db.commit()
+
+        # The antecessors not found might arrive by the next run, and the
+        # ones found might be changed by other processes meanwhile
+        self.missing = set()
+        self.db.clear_cache()
+
+
+    def flush(self):
+        """ Write the buffered handled-state changes, one statement per
+            handled value, and commit them.
+        """
+
+        ids = {}
+        for _id, handled in self.marks.items():
+            ids.setdefault(handled, []).append(_id)
+
+        for handled in ids:
+            self.db.set_handled_many(sorted(ids[handled]), handled)
+
+        # The notifications added to the outbox share the connection, so they
+        # are committed along with the handled state of their events
+        self.db.commit()
+
+        self.marks = {}
+        self.last_flush = time()
+
+
+    def __mark(self, handled):
+        """ Buffer the new handled value of the current event (see flush).
+        """
+
+        self.marks[self.event.id()] = handled
+
+        if len(self.marks) >= self.flush_size \
+            or time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+
+    def stream(self, chunk=1000):
+        """ Stream the events of the next scans, fetching `chunk` events at a
+            time instead of the whole queue at once. Use this when scanning
+            (lots of) events with first(), for example.
+        """
+
+        self.db.stream(chunk)
+
+
+    def checkpoint(self, name=None, grace=None, since=None):
+        """ Switch to the checkpointed mode: from now on, first_unhandled()
+            only returns the events above the watermark `name` (by default,
+            the script's file name), i.e., the events that arrived after the
+            previous run. On commit, the watermark is moved past the events
+            visited, so the events left unhandled are not returned again.
+            The watermark is never moved past events younger than `grace`
+            seconds (checkpoint_grace by default). Use `since` to (re)process
+            the events from the given id on. Returns the watermark.
+        """
+
+        if name is None:
+            name = os.path.basename(self.script)
+
+        if grace is None:
+            grace = self.checkpoint_grace
+
+        if since is None:
+            since = self.db.get_watermark(name)
+
+        self.watermark = {
+            'name'  : name,
+            'lastid': since,
+            'next'  : since,
+            'stop'  : False,
+            'scan'  : False,
+            'cutoff': datetime.strptime(self.ts_max, '%Y-%m-%d %H:%M:%S') \
+                      - timedelta(seconds=grace),
+        }
+
+        return since
+
+
+    def __advance(self, event):
+        """ Move the next watermark past the given (visited) event, unless
+            a too young event was visited before.
+        """
+
+        w = self.watermark
+        if w is None or event is None or w['stop'] or not w['scan']:
+            return
+
+        if event.ts() is not None and event.ts() < w['cutoff']:
+            w['next'] = max(w['next'], event.id())
+        else:
+            w['stop'] = True
+
+
+    def __end_scan(self):
+        """ Stop walking over the snapshot and moving the watermark (a scan
+            of all events is starting).
+        """
+
+        self.cursor = None
+
+        if self.watermark is not None:
+            self.watermark['scan'] = False
+
+
+    def load_unhandled(self, since=None):
+        """ Fetch all unhandled events (whose id is greater than `since`, if
+            given) once and keep them in memory. From now on,
+            first_unhandled() walks over this snapshot instead of querying
+            the database again, skipping the events that have been handled in
+            the meantime. Returns the number of events loaded.
+        """
+
+        self.snapshot = []
+
+        row = self.db.find_all_unhandled(self.ts_max, since)
+        while row is not None:
+            self.snapshot.append(Event(row))
+            row = self.db.find_next()
+
+        return len(self.snapshot)
+
+
     def first(self):
         """ Set the cursor to the first event in the queue.
         """
 
+        self.__end_scan()
+        self.loader = None
         row = self.db.find_all(self.ts_max)
         self.event = None if row is None else Event(row)
 
@@ -278,18 +780,51 @@ class Q:
         """ Set the cursor to the first heartbeat events.
         """
 
+        self.__end_scan()
+        self.loader = None
         row = self.db.find_heartbeat(self.ts_max)
         self.event = None if row is None else Event(row)
 
         return self.event
 
 
-    def first_unhandled(self):
-        """ Set the cursor to the first unhandled event in the queue.
+    def first_unhandled(self, defer=False, **filters):
+        """ Set the cursor to the first unhandled event in the queue (above
+            the watermark in checkpointed mode).
+
+            Only the events matching the `filters` are returned, e.g.:
+
+                q.first_unhandled(source='nagios1', type=['PROBLEM', 'RECOVERY'],
+                                  servicename__startswith='HTTP',
+                                  ts__gte='2014-06-01 00:00:00')
+
+            Filters are `column` (equal to the value or, for a list, to any
+            of the values) or `column__op`, where op is startswith, like
+            (SQL pattern), gt, gte, lt or lte. They are evaluated by the
+            database, so only the candidate events are fetched. In
+            checkpointed mode, a filtered scan does not move the watermark
+            (it did not visit all events).
+
+            If `defer` is set, the message of the events is only fetched
+            when it is accessed (use it if most events are not notified).
         """
 
-        row = self.db.find_all_unhandled(self.ts_max)
-        self.event = None if row is None else Event(row)
+        since = None
+        if self.watermark is not None:
+            since = self.watermark['lastid']
+            self.watermark['scan'] = not filters
+
+        if self.snapshot is not None:
+            # Only the events left unhandled by the previous scripts
+            self.cursor = (e for e in self.snapshot if not e.is_handled() \
+                                and (since is None or e.id() > since) \
+                                and (not filters or match_filters(e, filters)))
+            return self.next()
+
+        self.loader = self.db.find_message if defer else None
+        row = self.db.find_all_unhandled(self.ts_max, since, filters, defer)
+        self.event = None if row is None else Event(row, self.loader)
+        self.__advance(self.event)
 
         return self.event
 
@@ -298,31 +833,94 @@ class Q:
         """ Set the cursor to the next event or None if no more events exits.
         """
 
+        if self.cursor is not None:
+            self.event = next(self.cursor, None)
+            if self.event is None:
+                self.cursor = None
+
+            self.__advance(self.event)
+
+            return self.event
+
         row = self.db.find_next()
-        self.event = None if row is None else Event(row)
+        self.event = None if row is None else Event(row, self.loader)
+        self.__advance(self.event)
 
         return self.event
 
 
+    def prefetch(self, events):
+        """ Fetch the antecessors of the given events (see find_last_event)
+            at once. They are cached by the database layer (see
+            DbEvent.find_eventids). Returns a dictionary (source, event id)
+            -> row of the antecessors found.
+        """
+
+        pairs = set([ (e.source(), e.lasteventid()) for e in events ]) \
+            - self.missing
+
+        rows = self.db.find_eventids(pairs)
+        self.missing.update(pairs - set(rows))
+
+        return rows
+
+
+    def __window(self):
+        """ Return the events following the current one that are already
+            known (i.e., without querying the database), at most
+            predecessor_window of them.
+        """
+
+        if self.snapshot is None:
+            return [ Event(row) for row in \
+                     self.db.buffered()[:self.predecessor_window] ]
+
+        # Position of each event in the snapshot (built once per snapshot)
+        if self.snapshot_pos is None or self.snapshot_pos[0] is not self.snapshot:
+            self.snapshot_pos = (self.snapshot, dict([ (e.id(), i) \
+                                 for i, e in enumerate(self.snapshot) ]))
+
+        i = self.snapshot_pos[1].get(self.event.id())
+        if i is None:
+            return []
+
+        return self.snapshot[i + 1:i + 1 + self.predecessor_window]
+
+
     def find_last_event(self):
         """ Given the current event, searches the queue for it's antecessor
             (i.e., the corresponding event that was generated before this one.
             It returns a tuple of booleans where each positions corresponds to
             the bits of the 'handled' field.
+
+            The antecessors of the next events of the scan are fetched along
+            (with a single query, see prefetch).
         """
 
-        # Open a local database connection
-        db = DbEvent()
+        pair = (self.event.source(), self.event.lasteventid())
 
-        row = db.find_eventid(self.event.source(), self.event.lasteventid())
+        if pair in self.missing:
+            return (False, False, False)
 
-        if row is None:
-            tup = (False, False, False)
+        if self.db.cached(*pair):
+            row = self.db.find_eventid(*pair)
         else:
-            event = Event(row)
-            tup = ( event.is_ignored(), event.is_mailsent(), event.is_smssent() )
+            row = self.prefetch([ self.event ] + self.__window()).get(pair)
+
+        if row is None:
+            return (False, False, False)
+
+        event = Event(row)
+
+        # The antecessor might have been handled but not written (or, in
+        # digest mode, sent) yet
+        if event.id() in self.marks:
+            event.h = self.marks[event.id()]
 
-        # Destroy the database instance (and commit data)
-        del db
+        held = self.held.get(event.id(), 0)
+        if held & (1 << MAILSENT):
+            event.set_mailsent()
+        if held & (1 << SMSSENT):
+            event.set_smssent()
 
-        return tup
+        return ( event.is_ignored(), event.is_mailsent(), event.is_smssent() )
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Jorge Morgado <jorge (at) morgado (dot) ch>
+#
+
+"""
+ This module implements the retention of the events: handled events older
+than a number of days are moved from the `queue` table to the `queue_archive`
+table, which is partitioned by month, and the archive partitions older than a
+number of months are dropped (optionally exported to a compressed file
+first).
+
+Dropping a partition is a metadata operation, unlike deleting its rows. The
+`queue` table itself is not partitioned, as MySQL requires every unique key
+of a partitioned table to include the partitioning column, i.e., the unique
+`dedupkey` would no longer detect duplicates across months.
+
+The `queue_archive` table is created by the 004-retention.sql migration.
+"""
+
+import sys
+import gzip
+import json
+import binascii
+from datetime import datetime
+
+sys.path.append('..')
+from db.db import Db
+from dbevent.dbevent import POOL_SIZE
+
+__author__     = "Jorge Morgado"
+__copyright__  = "Copyright (c)2014, Jorge Morgado"
+__credits__    = []
+__license__    = "unknown"
+__version__    = "1.0.0"
+__maintainer__ = "Jorge Morgado"
+__email__      = "jorge (at) morgado (dot) ch"
+__status__     = "Production"
+
+# The archive table and its catch-all partition
+ARCHIVE = 'queue_archive'
+PMAX = 'pmax'
+
+# The columns of the `queue` table (and of the archive)
+COLS = [
+    'id',
+    'ts',
+    'source',
+    'eventid',
+    'lasteventid',
+    'dedupkey',
+    'type',
+    'state',
+    'statetype',
+    'laststate',
+    'count',
+    'handled',
+    'ipv4',
+    'ipv6',
+    'hostname',
+    'servicename',
+    'date',
+    'time',
+    'message',
+]
+
+# Binary columns (exported in hex)
+BINARY_COLS = [ 'dedupkey', 'ipv6' ]
+
+
+def partition_name(year, month):
+    """ Return the name of the partition of the given month.
+
+    >>> partition_name(2014, 6)
+    'p201406'
+    """
+
+    return 'p%04d%02d' % (year, month)
+
+
+def partition_month(name):
+    """ Return the (year, month) of the given partition.
+
+    >>> partition_month('p201406')
+    (2014, 6)
+    """
+
+    return int(name[1:5]), int(name[5:7])
+
+
+def add_months(year, month, n):
+    """ Return the (year, month) `n` months after (or before) the given one.
+
+    >>> add_months(2014, 11, 3)
+    (2015, 2)
+    >>> add_months(2014, 1, -1)
+    (2013, 12)
+    """
+
+    months = year * 12 + month - 1 + n
+
+    return months // 12, months % 12 + 1
+
+
+class Retention:
+    'Common base class for the retention of the events.'
+
+    def __init__(self):
+        self.db = Db('qapi', 'password', 'event', pool_size=POOL_SIZE)
+
+
+    def __del__(self):
+        self.close()
+
+
+    def close(self):
+        """ Close the database connection (and commit data). """
+
+        self.db.close()
+
+
+    def partitions(self):
+        """ Return the names of the monthly partitions of the archive, from
+            the oldest (the catch-all partition is left out).
+        """
+
+        rows = self.db.query('SELECT partition_name '
+                             'FROM information_schema.partitions '
+                             'WHERE table_schema = DATABASE() '
+                             'AND table_name = %(table)s '
+                             'AND partition_name IS NOT NULL',
+                             { 'table': ARCHIVE })
+
+        return sorted([ r[0] for r in rows if r[0] != PMAX ])
+
+
+    def add_partitions(self, months=3):
+        """ Create the partitions of the archive up to `months` months from
+            now (starting with the month of the oldest event in the queue
+            if there are none yet). The new partitions are split from the
+            (empty) catch-all partition. Returns the names of the partitions
+            created.
+        """
+
+        now = datetime.now()
+        last = add_months(now.year, now.month, months)
+
+        existing = self.partitions()
+        if existing:
+            first = add_months(*partition_month(existing[-1]) + (1,))
+        else:
+            rows = self.db.query('SELECT MIN(ts) FROM queue')
+            oldest = rows[0][0] if rows and rows[0][0] is not None else now
+            first = (oldest.year, oldest.month)
+
+        created = []
+        parts = []
+        month = first
+
+        while month <= last:
+            upper = add_months(month[0], month[1], 1)
+            created.append(partition_name(*month))
+            parts.append("PARTITION %s VALUES LESS THAN "
+                         "(UNIX_TIMESTAMP('%04d-%02d-01 00:00:00'))" %
+                         ((created[-1],) + upper))
+            month = upper
+
+        if parts:
+            parts.append('PARTITION %s VALUES LESS THAN MAXVALUE' % PMAX)
+            self.db.execute('ALTER TABLE %s REORGANIZE PARTITION %s INTO (%s)'
+                            % (ARCHIVE, PMAX, ', '.join(parts)))
+
+        return created
+
+
+    def archive(self, days, chunk=1000):
+        """ Move the handled events older than `days` days to the archive,
+            `chunk` events per transaction. Returns the number of events
+            moved.
+        """
+
+        moved = 0
+
+        while True:
+            rows = self.db.query('SELECT id FROM queue '
+                                 'WHERE handled <> 0 '
+                                 'AND ts < NOW() - INTERVAL %%(days)s DAY '
+                                 'ORDER BY id LIMIT %d' % chunk,
+                                 { 'days': days })
+            if not rows:
+                break
+
+            params = {}
+            for i, row in enumerate(rows):
+                params['id%d' % i] = row[0]
+
+            in_list = ', '.join([ '%%(id%d)s' % i for i in range(len(rows)) ])
+
+            with self.db.transaction():
+                self.db.execute('INSERT INTO ' + ARCHIVE + ' (' +
+                                ', '.join(COLS) + ') SELECT ' +
+                                ', '.join(COLS) + ' FROM queue '
+                                'WHERE id IN (' + in_list + ')', params)
+                self.db.execute('DELETE FROM queue '
+                                'WHERE id IN (' + in_list + ')', params)
+
+            moved += len(rows)
+
+            if len(rows) < chunk:
+                break
+
+        return moved
+
+
+    def export(self, name, path, chunk=10000):
+        """ Write the events of the given archive partition to `path` as
+            gzip-compressed JSON lines (binary columns in hex). Returns the
+            number of events written.
+        """
+
+        year, month = partition_month(name)
+        upper = add_months(year, month, 1)
+
+        where = "ts >= '%04d-%02d-01 00:00:00' AND ts < '%04d-%02d-01 00:00:00'" \
+                % (year, month, upper[0], upper[1])
+
+        count = 0
+        last = 0
+        f = gzip.open(path, 'wb')
+
+        try:
+            while True:
+                rows = self.db.query('SELECT ' + ', '.join(COLS) + ' FROM ' +
+                                     ARCHIVE + ' WHERE ' + where +
+                                     ' AND id > %%(id)s ORDER BY id LIMIT %d'
+                                     % chunk, { 'id': last })
+
+                for row in rows:
+                    record = dict(zip(COLS, row))
+                    for col in BINARY_COLS:
+                        if record[col] is not None:
+                            record[col] = binascii.hexlify(record[col]) \
+                                          .decode('ascii')
+                    record['ts'] = str(record['ts'])
+
+                    f.write((json.dumps(record, sort_keys=True) + '\n')
+                            .encode('utf-8'))
+
+                count += len(rows)
+
+                if len(rows) < chunk:
+                    break
+
+                last = rows[-1][0]
+        finally:
+            f.close()
+
+        return count
+
+
+    def drop_partitions(self, months, export_dir=None):
+        """ Drop the archive partitions older than `months` months (i.e.,
+            whose month ended before). If `export_dir` is given, each
+            partition is exported there first (see export). Returns the
+            names of the partitions dropped.
+        """
+
+        now = datetime.now()
+        cutoff = partition_name(*add_months(now.year, now.month, -months))
+
+        dropped = []
+        for name in self.partitions():
+            if name >= cutoff:
+                break
+
+            if export_dir is not None:
+                self.export(name, '%s/%s-%s.json.gz' % (export_dir, ARCHIVE,
+                                                         name))
+
+            self.db.execute('ALTER TABLE %s DROP PARTITION %s'
+                            % (ARCHIVE, name))
+            dropped.append(name)
+
+        return dropped
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Jorge Morgado <jorge (at) morgado (dot) ch>
+#
+
+"""
+ This module implements the rules of the q scripting language: functions
+which are called for the events matching some conditions on their fields,
+e.g.:
+
+@q.rule(hostname=['switch1', 'switch2'], servicename='Ping')
+def catch_switch_ping():
+    q.sendmail()
+
+A condition is either a value (the field must be equal to it), a list, tuple
+or set of values (the field must be one of them) or a function (called with
+the field's value, must return True).
+
+The rules are indexed (see RuleIndex) by the values of one of their fields,
+so each event is only checked against the rules that can match it.
+"""
+
+__author__     = "Jorge Morgado"
+__copyright__  = "Copyright (c)2014, Jorge Morgado"
+__credits__    = []
+__license__    = "unknown"
+__version__    = "1.0.0"
+__maintainer__ = "Jorge Morgado"
+__email__      = "jorge (at) morgado (dot) ch"
+__status__     = "Production"
+
+# The event fields rules can have conditions on
+FIELDS = ( 'id', 'ts', 'source', 'eventid', 'lasteventid', 'type', 'state',
+           'statetype', 'laststate', 'count', 'ipv4', 'ipv6', 'hostname',
+           'servicename', 'date', 'time', 'message', 'weekday' )
+
+
+def match(value, condition):
+    """ Return True if the field `value` satisfies the `condition`.
+
+    >>> match('CPU', 'CPU'), match('CPU', 'Ping')
+    (True, False)
+    >>> match('switch1', [ 'switch1', 'switch2' ])
+    True
+    >>> match('IGNORE4_disk', lambda name: name.startswith('IGNORE4_'))
+    True
+    """
+
+    if callable(condition):
+        return bool(condition(value))
+
+    if isinstance(condition, (list, tuple, set, frozenset)):
+        return value in condition
+
+    return value == condition
+
+
+class Rule(object):
+    'A function called for the events matching some conditions.'
+
+    __slots__ = ('func', 'conditions', 'script')
+
+    def __init__(self, func, conditions, script=None):
+        """ Call `func` for the events matching all `conditions` (a dict of
+            event field name -> condition). `script` is the script the rule
+            belongs to.
+        """
+
+        for field in conditions:
+            if field not in FIELDS:
+                raise ValueError("Unknown event field: %s" % field)
+
+        self.func = func
+        self.conditions = conditions
+        self.script = script
+
+
+    def matches(self, event):
+        """ Return True if the event matches all conditions. """
+
+        for field, condition in self.conditions.items():
+            if not match(getattr(event, field)(), condition):
+                return False
+
+        return True
+
+
+    def key(self):
+        """ Return the field (and its values) used to index the rule, or
+            (None, None) if the rule can't be indexed (i.e., it has no
+            condition on values).
+        """
+
+        for field in sorted(self.conditions):
+            condition = self.conditions[field]
+
+            if callable(condition):
+                continue
+
+            if isinstance(condition, (list, tuple, set, frozenset)):
+                values = list(condition)
+            else:
+                values = [ condition ]
+
+            try:
+                for value in values:
+                    hash(value)
+            except TypeError:
+                continue
+
+            return field, values
+
+        return None, None
+
+
+class RuleIndex:
+    'Route the events to the rules that can match them.'
+
+    def __init__(self, rules):
+        """ Index the given rules (their order is kept).
+
+        >>> class E:
+        ...     def __init__(self, hostname, servicename):
+        ...         self.hostname = lambda: hostname
+        ...         self.servicename = lambda: servicename
+        >>> f = lambda: None
+        >>> cpu = Rule(f, { 'hostname': 'prep-poller1', 'servicename': 'CPU' })
+        >>> ping = Rule(f, { 'hostname': [ 'switch1', 'switch2' ] })
+        >>> starts = Rule(f, { 'servicename': lambda s: s.startswith('C') })
+        >>> index = RuleIndex([ cpu, ping, starts ])
+        >>> index.match(E('prep-poller1', 'CPU')) == [ cpu, starts ]
+        True
+        >>> index.match(E('switch2', 'Ping')) == [ ping ]
+        True
+        >>> index.match(E('other', 'Ping'))
+        []
+        """
+
+        self.rules = rules
+
+        # Field -> value -> positions of the rules indexed by that value
+        self.index = {}
+
+        # Positions of the rules that can't be indexed
+        self.always = []
+
+        for pos, rule in enumerate(rules):
+            field, values = rule.key()
+
+            if field is None:
+                self.always.append(pos)
+                continue
+
+            for value in values:
+                self.index.setdefault(field, {}).setdefault(value, []) \
+                    .append(pos)
+
+
+    def match(self, event):
+        """ Return the rules matching the event, in order. """
+
+        positions = set(self.always)
+
+        for field, values in self.index.items():
+            try:
+                positions.update(values.get(getattr(event, field)(), ()))
+            except TypeError:
+                pass    # unhashable value
+
+        return [ self.rules[pos] for pos in sorted(positions)
+                 if self.rules[pos].matches(event) ]
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Jorge Morgado <jorge (at) morgado (dot) ch>
+#
+
+"""
+This module implements the database layer abstraction of db.py on an
+embedded SQLite database, e.g., to run the event queue on a single node
+without a MySQL server.
+
+The statements built by Db (and the ones given to execute() and query())
+are written for MySQL: they are translated to SQLite when executed (see
+translate) and the MySQL functions they use (INET_ATON and INET_NTOA) are
+implemented in Python. The database runs in WAL mode, so that the readers
+don't block the writer (and vice versa).
+
+The unit tests on this module run on an in-memory database. To test the
+module use:
+$ python sqlitedb.py
+"""
+
+import re
+import sys
+import socket
+import struct
+import sqlite3
+import datetime
+from collections import OrderedDict, deque
+sys.path.append('..')
+import db.db as dbm
+from db.db import Db, get_pool
+
+__author__ = "Jorge Morgado"
+__copyright__ = "Copyright (c)2014, Jorge Morgado"
+__credits__ = []
+__license__ = "unknown"
+__version__ = "1.0.0"
+__maintainer__ = "Jorge Morgado"
+__email__ = "jorge (at) morgado (dot) ch"
+__status__ = "Production"
+
+# TODO Set this from a configuration file
+# How long to wait for the lock held by another connection (in seconds)
+TIMEOUT = 30
+
+# Settings of each connection: in WAL mode, with synchronous=NORMAL, a
+# commit only appends to the log (the log is synced on checkpoints), i.e.,
+# the last commits might be lost on a power failure, but the database is
+# never corrupted.
+PRAGMAS = [
+    'journal_mode = WAL',
+    'synchronous = NORMAL',
+    'cache_size = -16000',
+    'temp_store = MEMORY',
+]
+
+# How many compiled statements to keep per connection
+STATEMENT_CACHE_SIZE = 256
+
+# Format of the TIMESTAMP columns
+TS_FMT = '%Y-%m-%d %H:%M:%S'
+
+# The SQLite form of the statements (see translate)
+translate_cache = {}
+
+# MySQL syntax (see translate)
+DUPLICATE_KEY = ' ON DUPLICATE KEY UPDATE '
+LAST_INSERT_ID = ', id = LAST_INSERT_ID(id)'
+VALUES_FN = re.compile(r'\bVALUES\((\w+)\)')
+LIKE_PARAM = re.compile(r'\bLIKE (%\(\w+\)s)')
+NOW = re.compile(r'\bCURRENT_TIMESTAMP\b|\bNOW\(\)')
+INTERVAL = re.compile(r'\bNOW\(\) \+ INTERVAL (%\(\w+\)s) SECOND\b')
+UPDATE_LIMIT = re.compile(r'^UPDATE (\w+) SET (.*?) WHERE (.*?)'
+                          r'( ORDER BY [\w, ]+)? LIMIT (\S+)$', re.S)
+ROW_IN = re.compile(r'\(([\w, ]+)\) IN \(((?:\([^()]*\), )*\([^()]*\))\)')
+ROW = re.compile(r'\(([^()]*)\)')
+
+
+def translate(sql):
+    """ Translate a MySQL statement (as built by Db) into SQLite. Returns
+        the statement, the names of its parameters in order (named
+        parameters are bound by position, as SQLite looks each name up
+        through all the parameters) and whether it returns the id of the
+        row written (upserts, see Db.upsert).
+
+    >>> translate('SELECT id FROM test WHERE col1 LIKE %(col1)s and id > %(id)s')
+    ("SELECT id FROM test WHERE col1 LIKE ? ESCAPE '\\\\' and id > ?", ['col1', 'id'], False)
+    >>> translate('INSERT INTO test (id) VALUES (%(id)s) ON DUPLICATE KEY '
+    ...           'UPDATE col1 = VALUES(col1), id = LAST_INSERT_ID(id)')
+    ('INSERT INTO test (id) VALUES (?) ON CONFLICT DO UPDATE SET col1 = excluded.col1 RETURNING id', ['id'], True)
+    >>> translate('SELECT id FROM test WHERE (id, col1) IN ((%s, %s), (%s, %s))')
+    ('SELECT id FROM test WHERE ((id = ? AND col1 = ?) OR (id = ? AND col1 = ?))', [], False)
+    >>> translate('UPDATE test SET ts = NOW() + INTERVAL %(secs)s SECOND '
+    ...           'WHERE ts <= NOW() ORDER BY id LIMIT %(limit)s')[0]
+    "UPDATE test SET ts = datetime('now', 'localtime', ? || ' seconds') WHERE rowid IN (SELECT rowid FROM test WHERE ts <= datetime('now', 'localtime') ORDER BY id LIMIT ?)"
+    """
+
+    found = translate_cache.get(sql)
+
+    if found is None:
+        mysql_sql = sql
+        returning = False
+
+        if DUPLICATE_KEY in sql:
+            sql, update = sql.split(DUPLICATE_KEY, 1)
+            update = VALUES_FN.sub(r'excluded.\1', update)
+
+            # The id of the inserted or updated row
+            if update.endswith(LAST_INSERT_ID):
+                update = update[:-len(LAST_INSERT_ID)] + ' RETURNING id'
+                returning = True
+
+            sql += ' ON CONFLICT DO UPDATE SET ' + update
+
+        # MySQL escapes LIKE patterns with a backslash by default
+        sql = LIKE_PARAM.sub(r"LIKE \1 ESCAPE '\\'", sql)
+        sql = INTERVAL.sub(r"datetime('now', 'localtime', \1 || ' seconds')",
+                           sql)
+        sql = NOW.sub("datetime('now', 'localtime')", sql)
+
+        # SQLite doesn't take ORDER BY and LIMIT on UPDATE (by default)
+        sql = UPDATE_LIMIT.sub(r'UPDATE \1 SET \2 WHERE rowid IN (SELECT '
+                               r'rowid FROM \1 WHERE \3\4 LIMIT \5)', sql)
+        sql, names = dbm.positional(sql)
+        sql = sql.replace('%s', '?')
+
+        # SQLite doesn't search an index for row values IN a list
+        sql = ROW_IN.sub(row_in, sql)
+
+        if len(translate_cache) >= dbm.SQL_CACHE_SIZE:
+            translate_cache.clear()
+        found = translate_cache[mysql_sql] = (sql, names, returning)
+
+    return found
+
+
+def row_in(match):
+    """ Return the ROW_IN `match` as the equivalent OR of ANDs. """
+
+    columns = [ c.strip() for c in match.group(1).split(',') ]
+    rows = []
+
+    for row in ROW.findall(match.group(2)):
+        rows.append('(' + ' AND '.join([ c + ' = ' + v.strip() for c, v in
+                                         zip(columns, row.split(',')) ]) + ')')
+
+    return '(' + ' OR '.join(rows) + ')'
+
+
+def bind(params, names):
+    """ Return the `params` of a statement as taken by SQLite, i.e., by
+        position (see translate for `names`). With Python 2, the byte
+        strings that are not text (e.g., a dedup key) are bound as blobs.
+
+    >>> bind({ 'id': 1, 'col1': None }, [ 'col1', 'id' ])
+    (None, 1)
+    """
+
+    if params is None:
+        return ()
+
+    if isinstance(params, dict):
+        params = tuple([ params[name] for name in names ])
+
+    if bytes is not str:
+        return params
+
+    def value(v):
+        if isinstance(v, str):
+            try:
+                return v.decode('utf-8')
+            except UnicodeDecodeError:
+                return buffer(v)
+        return v
+
+    return tuple([ value(v) for v in params ])
+
+
+def inet_aton(address):
+    """ Return the IPv4 `address` as a number (as MySQL's INET_ATON).
+
+    >>> inet_aton('192.168.1.1')
+    3232235777
+    >>> inet_aton('bad') is None
+    True
+    """
+
+    try:
+        return struct.unpack('!I', socket.inet_aton(address))[0]
+    except Exception:   # catch *all* exceptions (None too)
+        return None
+
+
+def inet_ntoa(number):
+    """ Return the IPv4 address of `number` (as MySQL's INET_NTOA).
+
+    >>> inet_ntoa(3232235777)
+    '192.168.1.1'
+    >>> inet_ntoa(None) is None
+    True
+    """
+
+    try:
+        return socket.inet_ntoa(struct.pack('!I', number))
+    except Exception:   # catch *all* exceptions (None too)
+        return None
+
+
+def convert_timestamp(value):
+    """ Return the value of a TIMESTAMP column as a datetime (as MySQL). """
+
+    if not isinstance(value, str):
+        value = value.decode('ascii')
+
+    return datetime.datetime.strptime(value[:19], TS_FMT)
+
+sqlite3.register_converter('TIMESTAMP', convert_timestamp)
+sqlite3.register_adapter(datetime.datetime, lambda d: d.strftime(TS_FMT))
+
+
+def connect(database, schema=None, **ignored):
+    """ Open the SQLite `database` file (created if it doesn't exist) and
+        run the `schema` script on it (if given, it must only create what
+        doesn't exist yet).
+    """
+
+    return Connection(database, schema)
+
+
+class Cursor:
+    'A cursor running the MySQL statements built by Db (see translate).'
+
+    def __init__(self, conn, buffered=True):
+        """ Create a cursor on the SQLite connection `conn`. If `buffered`
+            is set, all rows found are read at once (as MySQL's buffered
+            cursors), so that a commit doesn't lose them.
+        """
+
+        self.cursor = conn.cursor()
+        self.buffered = buffered
+        self.rows = None
+        self.lastrowid = None
+        self.rowcount = -1
+
+
+    def execute(self, sql, params=None):
+        sql, names, returning = translate(sql)
+
+        self.cursor.execute(sql, bind(params, names))
+        self.rowcount = self.cursor.rowcount
+        self.rows = None
+
+        if returning:
+            row = self.cursor.fetchone()
+            self.cursor.fetchall()
+            self.lastrowid = row[0] if row is not None else None
+        elif sql.startswith('INSERT'):
+            # As MySQL, the id of the first row of a multi-row insert (the
+            # ids of the rows of an insert are consecutive)
+            self.lastrowid = self.cursor.lastrowid - max(self.rowcount, 1) + 1
+        elif self.buffered:
+            self.rows = deque(self.cursor.fetchall())
+
+
+    def fetchone(self):
+        if self.rows is None:
+            return self.cursor.fetchone()
+
+        return self.rows.popleft() if self.rows else None
+
+
+    def fetchall(self):
+        if self.rows is None:
+            return self.cursor.fetchall()
+
+        rows = list(self.rows)
+        self.rows.clear()
+        return rows
+
+
+    def close(self):
+        self.rows = None
+        self.cursor.close()
+
+
+class Connection:
+    'An SQLite connection with the interface of a MySQL one (as used by Db).'
+
+    def __init__(self, database, schema=None):
+        # Pooled connections are handed from one thread to another (but
+        # only used by one thread at a time)
+        self.conn = sqlite3.connect(database, timeout=TIMEOUT,
+                                    detect_types=sqlite3.PARSE_DECLTYPES,
+                                    cached_statements=STATEMENT_CACHE_SIZE,
+                                    check_same_thread=False)
+
+        self.conn.create_function('INET_ATON', 1, inet_aton)
+        self.conn.create_function('INET_NTOA', 1, inet_ntoa)
+
+        for pragma in PRAGMAS:
+            self.conn.execute('PRAGMA ' + pragma)
+
+        if schema:
+            self.conn.executescript(schema)
+
+
+    def cursor(self, buffered=True, prepared=False):
+        return Cursor(self.conn, buffered)
+
+
+    def ping(self, **kwargs):
+        """ Nothing to check, the database is local. """
+
+        return True
+
+
+    def commit(self):
+        self.conn.commit()
+
+
+    def rollback(self):
+        self.conn.rollback()
+
+
+    def close(self):
+        self.conn.close()
+
+
+class SqliteDb(Db):
+    def __init__(self, database, schema=None, pool_size=None):
+        """ Open the SQLite `database` file (see connect for `schema`). The
+            same Db interface is available, running the same (MySQL)
+            statements.
+
+            If `pool_size` is given, the connection is taken from a pool (see
+            Db.__init__). There is no prepared mode: SQLite keeps the last
+            STATEMENT_CACHE_SIZE statements compiled already.
+
+        >>> mydb = SqliteDb(':memory:', \
+                'CREATE TABLE test (id INTEGER PRIMARY KEY AUTOINCREMENT, ' \
+                'col1 TEXT, col2 TEXT, UNIQUE (col1))')
+        >>> mydb.insert('test', { \
+                    'col1': [ '%(col1)s', 'col1' ], \
+                    'col2': [ '%(col2)s', 'col2' ], \
+                })
+        1
+        >>> mydb.insert_many('test', [ \
+                    { 'col1': [ '%(col1)s', 'a' ] }, \
+                    { 'col1': [ '%(col1)s', 'b' ] }, \
+                ])
+        [2, 3]
+        >>> mydb.upsert('test', { \
+                    'col1': [ '%(col1)s', 'a' ], \
+                }, { \
+                    'col2': "'updated'", \
+                })
+        2
+        >>> mydb.update_in('test', { 'col2': "'x'" }, 'id', [ 1, 3 ])
+        2
+        >>> mydb.select('test', [ 'id', 'col2' ], \
+                    { 'col1': [ ' LIKE ', '%(col1)s', 'COL%' ] })
+        True
+        >>> [ row[0] for row in mydb.fetch_all() ]
+        [1]
+        >>> mydb.select('test', [ 'id', 'col2' ], \
+                    { 'id': [ ' > ', '%(id)s', 1 ] }, [ 'id' ])
+        True
+        >>> mydb.fetch_next()[1] == 'updated'
+        True
+        >>> mydb.query('SELECT INET_NTOA(INET_ATON(%(ip)s))', \
+                    { 'ip': '10.0.0.1' })[0][0] == '10.0.0.1'
+        True
+        >>> mydb.close()
+        """
+
+        dbconfig = {
+            'user'    : None,
+            'host'    : None,
+            'port'    : None,
+            'database': database,
+            'schema'  : schema,
+        }
+
+        self.pool = None
+        self.conn = None
+        self.cursor_ro = None
+        self.cursor_rw = None
+
+        self.prepared = False
+        self.statements = OrderedDict()
+        self.rows = None
+
+        # SQLite ids go one by one
+        self.increment = 1
+
+        try:
+            if pool_size:
+                self.pool = get_pool(dbconfig, pool_size, connect)
+                self.conn = self.pool.checkout()
+            else:
+                self.conn = connect(**dbconfig)
+
+            # Create two cursors: one for RO and one for RW operartions
+            self.cursor_ro = self.conn.cursor(buffered=True)
+            self.cursor_rw = self.conn.cursor(buffered=True)
+        except Exception as e:  # catch *all* exceptions
+            print("Err %s" % e)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -3,8 +3,9 @@
 # The host notification command is called by the poller and puts
 # the notification to the Event Queue.
 #
-# This is just a wrapper to curl - it might be better to run curl
-# directly from your Nagios poller. Although, if that fails to process
+# If the local spool agent (eq-spoold) is running, the event is handed over
+# to it. Otherwise, this is just a wrapper to curl - it might be better to run
+# curl directly from your Nagios poller. Although, if that fails to process
 # the `hostname -s` (security reasons?) you can use this script (2-steps):
 #
 #	      Nagios poller > (this script) > Event Queue
@@ -20,6 +21,9 @@
 
 HOSTNAME=`hostname -s`
 
+# The Unix socket of the local spool agent (see eq-spoold)
+SOCKET="/var/run/eq-spoold.sock"
+
 # The JSON content
 CONTENT=" \
   \"source\":\"${HOSTNAME}\", \
@@ -36,6 +40,16 @@ CONTENT=" \
   \"lasthosteventid\":\"${11}\" \
 "
 
+# Hand the event over to the local spool agent, which stores it on disk and
+# forwards it to the Event Queue (also when the Event Queue is unavailable).
+# The agent answers 'OK' once the event is safely stored.
+if [ -S ${SOCKET} ]; then
+  echo "{${CONTENT}}" \
+    | /usr/bin/socat -t 5 - UNIX-CONNECT:${SOCKET} 2>/dev/null \
+    | grep -q OK && exit 0
+fi
+
+# The agent is not running (or failed), push the event directly
 /usr/bin/curl \
   -i \
   --noproxy eqhost \
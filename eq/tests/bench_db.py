@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Jorge Morgado <jorge (at) morgado (dot) ch>
+#
+
+"""
+A micro-benchmark of the Db statements: building the SQL text with and
+without the SQL cache, and running them as text or as prepared statements
+(see PREPARED in db.py).
+
+Running the statements requires the `test` database described in db.py.
+
+Usage: python bench_db.py [-n ITERATIONS] [--no-server]
+"""
+
+import os
+import sys
+import argparse
+from time import time
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + "/../lib")
+import db.db as dbm
+from db.db import Db
+
+__author__     = "Jorge Morgado"
+__copyright__  = "Copyright (c)2014, Jorge Morgado"
+__credits__    = []
+__license__    = "unknown"
+__version__    = "1.0.0"
+__maintainer__ = "Jorge Morgado"
+__email__      = "jorge (at) morgado (dot) ch"
+__status__     = "Production"
+
+# The shapes of the statements most used by DbEvent
+RECORD = {
+    'col1': [ '%(col1)s', 'value1' ],
+    'col2': [ '%(col2)s', 'value2' ],
+}
+WHERE = {
+    'id'  : [ '>', '%(id)s', 0 ],
+    'col1': [ '=', '%(col1)s', 'value1' ],
+}
+
+
+class Cursor:
+    'A cursor discarding all statements (to time the SQL building only).'
+
+    lastrowid = 0
+    rowcount = 0
+
+    def execute(self, sql, params=None):
+        pass
+
+    def fetchall(self):
+        return []
+
+
+class NoServerDb(Db):
+    'A Db not connected to any server (see Cursor).'
+
+    def __init__(self):
+        self.conn = None
+        self.pool = None
+        self.prepared = False
+        self.statements = {}
+        self.rows = None
+        self.cursor_ro = self.cursor_rw = Cursor()
+
+
+def timeit(label, n, func):
+    """ Run `func` `n` times and print the rate. """
+
+    start = time()
+    for i in range(n):
+        func(i)
+    elapsed = time() - start
+
+    print("%-32s %8.0f ops/s" % (label, n / elapsed if elapsed else 0))
+
+
+def bench_build(n):
+    """ Time the statements building only (no server needed). """
+
+    mydb = NoServerDb()
+    cache_size = dbm.SQL_CACHE_SIZE
+
+    for label, size in (('build (no cache)', 0), ('build (cached)', cache_size)):
+        dbm.SQL_CACHE_SIZE = size
+        dbm.sql_cache.clear()
+
+        timeit(label + ': insert', n,
+               lambda i: mydb.insert('test', RECORD))
+        timeit(label + ': select', n,
+               lambda i: mydb.select('test', [ 'id', 'col1' ], WHERE,
+                                     [ 'id' ], limit=10))
+        timeit(label + ': update', n,
+               lambda i: mydb.update('test', { 'col2': '"x"' },
+                                     { 'id': [ '%(id)s', i ] }))
+
+    dbm.SQL_CACHE_SIZE = cache_size
+
+
+def bench_server(n):
+    """ Time the statements on the `test` database, as text and prepared. """
+
+    for label, prepared in (('text', False), ('prepared', True)):
+        mydb = Db('test', 'password', 'test', '127.0.0.1', prepared=prepared)
+
+        timeit(label + ': insert', n,
+               lambda i: mydb.insert('test', RECORD))
+        timeit(label + ': select', n,
+               lambda i: mydb.select('test', [ 'id', 'col1' ], WHERE,
+                                     [ 'id' ], limit=10) and mydb.fetch_all())
+        timeit(label + ': update', n,
+               lambda i: mydb.update('test', { 'col2': '"x"' },
+                                     { 'id': [ '%(id)s', i ] }))
+
+        mydb.rollback()
+        mydb.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Db statements.")
+    parser.add_argument('-n', '--iterations', type=int, dest='n',
+                        default=10000,
+                        help='how many times to run each statement')
+    parser.add_argument('--no-server', action='store_true', dest='no_server',
+                        default=False,
+                        help='only time the building of the statements')
+    args = parser.parse_args()
+
+    bench_build(args.n)
+
+    if not args.no_server:
+        bench_server(args.n)
+
+
+if __name__ == "__main__":
+    main()
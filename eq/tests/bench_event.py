@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Micro-benchmark of the Event accessors, as used by the q scripts.
+#
+# Usage: python bench_event.py [events]
+#
+
+"""
+Compare the per-event cost of the accessors of the current Event class with
+the previous implementation (every accessor normalizing its column and the
+date/time being parsed on every call).
+"""
+
+import sys
+import datetime
+from timeit import timeit
+
+sys.path.append('../lib')
+from event.event import Event, F_HANDLED, DATE_FMT, TIME_FMT
+
+class LegacyEvent():
+    'The previous implementation of the Event accessors.'
+
+    def __init__(self, row):
+        self.e = row
+        self.h = self.__column(F_HANDLED)
+
+    def __column(self, index):
+        if self.e is None:
+            return None
+        elif self.e[index] is None:
+            return ''
+        else:
+            return self.e[index]
+
+    def source(self):      return self.__column(2)
+    def type(self):        return self.__column(5)
+    def state(self):       return self.__column(6)
+    def laststate(self):   return self.__column(8)
+    def hostname(self):    return self.__column(13)
+    def servicename(self): return self.__column(14)
+    def date(self):        return self.__column(15)
+    def time(self):        return self.__column(16)
+
+    def weekday(self):
+        wd = [ 'Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday',
+            'Saturday', 'Sunday' ]
+
+        return wd[datetime.datetime.strptime(self.date(), DATE_FMT).weekday()]
+
+    def time_is_between(self, hr1, min1, hr2, min2):
+        time = datetime.datetime.strptime(self.date() + ' ' + self.time(),
+                                          DATE_FMT + ' ' + TIME_FMT)
+        time_min = time.replace(hour=hr1, minute=min1, second=0, microsecond=0)
+        time_max = time.replace(hour=hr2, minute=min2, second=0, microsecond=0)
+
+        return time_min < time < time_max
+
+
+def rule(event):
+    """ What a typical script does with each event (several scripts). """
+
+    for i in range(3):
+        if (event.source() in ['prod-poller1', 'prod-poller2']
+        and (event.state() in ['CRITICAL', 'DOWN']
+             or event.laststate() in ['CRITICAL', 'DOWN'])
+        and event.servicename() != 'IGNORE1'
+        and event.hostname() != 'switch1'):
+            event.weekday()
+            event.time_is_between(8, 0, 18, 0)
+            event.time_is_between(18, 0, 23, 59)
+
+
+def bench(cls, rows):
+    """ Return the time (in microseconds) spent per event. """
+
+    secs = timeit(lambda: [rule(cls(row)) for row in rows], number=1)
+    return secs * 1000000 / len(rows)
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    rows = [ (i, None, 'prod-poller1', i, i - 1, 'PROBLEM', 'CRITICAL', 'HARD',
+              'OK', 1, 0, '10.0.0.1', None, 'host%d' % (i % 100), None,
+              '2014-06-10', '17:33:00', 'Load too high') for i in range(n) ]
+
+    legacy = bench(LegacyEvent, rows)
+    current = bench(Event, rows)
+
+    print("%d events: legacy %.1f us/event, current %.1f us/event (%.1fx)" %
+          (n, legacy, current, legacy / current))
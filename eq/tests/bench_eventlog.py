@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Jorge Morgado <jorge (at) morgado (dot) ch>
+#
+
+"""
+A benchmark of the event log backend (see eventlog.py): the ingestion of
+`--events` events (in batches of `--batch`, as app.wsgi does) and their scan
+by q (first_unhandled/next), before and after marking most of them handled.
+
+The log is written to a temporary directory (removed at the end), unless
+`--path` is given.
+
+Usage: python bench_eventlog.py [--events N] [--batch N] [--path DIR]
+"""
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+from time import time
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + "/../lib")
+from dbevent import dbevent
+from q.q import Q
+
+__author__     = "Jorge Morgado"
+__copyright__  = "Copyright (c)2014, Jorge Morgado"
+__credits__    = []
+__license__    = "unknown"
+__version__    = "1.0.0"
+__maintainer__ = "Jorge Morgado"
+__email__      = "jorge (at) morgado (dot) ch"
+__status__     = "Production"
+
+
+def events(count):
+    """ Generate `count` distinct events (no duplicates). """
+
+    for i in range(count):
+        yield {
+            'source': 'nagios%d' % (i % 4), 'eventid': i, 'lasteventid': 0,
+            'type': 'PROBLEM', 'state': 'CRITICAL', 'statetype': 'HARD',
+            'laststate': 'OK', 'ipv4': '192.168.1.%d' % (i % 250),
+            'ipv6': None, 'hostname': 'host%d' % (i % 1000),
+            'servicename': 'HTTP', 'date': '2014-06-10', 'time': '17:33:00',
+            'message': 'HTTP CRITICAL - connection refused',
+        }
+
+
+def ingest(db, count, batch):
+    """ Queue `count` events, `batch` at a time. Returns the number of
+        events queued.
+    """
+
+    pending = []
+
+    for event in events(count):
+        pending.append(event)
+        if len(pending) == batch:
+            db.new_events(pending)
+            pending = []
+
+    if pending:
+        db.new_events(pending)
+    db.commit()
+
+    return count
+
+
+def scan(q):
+    """ Read all unhandled events, as a q script does. Returns the number
+        of events read.
+    """
+
+    count = 0
+    event = q.first_unhandled()
+
+    while event is not None:
+        count += 1
+        event = q.next()
+
+    return count
+
+
+def timeit(label, func):
+    """ Run `func` and print how long it took (and the rate). """
+
+    start = time()
+    result = func()
+    elapsed = time() - start
+    print("%-24s %10d events %8.3f s %10d events/s" %
+          (label, result, elapsed, result / max(elapsed, 1e-9)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the event log backend.")
+    parser.add_argument('--events', type=int, default=1000000,
+                        help='how many events to queue')
+    parser.add_argument('--batch', type=int, default=1000,
+                        help='how many events per new_events call')
+    parser.add_argument('--path', help='log directory')
+    args = parser.parse_args()
+
+    path = args.path or tempfile.mkdtemp()
+    dbevent.BACKEND = 'log'
+    dbevent.LOG_PATH = path
+
+    try:
+        db = dbevent.connect()
+        timeit("ingest", lambda: ingest(db, args.events, args.batch))
+
+        q = Q('2100-01-01 00:00:00')
+        timeit("scan (all unhandled)", lambda: scan(q))
+
+        # Leave one event out of 100 unhandled
+        db.set_handled_many([ i for i in range(1, args.events + 1)
+                              if i % 100 ], 1)
+        timeit("scan (1% unhandled)", lambda: scan(q))
+    finally:
+        if not args.path:
+            shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    main()
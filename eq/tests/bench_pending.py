@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Jorge Morgado <jorge (at) morgado (dot) ch>
+#
+
+"""
+A benchmark of the scan of the unhandled events: the whole queue (filtered on
+`handled = 0`) against the `pending` table of the 005-pending.sql migration
+(see PENDING_TABLE in dbevent.py).
+
+The benchmark runs on its own database (`eqbench` by default, which has to
+exist and be writable by the given user), with a copy of the structure of
+the `event` queue, filled with `--rows` events of which `--unhandled` are
+left unhandled.
+
+Usage: python bench_pending.py [--rows N] [--unhandled N] [--user USER]
+                               [--password PASSWORD] [--database NAME]
+"""
+
+import os
+import sys
+import argparse
+from time import time
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)) + "/../lib")
+from db.db import Db
+from dbevent.dbevent import QUEUE, PENDING
+
+__author__     = "Jorge Morgado"
+__copyright__  = "Copyright (c)2014, Jorge Morgado"
+__credits__    = []
+__license__    = "unknown"
+__version__    = "1.0.0"
+__maintainer__ = "Jorge Morgado"
+__email__      = "jorge (at) morgado (dot) ch"
+__status__     = "Production"
+
+# The statements of 005-pending.sql (without the DELIMITER of the mysql CLI)
+SCHEMA = [
+    "DROP TABLE IF EXISTS pending",
+    "DROP TABLE IF EXISTS queue",
+    "CREATE TABLE queue LIKE event.queue",
+    "CREATE TABLE pending (id int(11) NOT NULL, PRIMARY KEY (id)) "
+    "ENGINE=InnoDB",
+    "CREATE TRIGGER queue_pending_insert AFTER INSERT ON queue "
+    "FOR EACH ROW BEGIN "
+    "IF NEW.handled = 0 THEN "
+    "INSERT IGNORE INTO pending (id) VALUES (NEW.id); "
+    "END IF; "
+    "END",
+    "CREATE TRIGGER queue_pending_update AFTER UPDATE ON queue "
+    "FOR EACH ROW BEGIN "
+    "IF NEW.handled = 0 AND OLD.handled <> 0 THEN "
+    "INSERT IGNORE INTO pending (id) VALUES (NEW.id); "
+    "ELSEIF NEW.handled <> 0 AND OLD.handled = 0 THEN "
+    "DELETE FROM pending WHERE id = OLD.id; "
+    "END IF; "
+    "END",
+    "CREATE TRIGGER queue_pending_delete AFTER DELETE ON queue "
+    "FOR EACH ROW BEGIN "
+    "DELETE FROM pending WHERE id = OLD.id; "
+    "END",
+]
+
+# The columns read by the scan (as in DbEvent, without the message)
+COLS = [ 'id', 'ts', 'source', 'eventid', 'lasteventid', 'type', 'state',
+         'statetype', 'laststate', 'count', 'handled' ]
+
+# Rows per page of the scan (as in DbEvent's streaming mode)
+CHUNK = 1000
+
+
+def fill(mydb, rows, unhandled):
+    """ Fill the queue with `rows` handled events and then `unhandled`
+        unhandled ones (the most recent, as in a live queue).
+    """
+
+    record = {
+        'source'   : [ '%(source)s', 'bench' ],
+        'eventid'  : [ '%(eventid)s', 1 ],
+        'type'     : [ '%(type)s', 'bench' ],
+        'handled'  : [ '%(handled)s', 1 ],
+        'date'     : [ '%(date)s', '' ],
+        'time'     : [ '%(time)s', '' ],
+    }
+
+    # Double the handled events until there are enough of them (much faster
+    # than inserting them one chunk at a time)
+    mydb.insert_many('queue', [ record ] * min(rows, 1000), commit=True)
+    count = min(rows, 1000)
+    while count < rows:
+        n = min(count, rows - count)
+        count += mydb.execute(
+            "INSERT INTO queue (source, eventid, type, handled, date, time) "
+            "SELECT source, eventid, type, handled, date, time FROM queue "
+            "LIMIT %d" % n)
+        mydb.commit()
+
+    record['handled'] = [ '%(handled)s', 0 ]
+    mydb.insert_many('queue', [ record ] * unhandled, commit=True)
+
+
+def scan(mydb, table):
+    """ Read all unhandled events of `table` a page at a time, as DbEvent
+        does. Returns the number of events read.
+    """
+
+    count = 0
+    last = 0
+
+    while True:
+        mydb.select(table, COLS, {
+            'handled': [ '=', '%(handled)s', 0 ],
+            'id'     : [ '>', '%(id)s', last ],
+        }, [ 'id' ], limit=CHUNK)
+        rows = mydb.fetch_all()
+
+        if not rows:
+            return count
+
+        count += len(rows)
+        last = rows[-1][0]
+
+
+def timeit(label, func):
+    """ Run `func` and print how long it took. """
+
+    start = time()
+    result = func()
+    print("%-24s %10d events %8.3f s" % (label, result, time() - start))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the scan of the unhandled events.")
+    parser.add_argument('--rows', type=int, default=10000000,
+                        help='how many handled events in the queue')
+    parser.add_argument('--unhandled', type=int, default=1000,
+                        help='how many unhandled events in the queue')
+    parser.add_argument('--user', default='test', help='database user')
+    parser.add_argument('--password', default='password',
+                        help='database password')
+    parser.add_argument('--database', default='eqbench', help='database name')
+    args = parser.parse_args()
+
+    mydb = Db(args.user, args.password, args.database)
+
+    for sql in SCHEMA:
+        mydb.execute(sql)
+
+    fill(mydb, args.rows, args.unhandled)
+
+    # Once cold-ish (first read of the pages), then warm
+    for run in ('1st', '2nd'):
+        timeit("%s: queue" % run, lambda: scan(mydb, QUEUE))
+        timeit("%s: pending" % run, lambda: scan(mydb, PENDING))
+
+    mydb.close()
+
+
+if __name__ == "__main__":
+    main()
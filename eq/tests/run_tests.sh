@@ -33,6 +33,27 @@ echo "Testing Python Db module"
 echo "Testing Python DbEvent module"
 ./test_module_dbevent.sh ${VERBOSE} || RET=1
 
+echo "Testing the SQLite backend"
+./test_backend_sqlite.sh ${VERBOSE} || RET=1
+
+echo "Testing the event log backend"
+./test_backend_log.sh ${VERBOSE} || RET=1
+
+echo "Testing the scan engine"
+./test_engine.sh ${VERBOSE} || RET=1
+
+echo "Testing the checkpointed mode"
+./test_checkpoint.sh ${VERBOSE} || RET=1
+
+echo "Testing the digest mode"
+./test_digest.sh ${VERBOSE} || RET=1
+
+echo "Testing the spool agent"
+./test_spoold.sh ${VERBOSE} || RET=1
+
+echo "Testing the notification outbox"
+./test_outbox.sh ${VERBOSE} || RET=1
+
 echo "Testing generic q script(s)"
 ./test_scripts.sh ${VERBOSE} || RET=1
 
@@ -0,0 +1,94 @@
+#!/bin/bash
+
+# Run the event queue on a temporary event log (see BACKEND in dbevent.py
+# and eventlog.py)
+export EQ_BACKEND=log
+export EQ_LOG_PATH=`mktemp -d /tmp/eq-test.XXXXXX`
+
+pushd ../lib/eventlog > /dev/null
+
+python -m eventlog $*
+RET=$?
+
+popd > /dev/null
+
+pushd ../lib > /dev/null
+
+# Queue a problem (twice) and its recovery, then handle them with q
+python - <<'END' || RET=1
+from dbevent.dbevent import connect
+from eventlog import eventlog
+from q.q import Q
+
+# Small segments, to have a few of them
+eventlog.SEGMENT_EVENTS = 100
+
+db = connect()
+problem = { 'source': 'nagios1', 'eventid': 1, 'lasteventid': 0,
+            'type': 'PROBLEM', 'state': 'CRITICAL', 'statetype': 'HARD',
+            'laststate': 'OK', 'ipv4': '192.168.1.1', 'ipv6': None,
+            'hostname': 'office-gw', 'servicename': 'HTTP_proxy',
+            'date': '2014-06-10', 'time': '17:33:00', 'message': 'Down' }
+recovery = dict(problem, eventid=2, lasteventid=1, type='RECOVERY',
+                state='OK', laststate='CRITICAL', message='Up')
+
+ids = db.new_events([ problem, problem ])
+assert ids[0] == ids[1], ids
+assert db.new_event(*[ recovery[k] for k in ('source', 'eventid',
+    'lasteventid', 'type', 'state', 'statetype', 'laststate', 'ipv4', 'ipv6',
+    'hostname', 'servicename', 'date', 'time', 'message') ]) == ids[0] + 1
+db.commit()
+
+q = Q('2100-01-01 00:00:00')
+assert q.first_unhandled(servicename__startswith='HTTP_') is not None
+assert q.event.ipv4() == '192.168.1.1', q.event.ipv4()
+assert q.event.count() == 2, q.event.count()
+q.ignore()
+q.next()
+assert q.event.type() == 'RECOVERY'
+assert q.find_last_event() == (True, False, False)
+q.ignore()
+q.commit()
+
+assert q.first_unhandled(servicename__startswith='HTTP%') is None
+assert db.find_all_unhandled('2100-01-01 00:00:00') is None
+assert db.find_eventid('nagios1', 1)[0] == ids[0]
+
+# Heartbeats are counted, not queued again
+hb = db.new_heartbeat_event('nagios2', 'HEARTBEAT', 'OK', '2014-06-10',
+                            '17:33:00')
+assert db.new_heartbeat_event('nagios2', 'HEARTBEAT', 'OK', '2014-06-10',
+                              '17:34:00') == hb
+assert q.first_heartbeat().count() == 2
+
+db.set_watermark('test', 10)
+db.set_watermark('test', 20)
+assert db.get_watermark('test') == 20
+
+# Fill a few segments and drop the handled ones
+event = dict(problem, servicename='disk')
+db.new_events([ dict(event, eventid=i) for i in range(3, 200) ])
+for i in range(200, 350):
+    db.new_event(*[ dict(event, eventid=i)[k] for k in ('source', 'eventid',
+        'lasteventid', 'type', 'state', 'statetype', 'laststate', 'ipv4',
+        'ipv6', 'hostname', 'servicename', 'date', 'time', 'message') ])
+assert len(db.log.segments) == 4, db.log.segments
+db.set_handled_many(range(1, 301), 1)
+assert db.compact(days=0) == 3
+assert db.find_eventid('nagios1', 3) is None
+assert db.find_eventid('nagios1', 349)[0] == 350
+assert q.first_unhandled().id() == 301
+
+# Duplicates are matched ignoring case, as MySQL's collation does
+assert db.new_events([ dict(event, eventid=349, hostname='OFFICE-GW'),
+                       dict(event, eventid=349, type='problem') ]) == [ 350 ] * 2
+new = db.new_events([ dict(event, eventid=400, state='Warning'),
+                      dict(event, eventid=400, state='WARNING') ])
+assert new[0] == new[1], new
+END
+
+popd > /dev/null
+
+rm -rf ${EQ_LOG_PATH}
+
+exit ${RET}
@@ -0,0 +1,96 @@
+#!/bin/bash
+
+# Run the event queue on a temporary SQLite database (see BACKEND in
+# dbevent.py), i.e., without a MySQL server
+export EQ_BACKEND=sqlite
+export EQ_SQLITE_PATH=`mktemp -u /tmp/eq-test.XXXXXX`
+
+pushd ../lib/sqlitedb > /dev/null
+
+python -m sqlitedb $*
+RET=$?
+
+popd > /dev/null
+
+pushd ../lib > /dev/null
+
+# Queue a problem (twice) and its recovery, then handle them with q
+python - <<'END' || RET=1
+from dbevent.dbevent import DbEvent
+from q.q import Q
+
+db = DbEvent()
+problem = { 'source': 'nagios1', 'eventid': 1, 'lasteventid': 0,
+            'type': 'PROBLEM', 'state': 'CRITICAL', 'statetype': 'HARD',
+            'laststate': 'OK', 'ipv4': '192.168.1.1', 'ipv6': None,
+            'hostname': 'office-gw', 'servicename': 'HTTP_proxy',
+            'date': '2014-06-10', 'time': '17:33:00', 'message': 'Down' }
+recovery = dict(problem, eventid=2, lasteventid=1, type='RECOVERY',
+                state='OK', laststate='CRITICAL', message='Up')
+
+ids = db.new_events([ problem, problem ])
+assert ids[0] == ids[1], ids
+assert db.new_event(*[ recovery[k] for k in ('source', 'eventid',
+    'lasteventid', 'type', 'state', 'statetype', 'laststate', 'ipv4', 'ipv6',
+    'hostname', 'servicename', 'date', 'time', 'message') ]) == ids[0] + 1
+db.commit()
+
+q = Q('2100-01-01 00:00:00')
+assert q.first_unhandled(servicename__startswith='HTTP_') is not None
+assert q.event.ipv4() == '192.168.1.1', q.event.ipv4()
+assert q.event.count() == 2, q.event.count()
+q.ignore()
+q.next()
+assert q.event.type() == 'RECOVERY'
+assert q.find_last_event() == (True, False, False)
+q.ignore()
+q.commit()
+
+assert q.first_unhandled(servicename__startswith='HTTP%') is None
+assert db.find_all_unhandled('2100-01-01 00:00:00') is None
+assert db.find_eventid('nagios1', 1)[0] == ids[0]
+
+# Duplicates are matched ignoring case, as MySQL's collation does
+assert db.new_events([ dict(problem, hostname='OFFICE-GW'),
+                       dict(problem, type='problem') ]) == [ ids[0] ] * 2
+new = db.new_events([ dict(problem, eventid=7, state='Warning'),
+                      dict(problem, eventid=7, state='WARNING') ])
+assert new[0] == new[1], new
+db.commit()
+
+# Upserts keep the same event (and count it)
+db = DbEvent(upsert=True)
+event = [ 'nagios2', 1, 0, 'PROBLEM', 'WARNING', 'SOFT', 'OK', None, None,
+          'db', 'disk', '2014-06-10', '17:33:00', 'Disk full' ]
+assert db.new_event(*event) == db.new_event(*event)
+assert db.new_event(*event) == db.new_event(*(event[:9] + [ 'DB' ] +
+                                               event[10:]))
+db.set_watermark('test', 10)
+db.set_watermark('test', 20)
+assert db.get_watermark('test') == 20
+db.commit()
+
+# Closing an instance does not commit the transaction of another one that
+# shares its pooled connection
+import os
+from sqlitedb.sqlitedb import SqliteDb
+other = SqliteDb(os.environ['EQ_SQLITE_PATH'])
+db = DbEvent()
+try:
+    with db.transaction():
+        db.set_watermark('shared', 5)
+        DbEvent().close()
+        assert other.query("SELECT COUNT(*) FROM watermark "
+                           "WHERE name = 'shared'")[0][0] == 0
+        raise KeyError('rollback')
+except KeyError:
+    pass
+assert db.get_watermark('shared') == 0
+other.close()
+END
+
+popd > /dev/null
+
+rm -f ${EQ_SQLITE_PATH} ${EQ_SQLITE_PATH}-wal ${EQ_SQLITE_PATH}-shm
+
+exit ${RET}
@@ -0,0 +1,149 @@
+#!/bin/bash
+
+# Run the checkpointed mode (see Q.checkpoint) on a temporary SQLite
+# database: each run only sees the events that arrived since the previous
+# one, the watermark is not moved past the too young events nor by a filtered
+# scan, and the same goes for the engine (eqd --checkpoint)
+export EQ_BACKEND=sqlite
+export EQ_SQLITE_PATH=`mktemp -u /tmp/eq-test.XXXXXX`
+
+pushd ../lib > /dev/null
+
+python - <<'END'
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from dbevent.dbevent import DbEvent
+from engine.engine import Engine
+from q.q import Q
+
+
+def queue(db, first, count):
+    """ Queue `count` critical problems, of as many hosts. """
+
+    for i in range(first, first + count):
+        db.new_events([ { 'source': 'nagios1', 'eventid': i,
+            'lasteventid': 0, 'type': 'PROBLEM', 'state': 'CRITICAL',
+            'statetype': 'HARD', 'laststate': 'OK', 'ipv4': None,
+            'ipv6': None, 'hostname': 'host%d' % i, 'servicename': 'HTTP',
+            'date': '2014-06-10', 'time': '17:33:00', 'message': 'Down' } ])
+    db.commit()
+
+
+def age(db, ids, secs=86400):
+    """ Make the given events `secs` seconds old (by default, older than any
+        grace period).
+    """
+
+    db.db.execute("UPDATE queue SET ts = %%(ts)s WHERE id IN (%s)" %
+                  ', '.join([ str(i) for i in ids ]),
+                  { 'ts': now(-secs) })
+    db.commit()
+
+
+def now(secs=0):
+    return (datetime.now() + timedelta(seconds=secs)) \
+        .strftime('%Y-%m-%d %H:%M:%S')
+
+
+def scan(since=None, **filters):
+    """ Visit (without handling) the unhandled events in checkpointed mode.
+        Returns the ids visited.
+    """
+
+    q = Q(now())
+    q.checkpoint('scan', grace=60, since=since)
+
+    seen = []
+    q.first_unhandled(**filters)
+    while q.event is not None:
+        seen.append(q.event.id())
+        q.next()
+
+    q.commit()
+    q.close()
+
+    return seen
+
+
+db = DbEvent()
+
+# The watermark stops before the first too young event (3), even if older
+# events follow it
+queue(db, 1, 4)
+age(db, [ 1, 2, 4 ])
+age(db, [ 3 ], 10)
+assert scan() == [ 1, 2, 3, 4 ]
+assert db.get_watermark('scan') == 2
+assert scan() == [ 3, 4 ]
+
+# Once 3 is old enough, the watermark is moved past all events
+age(db, [ 3 ])
+assert scan() == [ 3, 4 ]
+assert db.get_watermark('scan') == 4
+assert scan() == []
+
+# A filtered scan doesn't move the watermark (it didn't visit all events)
+queue(db, 5, 2)
+age(db, [ 5, 6 ])
+assert scan(hostname='host6') == [ 6 ]
+assert db.get_watermark('scan') == 4
+assert scan() == [ 5, 6 ]
+assert db.get_watermark('scan') == 6
+
+# `since` reprocesses the events from the given id on
+assert scan(since=3) == [ 4, 5, 6 ]
+
+# The engine keeps a watermark per script
+path = tempfile.mkdtemp()
+f = open(os.path.join(path, '50_scan.q'), 'w')
+f.write("""seen = open(__file__ + '.seen', 'a')
+q.first_unhandled()
+while q.event is not None:
+    seen.write('%d\\n' % q.event.id())
+    q.next()
+seen.write('-\\n')
+seen.close()
+""")
+f.close()
+
+
+def runs():
+    """ Return the ids visited by each run of the engine's script. """
+
+    seen = open(os.path.join(path, '50_scan.q.seen')).read()
+    return [ [ int(i) for i in run.split() ] for run in seen.split('-')[:-1] ]
+
+
+try:
+    engine = Engine(Q(now()), checkpoint=True)
+    engine.load(path)
+
+    queue(db, 7, 2)
+    age(db, [ 7 ])
+    age(db, [ 8 ], 10)
+    engine.run()
+    assert db.get_watermark('50_scan.q') == 7
+
+    # Each run takes the current time (as eqd does)
+    engine.q.ts_max = now()
+    engine.run()
+    assert db.get_watermark('50_scan.q') == 7
+
+    age(db, [ 8 ])
+    engine.run()
+    assert db.get_watermark('50_scan.q') == 8
+
+    engine.run()
+    assert runs() == [ list(range(1, 9)), [ 8 ], [ 8 ], [] ], runs()
+finally:
+    shutil.rmtree(path)
+END
+RET=$?
+
+popd > /dev/null
+
+rm -f ${EQ_SQLITE_PATH} ${EQ_SQLITE_PATH}-wal ${EQ_SQLITE_PATH}-shm
+
+exit ${RET}
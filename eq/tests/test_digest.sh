@@ -0,0 +1,151 @@
+#!/bin/bash
+
+# Run the digest mode (see Q.digest) on a temporary SQLite database: the
+# events are sent at once, only marked once their digest is sent, and a
+# digest that can't be sent is retried by the next (checkpointed) run
+export EQ_BACKEND=sqlite
+export EQ_SQLITE_PATH=`mktemp -u /tmp/eq-test.XXXXXX`
+
+pushd ../lib > /dev/null
+
+python - <<'END'
+from dbevent.dbevent import DbEvent
+from event.event import Event
+from q.q import Q
+
+
+class Notifier:
+    'Record the messages sent instead of sending them.'
+
+    def __init__(self, mail=True, smpp=True, smtp=True):
+        self.works = { 'mail': mail, 'smpp': smpp, 'smtp': smtp }
+        self.sent = []
+
+    def send(self, gateway, rcpt, message):
+        if not self.works[gateway]:
+            raise Exception("%s is down" % gateway)
+        self.sent.append((gateway, rcpt, message))
+        return True
+
+    def mail(self, rcpts, subject, body):
+        return self.send('mail', rcpts, subject)
+
+    def sms_via_smpp(self, number, message):
+        # As Notifier.sms_via_smpp, returns False if it fails
+        return self.works['smpp'] and self.send('smpp', number, message)
+
+    def sms_via_smtp(self, number, message):
+        return self.send('smtp', number, message)
+
+
+def queue(db, first, count):
+    """ Queue `count` critical problems, of as many hosts. """
+
+    for i in range(first, first + count):
+        db.new_events([ { 'source': 'nagios1', 'eventid': i,
+            'lasteventid': 0, 'type': 'PROBLEM', 'state': 'CRITICAL',
+            'statetype': 'HARD', 'laststate': 'OK', 'ipv4': None,
+            'ipv6': None, 'hostname': 'host%d' % i, 'servicename': 'HTTP',
+            'date': '2014-06-10', 'time': '17:33:00', 'message': 'Down' } ])
+    db.commit()
+
+
+def run(notifier):
+    """ Run the catch all script in digest (and checkpointed) mode. """
+
+    q = Q('2100-01-01 00:00:00')
+    q.notifier = notifier
+    q.checkpoint('digest', grace=0)
+    q.digest(60)
+
+    q.first_unhandled()
+    while q.event is not None:
+        if not q.sendsms('0041790000000'):
+            q.sendsms('0041790000000', proto=q.SMTP)
+        q.sendmail()
+        q.next()
+
+    q.commit()
+    q.close()
+
+
+def handled(db):
+    """ Return the handled value of all events. """
+
+    values = []
+    row = db.find_all('2100-01-01 00:00:00')
+    while row is not None:
+        event = Event(row)
+        values.append((event.is_mailsent(), event.is_smssent()))
+        row = db.find_next()
+
+    return values
+
+
+db = DbEvent()
+
+# One mail and one SMS for all events, the SMS via SMTP as SMPP is down
+queue(db, 1, 3)
+notifier = Notifier(smpp=False)
+run(notifier)
+assert [ s[0] for s in notifier.sent ] == [ 'mail', 'smtp' ], notifier.sent
+assert handled(db) == [ (True, True) ] * 3, handled(db)
+assert db.get_watermark('digest') == 3
+
+# Nothing can be sent: the events are left as they are, and the watermark
+# is not moved past them
+queue(db, 4, 2)
+run(Notifier(mail=False, smpp=False, smtp=False))
+assert handled(db)[3:] == [ (False, False) ] * 2, handled(db)
+assert db.get_watermark('digest') == 3
+
+# So the next run sends them
+notifier = Notifier()
+run(notifier)
+assert [ s[0] for s in notifier.sent ] == [ 'mail', 'smpp' ], notifier.sent
+assert handled(db)[3:] == [ (True, True) ] * 2, handled(db)
+assert db.get_watermark('digest') == 5
+
+# The same goes for the engine, serial or parallel (with a queue instance
+# per worker)
+import os
+import shutil
+import tempfile
+from engine.engine import Engine
+from q import q as qmod
+
+path = tempfile.mkdtemp()
+f = open(os.path.join(path, '50_digest.q'), 'w')
+f.write("""q.digest(60)
+q.first_unhandled()
+while q.event is not None:
+    q.sendmail()
+    q.next()
+""")
+f.close()
+
+try:
+    for workers, first in ((1, 6), (2, 8)):
+        queue(db, first, 2)
+        qmod.Notifier = lambda *args: Notifier(mail=False)
+        engine = Engine(Q('2100-01-01 00:00:00'), checkpoint=True,
+                        workers=workers)
+        engine.load(path)
+        engine.run()
+        assert db.get_watermark('50_digest.q') == first - 1
+
+        qmod.Notifier = lambda *args: Notifier()
+        engine.q.notifier = Notifier()
+        engine.run()
+        assert handled(db)[first - 1:] == [ (True, False) ] * 2, handled(db)
+        assert db.get_watermark('50_digest.q') == first + 1
+finally:
+    shutil.rmtree(path)
+END
+RET=$?
+
+popd > /dev/null
+
+rm -f ${EQ_SQLITE_PATH} ${EQ_SQLITE_PATH}-wal ${EQ_SQLITE_PATH}-shm
+
+exit ${RET}
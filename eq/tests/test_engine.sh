@@ -0,0 +1,126 @@
+#!/bin/bash
+
+# Run the scan engine (see engine.py) on a temporary SQLite database: in
+# parallel mode, the rules are evaluated over the partitions of the events,
+# but the other scripts run once per scan (even if no event is unhandled), and
+# the rules of a script that does more than declaring rules are run after it
+export EQ_BACKEND=sqlite
+export EQ_SQLITE_PATH=`mktemp -u /tmp/eq-test.XXXXXX`
+
+pushd ../lib > /dev/null
+
+python - <<'END'
+import os
+import shutil
+import tempfile
+from dbevent.dbevent import DbEvent
+from engine.engine import Engine
+from event.event import Event
+from q.q import Q
+
+
+def queue(db, first, count):
+    """ Queue `count` critical problems of 3 sources, alternately on the CPU
+        and HTTP services.
+    """
+
+    for i in range(first, first + count):
+        db.new_events([ { 'source': 'nagios%d' % (i % 3), 'eventid': i,
+            'lasteventid': 0, 'type': 'PROBLEM', 'state': 'CRITICAL',
+            'statetype': 'HARD', 'laststate': 'OK', 'ipv4': None,
+            'ipv6': None, 'hostname': 'host%d' % i,
+            'servicename': 'CPU' if i % 2 else 'HTTP',
+            'date': '2014-06-10', 'time': '17:33:00', 'message': 'Down' } ])
+    db.commit()
+
+
+def unhandled(db):
+    """ Return the ids of the unhandled events. """
+
+    ids = []
+    row = db.find_all_unhandled('2100-01-01 00:00:00')
+    while row is not None:
+        ids.append(Event(row).id())
+        row = db.find_next()
+
+    return ids
+
+
+def script(path, name, source):
+    f = open(os.path.join(path, name), 'w')
+    f.write(source)
+    f.close()
+
+
+def lines(path, name):
+    """ Return the lines written by the script `name` (see seen below). """
+
+    try:
+        return open(os.path.join(path, name + '.seen')).read().split()
+    except IOError:
+        return []
+
+
+db = DbEvent()
+path = tempfile.mkdtemp()
+
+# Writes the events it sees (or '-' once per scan)
+seen = """seen = open(__file__ + '.seen', 'a')
+seen.write('-\\n')
+q.first_unhandled()
+while q.event is not None:
+    seen.write('%d\\n' % q.event.id())
+    q.next()
+seen.close()
+"""
+
+script(path, '10_heartbeat.q', seen)
+script(path, '50_cpu.q', """@q.rule(servicename='CPU')
+def cpu():
+    q.ignore()
+""")
+script(path, '90_catch_all.q', seen)
+
+try:
+    engine = Engine(Q('2100-01-01 00:00:00'), workers=3)
+    engine.load(path)
+
+    # Nothing to scan: the scripts still run, once
+    engine.run()
+    assert lines(path, '10_heartbeat.q') == [ '-' ]
+    assert lines(path, '90_catch_all.q') == [ '-' ]
+
+    # The CPU rule is evaluated in parallel (one partition per source), the
+    # other scripts see all events at once
+    queue(db, 1, 9)
+    engine.run()
+    assert lines(path, '10_heartbeat.q') == [ '-', '-' ] + \
+        [ str(i) for i in range(1, 10) ], lines(path, '10_heartbeat.q')
+    assert lines(path, '90_catch_all.q') == [ '-', '-', '2', '4', '6', '8' ], \
+        lines(path, '90_catch_all.q')
+    assert unhandled(db) == [ 2, 4, 6, 8 ], unhandled(db)
+
+    # The rules of a script which doesn't only declare rules are run after
+    # it, serial or parallel
+    script(path, '60_mixed.q', """q.digest(None)
+
+@q.rule(servicename='HTTP')
+def http():
+    q.ignore()
+""")
+    for workers in (1, 3):
+        queue(db, 10 * workers, 4)
+        engine = Engine(Q('2100-01-01 00:00:00'), workers=workers)
+        engine.load(path)
+        engine.run()
+        assert unhandled(db) == [], unhandled(db)
+finally:
+    shutil.rmtree(path)
+END
+RET=$?
+
+popd > /dev/null
+
+rm -f ${EQ_SQLITE_PATH} ${EQ_SQLITE_PATH}-wal ${EQ_SQLITE_PATH}-shm
+
+exit ${RET}
@@ -0,0 +1,109 @@
+#!/bin/bash
+
+# Run the notification outbox (see Q.use_outbox and eq-dispatch) on a
+# temporary SQLite database: a notification is enqueued once, claimed by one
+# worker at a time (or again once its lease expires), and retried or given up
+# as the workers record it
+export EQ_BACKEND=sqlite
+export EQ_SQLITE_PATH=`mktemp -u /tmp/eq-test.XXXXXX`
+
+pushd ../lib > /dev/null
+
+python - <<'END'
+import os
+import sys
+import subprocess
+from dbevent.dbevent import DbEvent, POOL_SIZE
+from outbox.outbox import Outbox, MAIL, SMS, SENDING, SENT, PENDING, FAILED
+from q.q import Q
+
+
+def queue(db, first, count):
+    """ Queue `count` critical problems, of as many hosts. """
+
+    for i in range(first, first + count):
+        db.new_events([ { 'source': 'nagios1', 'eventid': i,
+            'lasteventid': 0, 'type': 'PROBLEM', 'state': 'CRITICAL',
+            'statetype': 'HARD', 'laststate': 'OK', 'ipv4': None,
+            'ipv6': None, 'hostname': 'host%d' % i, 'servicename': 'HTTP',
+            'date': '2014-06-10', 'time': '17:33:00', 'message': 'Down' } ])
+    db.commit()
+
+
+def states(outbox):
+    """ Return the state and attempts of all notifications. """
+
+    return [ tuple(row) for row in outbox.db.query(
+        'SELECT id, channel, state, attempts FROM outbox ORDER BY id') ]
+
+
+db = DbEvent()
+queue(db, 1, 2)
+
+# Notifying the same events twice enqueues a single notification (and no
+# error), committed with the events
+q = Q('2100-01-01 00:00:00')
+q.use_outbox()
+q.first_unhandled()
+while q.event is not None:
+    q.sendmail()
+    q.sendmail()
+    q.sendsms('0041790000000')
+    q.next()
+q.commit()
+q.close()
+
+outbox = Outbox()
+assert [ s[1:] for s in states(outbox) ] == [ (MAIL, PENDING, 0),
+    (SMS, PENDING, 0), (MAIL, PENDING, 0), (SMS, PENDING, 0) ], states(outbox)
+ids = [ s[0] for s in states(outbox) ]
+
+# Enqueueing an existing notification returns its id
+row = outbox.db.query('SELECT dedupkey FROM outbox WHERE id = %(id)s',
+                      { 'id': ids[2] })[0]
+assert outbox.enqueue(row[0], MAIL, 'eq-admin@your.domain.com', 'x') == ids[2]
+outbox.commit()
+assert len(states(outbox)) == 4
+
+# A worker claims up to `limit` notifications, the others are left to the
+# next one
+claimed = outbox.claim('w1', limit=3)
+assert [ c[0] for c in claimed ] == ids[:3], claimed
+assert [ c[6] for c in claimed ] == [ 1 ] * 3
+assert [ c[0] for c in outbox.claim('w2') ] == ids[3:]
+assert outbox.claim('w3') == []
+
+# w1 delivers one, retries one later and gives up the last one
+outbox.sent(ids[0])
+outbox.retry(ids[1], 'gateway is down', 3600)
+outbox.fail(ids[2], 'no such recipient')
+assert [ s[2:] for s in states(outbox) ] == [ (SENT, 1), (PENDING, 1),
+    (FAILED, 1), (SENDING, 1) ], states(outbox)
+assert outbox.claim('w3') == []
+
+# w2 dies: its notification is claimed again once the lease has expired,
+# as is the retried one once its delay has passed
+outbox.db.execute("UPDATE outbox SET nextts = '2000-01-01 00:00:00' "
+                  "WHERE state IN ('pending', 'sending')")
+outbox.commit()
+claimed = outbox.claim('w3')
+assert [ (c[0], c[6]) for c in claimed ] == [ (ids[1], 2), (ids[3], 2) ], \
+    claimed
+assert [ s[2] for s in states(outbox) ] == [ SENT, SENDING, FAILED, SENDING ]
+outbox.close()
+
+# eq-dispatch refuses more workers than pooled connections
+dispatch = os.path.join('..', 'bin', 'eq-dispatch')
+for workers in (0, POOL_SIZE):
+    p = subprocess.Popen([ sys.executable, dispatch, '-w', str(workers) ],
+                         stderr=subprocess.PIPE)
+    p.communicate()
+    assert p.returncode == 2, workers
+END
+RET=$?
+
+popd > /dev/null
+
+rm -f ${EQ_SQLITE_PATH} ${EQ_SQLITE_PATH}-wal ${EQ_SQLITE_PATH}-shm
+
+exit ${RET}
@@ -0,0 +1,102 @@
+#!/bin/bash
+
+# Run eq-spoold against a fake Event Queue API: no event is lost while the
+# API fails (5xx), and only the events it refuses (4xx) are put aside in
+# spool.rejected
+export SPOOL_DIR=`mktemp -d /tmp/eq-test.XXXXXX`
+
+pushd ../sbin > /dev/null
+
+python - <<'END'
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import subprocess
+
+try:
+    # Python 2
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+path = os.environ['SPOOL_DIR']
+failures = [ 2 ]    # how many requests fail (503) first
+received = []       # the events accepted
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_PUT(self):
+        events = self.rfile.read(int(self.headers['Content-Length']))
+        events = [ json.loads(e.decode('utf-8'))
+                   for e in events.split(b'\n') ]
+
+        if failures[0]:
+            failures[0] -= 1
+            status, body = 503, []
+        elif [ e for e in events if e['source'] == 'bad' ]:
+            status, body = 400, []
+        else:
+            received.extend([ e['eventid'] for e in events ])
+            status, body = 200, [ { 'id': e['eventid'] } for e in events ]
+
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+server = HTTPServer(('127.0.0.1', 0), Handler)
+t = threading.Thread(target=server.serve_forever)
+t.daemon = True
+t.start()
+
+sock = os.path.join(path, 'eq-spoold.sock')
+agent = subprocess.Popen([ sys.executable, 'eq-spoold', '-s', sock,
+    '-d', path, '-b', '4', '-u', 'http://127.0.0.1:%d/eq/new-events' %
+    server.server_address[1] ])
+
+try:
+    while not os.path.exists(sock):
+        time.sleep(0.1)
+
+    events = [ { 'source': 'nagios1', 'eventid': i } for i in range(10) ]
+    events[5]['source'] = 'bad'
+    data = '\n'.join([ json.dumps(e) for e in events ] + [ 'not json' ])
+
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(sock)
+    s.sendall(data.encode('utf-8') + b'\n')
+    s.shutdown(socket.SHUT_WR)
+    assert s.recv(10) == b'OK\n'
+    s.close()
+
+    rejected = os.path.join(path, 'spool.rejected')
+    deadline = time.time() + 30
+    while set(received) != set(range(10)) - set([ 5 ]) \
+            or not os.path.exists(rejected):
+        assert time.time() < deadline, received
+        time.sleep(0.1)
+
+    # The failures were retried, only the refused event was put aside
+    assert failures[0] == 0
+    assert [ json.loads(e) for e in open(rejected).read().splitlines() ] \
+        == [ events[5] ]
+finally:
+    agent.terminate()
+    agent.wait()
+    server.shutdown()
+END
+RET=$?
+
+popd > /dev/null
+
+rm -rf ${SPOOL_DIR}
+
+exit ${RET}
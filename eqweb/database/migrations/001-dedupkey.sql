@@ -0,0 +1,45 @@
+--
+-- Add the `dedupkey` column to the `queue` table. The key identifies
+-- duplicate events (same source, eventid, lasteventid, type, state, hostname
+-- and servicename) so that events can be ingested with a single
+-- INSERT ... ON DUPLICATE KEY UPDATE statement (see UPSERT in dbevent.py).
+--
+-- The key must match the one computed by dedup_key() in dbevent.py, i.e., the
+-- SHA1 of the UTF-8 bytes whatever the charset of the columns, hence the
+-- explicit conversions. Text values are lowercased and stripped of trailing
+-- spaces, as the (case insensitive) collation of the columns compares them.
+-- Only the first (oldest) event of each group of existing duplicates gets a
+-- key, so the id returned for new duplicates stays the same as before.
+--
+-- Usage: mysql -u root -p event < 001-dedupkey.sql
+--
+
+ALTER TABLE `event`.`queue`
+  ADD COLUMN `dedupkey` binary(20) DEFAULT NULL AFTER `lasteventid`;
+
+UPDATE `event`.`queue` q
+  JOIN (SELECT MIN(k.`id`) AS `id`, k.`dedupkey`
+          FROM (SELECT `id`, UNHEX(SHA1(CONCAT_WS(CHAR(31 USING utf8mb4),
+                    LOWER(TRIM(TRAILING ' ' FROM
+                          CONVERT(`source` USING utf8mb4))),
+                    `eventid`, `lasteventid`,
+                    LOWER(TRIM(TRAILING ' ' FROM
+                          CONVERT(`type` USING utf8mb4))),
+                    IFNULL(LOWER(TRIM(TRAILING ' ' FROM
+                          CONVERT(`state` USING utf8mb4))),
+                           CHAR(0 USING utf8mb4)),
+                    IFNULL(LOWER(TRIM(TRAILING ' ' FROM
+                          CONVERT(`hostname` USING utf8mb4))),
+                           CHAR(0 USING utf8mb4)),
+                    IFNULL(LOWER(TRIM(TRAILING ' ' FROM
+                          CONVERT(`servicename` USING utf8mb4))),
+                           CHAR(0 USING utf8mb4))))) AS `dedupkey`
+                  FROM `event`.`queue`) k
+         GROUP BY k.`dedupkey`) f
+    ON q.`id` = f.`id`
+   SET q.`dedupkey` = f.`dedupkey`;
+
+ALTER TABLE `event`.`queue`
+  ADD UNIQUE KEY `dedupkey_idx` (`dedupkey`);
+
+-- End
@@ -0,0 +1,31 @@
+--
+-- Add the `outbox` table: notifications are enqueued there by the q scripts
+-- (see q.use_outbox() and outbox.py) and delivered by the eq-dispatch
+-- workers, so that a slow gateway doesn't stall the scan of the queue.
+--
+-- Usage: mysql -u root -p event < 002-outbox.sql
+--
+
+CREATE TABLE `event`.`outbox` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `ts` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `dedupkey` binary(20) NOT NULL,
+  `channel` varchar(10) NOT NULL,
+  `proto` tinyint(1) DEFAULT NULL,
+  `rcpt` varchar(1024) NOT NULL,
+  `subject` varchar(255) DEFAULT NULL,
+  `body` text NOT NULL,
+  `state` varchar(10) NOT NULL DEFAULT 'pending',
+  `attempts` int(11) NOT NULL DEFAULT '0',
+  `nextts` datetime NOT NULL,
+  `claimedby` varchar(255) DEFAULT NULL,
+  `error` varchar(255) DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `dedupkey_idx` (`dedupkey`),
+  KEY `state_nextts_idx` (`state`, `nextts`)
+) ENGINE=InnoDB;
+
+GRANT ALL PRIVILEGES ON event.outbox TO 'qapi'@'localhost';
+FLUSH PRIVILEGES;
+
+-- End
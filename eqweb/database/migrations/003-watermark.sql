@@ -0,0 +1,19 @@
+--
+-- Add the `watermark` table: the last event id processed by each q script
+-- running in checkpointed mode (see q.checkpoint()), so that the next run
+-- only reads the events that arrived since.
+--
+-- Usage: mysql -u root -p event < 003-watermark.sql
+--
+
+CREATE TABLE `event`.`watermark` (
+  `name` varchar(255) NOT NULL,
+  `lastid` int(11) NOT NULL DEFAULT '0',
+  `ts` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`name`)
+) ENGINE=InnoDB;
+
+GRANT ALL PRIVILEGES ON event.watermark TO 'qapi'@'localhost';
+FLUSH PRIVILEGES;
+
+-- End
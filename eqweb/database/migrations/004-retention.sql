@@ -0,0 +1,46 @@
+--
+-- Add the `queue_archive` table: the handled events older than a number of
+-- days are moved here by eq-retention. The table is partitioned by month, so
+-- that the old events can be dropped a month at a time. eq-retention creates
+-- the monthly partitions (out of the catch-all `pmax` partition).
+--
+-- Partitioned tables can't have unique keys without the partitioning column,
+-- hence the primary key on (id, ts) and no unique key on `dedupkey`.
+--
+-- Usage: mysql -u root -p event < 004-retention.sql
+--
+
+CREATE TABLE `event`.`queue_archive` (
+  `id` int(11) NOT NULL,
+  `ts` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `source` varchar(255) NOT NULL,
+  `eventid` int(11) NOT NULL DEFAULT '0',
+  `lasteventid` int(11) NOT NULL DEFAULT '0',
+  `dedupkey` binary(20) DEFAULT NULL,
+  `type` varchar(255) NOT NULL,
+  `state` varchar(255) DEFAULT NULL,
+  `statetype` varchar(255) DEFAULT NULL,
+  `laststate` varchar(255) DEFAULT NULL,
+  `count` int(11) DEFAULT '1',
+  `handled` tinyint(1) NOT NULL DEFAULT '0',
+  `ipv4` int(10) unsigned DEFAULT NULL,
+  `ipv6` binary(16) DEFAULT NULL,
+  `hostname` varchar(255) DEFAULT NULL,
+  `servicename` varchar(255) DEFAULT NULL,
+  `date` varchar(30) NOT NULL,
+  `time` varchar(30) NOT NULL,
+  `message` text,
+  PRIMARY KEY (`id`, `ts`),
+  KEY `ts_idx` (`ts`),
+  KEY `hostname_idx` (`hostname`),
+  KEY `eventid_idx` (`source`,`eventid`)
+) ENGINE=InnoDB
+PARTITION BY RANGE (UNIX_TIMESTAMP(`ts`)) (
+  PARTITION `pmax` VALUES LESS THAN MAXVALUE
+);
+
+GRANT ALL PRIVILEGES ON event.queue_archive TO 'qapi'@'localhost';
+GRANT SELECT ON event.queue_archive TO 'eqweb'@'localhost';
+FLUSH PRIVILEGES;
+
+-- End
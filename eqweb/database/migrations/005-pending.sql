@@ -0,0 +1,52 @@
+--
+-- Add the `pending` table: the ids of the unhandled events of the queue. The
+-- triggers below keep it up to date on every insert, update and delete of the
+-- queue, so that the scan of the unhandled events (see PENDING_TABLE in
+-- dbevent.py) reads a table that only grows with the backlog, not with the
+-- history of the queue.
+--
+-- The table only holds the id, so that `pending JOIN queue USING (id)` has no
+-- ambiguous columns.
+--
+-- Usage: mysql -u root -p event < 005-pending.sql
+--
+
+CREATE TABLE `event`.`pending` (
+  `id` int(11) NOT NULL,
+  PRIMARY KEY (`id`)
+) ENGINE=InnoDB;
+
+DELIMITER ;;
+
+CREATE TRIGGER `event`.`queue_pending_insert` AFTER INSERT ON `event`.`queue`
+FOR EACH ROW BEGIN
+  IF NEW.handled = 0 THEN
+    INSERT IGNORE INTO `event`.`pending` (`id`) VALUES (NEW.id);
+  END IF;
+END;;
+
+CREATE TRIGGER `event`.`queue_pending_update` AFTER UPDATE ON `event`.`queue`
+FOR EACH ROW BEGIN
+  IF NEW.handled = 0 AND OLD.handled <> 0 THEN
+    INSERT IGNORE INTO `event`.`pending` (`id`) VALUES (NEW.id);
+  ELSEIF NEW.handled <> 0 AND OLD.handled = 0 THEN
+    DELETE FROM `event`.`pending` WHERE `id` = OLD.id;
+  END IF;
+END;;
+
+CREATE TRIGGER `event`.`queue_pending_delete` AFTER DELETE ON `event`.`queue`
+FOR EACH ROW BEGIN
+  DELETE FROM `event`.`pending` WHERE `id` = OLD.id;
+END;;
+
+DELIMITER ;
+
+-- The events already waiting in the queue
+INSERT IGNORE INTO `event`.`pending` SELECT `id` FROM `event`.`queue`
+  WHERE `handled` = 0;
+
+GRANT ALL PRIVILEGES ON event.pending TO 'qapi'@'localhost';
+GRANT SELECT ON event.pending TO 'eqweb'@'localhost';
+FLUSH PRIVILEGES;
+
+-- End
@@ -57,6 +57,7 @@ CREATE TABLE `queue` (
   `source` varchar(255) NOT NULL,
   `eventid` int(11) NOT NULL DEFAULT '0',
   `lasteventid` int(11) NOT NULL DEFAULT '0',
+  `dedupkey` binary(20) DEFAULT NULL,
   `type` varchar(255) NOT NULL,
   `state` varchar(255) DEFAULT NULL,
   `statetype` varchar(255) DEFAULT NULL,
@@ -78,9 +79,113 @@ CREATE TABLE `queue` (
   KEY `ipv4_idx` (`ipv4`),
   KEY `ipv6_idx` (`ipv6`),
   KEY `hostname_idx` (`hostname`),
+  KEY `eventid_idx` (`source`,`eventid`),
+  UNIQUE KEY `dedupkey_idx` (`dedupkey`)
+) ENGINE=InnoDB;
+
+
+--
+-- Table structure for table `outbox`
+--
+DROP TABLE IF EXISTS `event`.`outbox`;
+CREATE TABLE `outbox` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `ts` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `dedupkey` binary(20) NOT NULL,
+  `channel` varchar(10) NOT NULL,
+  `proto` tinyint(1) DEFAULT NULL,
+  `rcpt` varchar(1024) NOT NULL,
+  `subject` varchar(255) DEFAULT NULL,
+  `body` text NOT NULL,
+  `state` varchar(10) NOT NULL DEFAULT 'pending',
+  `attempts` int(11) NOT NULL DEFAULT '0',
+  `nextts` datetime NOT NULL,
+  `claimedby` varchar(255) DEFAULT NULL,
+  `error` varchar(255) DEFAULT NULL,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `dedupkey_idx` (`dedupkey`),
+  KEY `state_nextts_idx` (`state`, `nextts`)
+) ENGINE=InnoDB;
+
+
+--
+-- Table structure for table `watermark`
+--
+DROP TABLE IF EXISTS `event`.`watermark`;
+CREATE TABLE `watermark` (
+  `name` varchar(255) NOT NULL,
+  `lastid` int(11) NOT NULL DEFAULT '0',
+  `ts` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+  PRIMARY KEY (`name`)
+) ENGINE=InnoDB;
+
+
+--
+-- Table structure for table `queue_archive` (see eq-retention)
+--
+DROP TABLE IF EXISTS `event`.`queue_archive`;
+CREATE TABLE `event`.`queue_archive` (
+  `id` int(11) NOT NULL,
+  `ts` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `source` varchar(255) NOT NULL,
+  `eventid` int(11) NOT NULL DEFAULT '0',
+  `lasteventid` int(11) NOT NULL DEFAULT '0',
+  `dedupkey` binary(20) DEFAULT NULL,
+  `type` varchar(255) NOT NULL,
+  `state` varchar(255) DEFAULT NULL,
+  `statetype` varchar(255) DEFAULT NULL,
+  `laststate` varchar(255) DEFAULT NULL,
+  `count` int(11) DEFAULT '1',
+  `handled` tinyint(1) NOT NULL DEFAULT '0',
+  `ipv4` int(10) unsigned DEFAULT NULL,
+  `ipv6` binary(16) DEFAULT NULL,
+  `hostname` varchar(255) DEFAULT NULL,
+  `servicename` varchar(255) DEFAULT NULL,
+  `date` varchar(30) NOT NULL,
+  `time` varchar(30) NOT NULL,
+  `message` text,
+  PRIMARY KEY (`id`, `ts`),
+  KEY `ts_idx` (`ts`),
+  KEY `hostname_idx` (`hostname`),
   KEY `eventid_idx` (`source`,`eventid`)
+) ENGINE=InnoDB
+PARTITION BY RANGE (UNIX_TIMESTAMP(`ts`)) (
+  PARTITION `pmax` VALUES LESS THAN MAXVALUE
+);
+
+--
+-- Table structure for table `pending` (the ids of the unhandled events)
+--
+DROP TABLE IF EXISTS `event`.`pending`;
+CREATE TABLE `event`.`pending` (
+  `id` int(11) NOT NULL,
+  PRIMARY KEY (`id`)
 ) ENGINE=InnoDB;
 
+--
+-- Keep the `pending` table in sync with the queue
+--
+DELIMITER ;;
+CREATE TRIGGER `event`.`queue_pending_insert` AFTER INSERT ON `event`.`queue`
+FOR EACH ROW BEGIN
+  IF NEW.handled = 0 THEN
+    INSERT IGNORE INTO `event`.`pending` (`id`) VALUES (NEW.id);
+  END IF;
+END;;
+CREATE TRIGGER `event`.`queue_pending_update` AFTER UPDATE ON `event`.`queue`
+FOR EACH ROW BEGIN
+  IF NEW.handled = 0 AND OLD.handled <> 0 THEN
+    INSERT IGNORE INTO `event`.`pending` (`id`) VALUES (NEW.id);
+  ELSEIF NEW.handled <> 0 AND OLD.handled = 0 THEN
+    DELETE FROM `event`.`pending` WHERE `id` = OLD.id;
+  END IF;
+END;;
+CREATE TRIGGER `event`.`queue_pending_delete` AFTER DELETE ON `event`.`queue`
+FOR EACH ROW BEGIN
+  DELETE FROM `event`.`pending` WHERE `id` = OLD.id;
+END;;
+DELIMITER ;
+
 
 --
 -- Create an Event Queue User
@@ -88,6 +193,14 @@ CREATE TABLE `queue` (
 CREATE USER 'qapi'@'localhost' IDENTIFIED BY 'password';
 -- Allow read-write on the queue table
 GRANT ALL PRIVILEGES ON event.queue TO 'qapi'@'localhost';
+-- Allow read-write on the outbox table
+GRANT ALL PRIVILEGES ON event.outbox TO 'qapi'@'localhost';
+-- Allow read-write on the watermark table
+GRANT ALL PRIVILEGES ON event.watermark TO 'qapi'@'localhost';
+-- Allow read-write on the queue_archive table (and its partitions)
+GRANT ALL PRIVILEGES ON event.queue_archive TO 'qapi'@'localhost';
+-- Allow read-write on the pending table
+GRANT ALL PRIVILEGES ON event.pending TO 'qapi'@'localhost';
 
 --
 -- Create an Event Queue Web User
@@ -95,6 +208,10 @@ GRANT ALL PRIVILEGES ON event.queue TO 'qapi'@'localhost';
 CREATE USER 'eqweb'@'localhost' IDENTIFIED BY 'password';
 -- Grant read-only to the queue table
 GRANT SELECT ON event.queue TO 'eqweb'@'localhost';
+-- Grant read-only to the queue_archive table
+GRANT SELECT ON event.queue_archive TO 'eqweb'@'localhost';
+-- Grant read-only to the pending table
+GRANT SELECT ON event.pending TO 'eqweb'@'localhost';
 -- Allow read-write on the user table
 GRANT ALL PRIVILEGES ON event.user TO 'eqweb'@'localhost';
 -- Allow read-write on the query table